@@ -13,8 +13,8 @@
 # limitations under the License.
 #
 # ==============================================================================
+import itertools
 import os
-import random
 
 import numpy as np
 
@@ -25,19 +25,22 @@ import tensorflow as tf
 if __name__ == 'LatEvModels':
     from datetools import addDateTime #@UnresolvedImport #@UnusedImport
     from layers import FullLayer #@UnresolvedImport #@UnusedImport
+    from utils import (EvolutionMatrices, get_dtypes, lower_chol_variable, #@UnresolvedImport #@UnusedImport
+                       apply_to_nonzero_rows, IdGroups) #@UnresolvedImport #@UnusedImport
 else:
     from .datetools import addDateTime # @UnresolvedImport @Reimport
     from .layers import FullLayer  # @Reimport
+    from .utils import (EvolutionMatrices, get_dtypes, lower_chol_variable, # @Reimport
+                        apply_to_nonzero_rows, IdGroups) # @Reimport
 
 
 TEST_DIR = './tests/test_results/'
-DTYPE = tf.float32
 
 def flow_modulator(x, x0=30.0, a=0.08):
     return (1 - np.tanh(a*(x - x0)))/2
 
 def flow_modulator_tf(X, x0=30.0, a=0.08):
-    return tf.cast((1.0 - tf.tanh(a*(X - x0)) )/2, DTYPE)
+    return tf.cast((1.0 - tf.tanh(a*(X - x0)) )/2, X.dtype)
 
 
 class NoisyEvolution():
@@ -69,6 +72,24 @@ class NoisyEvolution():
         """        
         self.X = X
         self.params = params
+        self.dtype, self.fact_dtype = get_dtypes(params)
+        
+        # The variable scope of the evolution network, needed to add the
+        # sampler to the graph later on.
+        self.var_scope = tf.get_variable_scope()
+        self._samplers = {}
+        self._fixed_point_finders = {}
+        # The evolution network is built once per input. See
+        # `_define_evolution_matrices`.
+        self._evolution_cache = {}
+        self._dense_evolution_cache = {}
+        # Tables of A(x) on a grid, for fast evaluations of the dynamics when
+        # xDim is small. See `get_A_grid`.
+        self._A_grids = {}
+        self.A_grid_range = ( params.A_grid_range if hasattr(params, 'A_grid_range')
+                              else 40.0 )
+        self.A_grid_points = ( params.A_grid_points if hasattr(params, 'A_grid_points')
+                               else 101 )
         
         # The Ids placeholder
         self.Ids = Ids = ( tf.placeholder(dtype=tf.int32, shape=[None], name='Ids') 
@@ -83,46 +104,107 @@ class NoisyEvolution():
         else: self.num_diff_entities = 1
 
         # The pDim parameters corresponding to each different entity.
-        self.ev_params_Pxp = tf.get_variable('ev_params', shape=[self.num_diff_entities, pDim])
+        self.ev_params_Pxp = self._define_entity_table('ev_params', [self.num_diff_entities, pDim])
 
         if params.with_inputs:
             # The Inputs placeholder (if with_inputs)
             self.iDim = iDim = params.iDim
-            self.I = ( tf.placeholder(dtype=DTYPE, shape=[None, None, iDim], name='Inputs') if 
+            self.I = ( tf.placeholder(dtype=self.dtype, shape=[None, None, iDim], name='Inputs') if 
                        Inputs is None else Inputs )
         
-        # Variance (Q) of the state-space evolution. 
+        # Variance (Q) of the state-space evolution. QInvChol is lower
+        # triangular with a log-parameterized diagonal, so that QInv is always
+        # positive definite and QChol follows from a triangular solve. With the
+        # 'diagonal' and 'isotropic' structures, Q and Q0 are diagonal and the
+        # products with QInv are elementwise scalings (QInv_d, Q0Inv_d are
+        # their diagonals, None for the 'full' structure).
+        self.Q_structure = Q_structure = ( params.Q_structure if hasattr(params, 'Q_structure')
+                                           else 'full' )
         init_Q = params.init_Q
-        self.QInvChol_dxd = tf.get_variable('QInvChol', 
-                                            initializer=tf.cast(init_Q*tf.eye(xDim), DTYPE),
-                                            trainable=params.is_Q_trainable)
-        self.QChol_dxd = tf.matrix_inverse(self.QInvChol_dxd, name='QChol')
+        self.QInvChol_dxd, self.QInvChol_logdiag_d = lower_chol_variable(
+            'QInvChol', xDim, init_Q, dtype=self.dtype, trainable=params.is_Q_trainable,
+            structure=Q_structure)
+        self.QChol_dxd, self.QInv_d = self._invert_chol(self.QInvChol_dxd, self.QInvChol_logdiag_d,
+                                                        name='QChol')
         self.QInv_dxd = tf.matmul(self.QInvChol_dxd, self.QInvChol_dxd, transpose_b=True,
                                   name='QInv')
-        self.Q_dxd = tf.matmul(self.QChol_dxd, self.QChol_dxd, transpose_b=True,
+        self.Q_dxd = tf.matmul(self.QChol_dxd, self.QChol_dxd, transpose_a=True,
                                name='Q')
         
         # Variance of the initial points
         init_Q0 = params.init_Q0
-        self.Q0InvChol_dxd = tf.get_variable('Q0InvChol',
-                                             initializer=tf.cast(init_Q0*tf.eye(xDim), DTYPE))
-        self.Q0Chol_dxd = tf.matrix_inverse(self.Q0InvChol_dxd, name='Q0Chol')
+        self.Q0InvChol_dxd, self.Q0InvChol_logdiag_d = lower_chol_variable(
+            'Q0InvChol', xDim, init_Q0, dtype=self.dtype, structure=Q_structure)
+        self.Q0Chol_dxd, self.Q0Inv_d = self._invert_chol(self.Q0InvChol_dxd,
+                                                          self.Q0InvChol_logdiag_d, name='Q0Chol')
         self.Q0Inv_dxd = tf.matmul(self.Q0InvChol_dxd, self.Q0InvChol_dxd,
                                    transpose_b=True, name='Q0Inv')
         
         # The mean starting coordinates in state-space
-        self.x0 = tf.get_variable('x0', initializer=tf.cast(tf.zeros(self.xDim), DTYPE))
+        self.x0 = tf.get_variable('x0', initializer=tf.zeros(self.xDim, dtype=self.dtype))
          
         self.alpha = params.alpha
+        
+        # The structure of the nonlinear part B(x) of the evolution. 'dense'
+        # outputs d^2 entries, 'lowrank' the factors of B = U*V^T of rank
+        # evolution_rank, 'blockdiag' the diagonal blocks of size
+        # evolution_block_size. See `utils.EvolutionMatrices`.
+        self.evolution_structure = ( params.evolution_structure
+                                     if hasattr(params, 'evolution_structure') else 'dense' )
+        if self.evolution_structure == 'lowrank':
+            self.evolution_rank = params.evolution_rank
+        elif self.evolution_structure == 'blockdiag':
+            self.evolution_block_size = params.evolution_block_size
+            if xDim % self.evolution_block_size:
+                raise ValueError("xDim must be a multiple of evolution_block_size")
+        elif self.evolution_structure != 'dense':
+            raise ValueError("Unknown evolution_structure {}".format(self.evolution_structure))
 
         # The base linear element of the evolution 
         if not hasattr(self, 'Alinear'):
-            self.Alinear_dxd = tf.get_variable('Alinear', initializer=tf.eye(xDim),
-                                               dtype=DTYPE)
+            self.Alinear_dxd = tf.get_variable('Alinear',
+                                               initializer=tf.eye(xDim, dtype=self.dtype))
         
-        # Define the evolution for *this* instance
+        # Define the evolution for *this* instance. The dense matrices are only
+        # computed if something asks for them.
 #         self.A_NxTxdxd, self.Awinflow_NxTxdxd, self.B_NxTxdxd = self._define_evolution_network()
-        self.A_NxTxdxd, self.Awinflow_NxTxdxd, self.B_NxTxdxd = self._define_evolution_network_wi()
+        self.A_evol, self.Awinflow_evol = self._define_evolution_matrices()
+        self.A_NxTxdxd, self.Awinflow_NxTxdxd, self.B_NxTxdxd = self._densify_evolution(
+            self.A_evol, self.Awinflow_evol)
+    
+    def _define_entity_table(self, name, shape):
+        """
+        A variable with a row of parameters per entity, to be read only with
+        tf.nn.embedding_lookup so that its gradients are sparse in the rows.
+        If params.entity_shards > 1, the rows are split across that many
+        variables (a PartitionedVariable). Every piece goes to the 'ENTITY'
+        collection, see Optimizer_TS for their lazy updates.
+        """
+        num_shards = self.params.entity_shards if hasattr(self.params, 'entity_shards') else 1
+        partitioner = tf.fixed_size_partitioner(num_shards) if num_shards > 1 else None
+        table = tf.get_variable(name, shape=shape, dtype=self.dtype, partitioner=partitioner)
+        for var in (table if partitioner is not None else [table]):
+            if var not in tf.get_collection('ENTITY'): tf.add_to_collection('ENTITY', var)
+        return table
+    
+    def _invert_chol(self, InvChol_dxd, logdiag_d, name):
+        """
+        Returns the factor Chol = InvChol^{-1} and, for diagonal structures,
+        the diagonal of InvChol*InvChol^T (None otherwise).
+        """
+        if self.Q_structure == 'full':
+            return tf.matrix_triangular_solve(InvChol_dxd, tf.eye(self.xDim, dtype=self.dtype),
+                                              name=name), None
+        return tf.matrix_diag(tf.exp(-logdiag_d), name=name), tf.exp(2.0*logdiag_d)
+    
+    def rmul_QInv(self, X_Mxd, initial=False):
+        """
+        Returns X*QInv (X*Q0Inv if initial) for a batch of row vectors X, an
+        elementwise scaling for the diagonal structures.
+        """
+        QInv_d = self.Q0Inv_d if initial else self.QInv_d
+        if QInv_d is not None: return X_Mxd*QInv_d
+        return tf.matmul(X_Mxd, self.Q0Inv_dxd if initial else self.QInv_dxd)
     
     def _define_evolution_network(self, X=None, Ids=None):
         """
@@ -140,7 +222,7 @@ class NoisyEvolution():
         NTbins = tf.shape(X_NxTxd)[1]
         
         # Expand the parameters according to the provided trial Ids
-        ev_params_Nxp = tf.gather(self.ev_params_Pxp, indices=Ids)
+        ev_params_Nxp = tf.nn.embedding_lookup(self.ev_params_Pxp, Ids)
         ev_params_NxTxp = tf.tile(tf.expand_dims(ev_params_Nxp, axis=1), [1, NTbins, 1])
 
         rangeB = self.params.initrange_B
@@ -163,10 +245,9 @@ class NoisyEvolution():
         
         X_norms = tf.norm(State_NTxr[:,:xDim], axis=1)
         fl_mod = flow_modulator_tf(X_norms)
-        eye_swap = tf.transpose(tf.tile(tf.expand_dims(tf.eye(self.xDim), 0),
-                                        [Nsamps*NTbins, 1, 1]), [2,1,0])
-        Awinflow_NTxdxd = tf.transpose(fl_mod*tf.transpose(
-                                A_NTxdxd, [2,1,0]) + 0.9*(1.0-fl_mod)*eye_swap, [2,1,0])
+        fl_mod_NTx1x1 = tf.reshape(fl_mod, [Nsamps*NTbins, 1, 1])
+        Awinflow_NTxdxd = ( fl_mod_NTx1x1*A_NTxdxd +
+                            0.9*(1.0-fl_mod_NTx1x1)*tf.eye(self.xDim, dtype=self.dtype) ) # Broadcast
         Awinflow_NxTxdxd = tf.reshape(Awinflow_NTxdxd, 
                                       [Nsamps, NTbins, xDim, xDim], name='Awinflow')
         
@@ -175,75 +256,357 @@ class NoisyEvolution():
 
     def _define_evolution_network_wi(self, X=None, Ids=None, Inputs=None):
         """
+        Returns the dense evolution matrices A, Awinflow and the nonlinearity B
+        at X. See `_define_evolution_matrices`.
+        """
+        return self._densify_evolution(*self._define_evolution_matrices(X, Ids, Inputs))
+    
+    def _densify_evolution(self, A, Awinflow):
+        """
+        Materializes every entry of the evolution, for the consumers that need
+        the dense matrices (the named 'A', 'Awinflow' and 'B' nodes, the grid
+        of A(x), the Jacobians). The costs use the structured products of A
+        instead, so these nodes are only evaluated when they are fetched.
+
+        With the 'dense' structure this only names the network output. With
+        'lowrank' it adds U*V^T to the graph, and with 'blockdiag' the k blocks
+        scattered into d x d matrices, O(d^2) memory per point in both cases.
+        The nodes are added once per A.
+
+        Args:
+            A, Awinflow: The `EvolutionMatrices` without and with inflow, as
+                returned by `_define_evolution_matrices`
+
+        Returns:
+            A_NxTxdxd, Awinflow_NxTxdxd, B_NxTxdxd: The dense A(x_t), its
+                version with inflow and the nonlinear part B(x_t)
+        """
+        if A in self._dense_evolution_cache: return self._dense_evolution_cache[A]
+        A_NxTxdxd = tf.identity(A.dense(), name='A')
+        Awinflow_NxTxdxd = tf.identity(Awinflow.dense(), name='Awinflow')
+        B_NxTxdxd = tf.identity(A.dense_B(), name='B')
+        self._dense_evolution_cache[A] = A_NxTxdxd, Awinflow_NxTxdxd, B_NxTxdxd
         
+        return A_NxTxdxd, Awinflow_NxTxdxd, B_NxTxdxd
+    
+    def _define_evolution_matrices(self, X=None, Ids=None, Inputs=None):
         """
-        params = self.params
+        Defines the evolution at X. For alpha = 0 the evolution is globally
+        linear and the evolution network is never built.
         
-        xDim = self.xDim
-        pDim = self.pDim
-        if params.with_inputs:
-            iDim = self.iDim    
-        rDim = xDim + pDim + iDim if params.with_mod_dynamics else xDim + pDim
+        The result is memoized per (X, Ids, Inputs), so that the costs that
+        evaluate the evolution on the same tensor (e.g. the ELBO with and
+        without inflow on noisy_postX) share a single copy of the network.
+        
+        Returns:
+            A, Awinflow: The `EvolutionMatrices` A(x_t) without and with an inward
+                flow from infinity superimposed
+        """
+        params = self.params
         
         if X is None and Ids is not None: raise ValueError("Must provide an X for these Ids")
         X_NxTxd = self.X if X is None else X
         if Ids is None: Ids = self.Ids
 
+        Inputs_NxTxi = ( (self.I if Inputs is None else Inputs) if params.with_mod_dynamics
+                         else None )
+        key = (X_NxTxd, Ids, Inputs_NxTxi)
+        if key in self._evolution_cache: return self._evolution_cache[key]
+
+        if not self.alpha:
+            # Globally linear dynamics, A = Alinear. The evolution network is
+            # not built.
+            A = EvolutionMatrices(self.Alinear_dxd, self.alpha,
+                                  batch_shape=tf.shape(X_NxTxd)[:2])
+        else:
+            A = self._define_evolution_network_matrices(X_NxTxd, Ids, Inputs_NxTxi)
+        
+        # Awinflow = fl_mod*A + 0.9*(1 - fl_mod)*I
+        fl_mod_NxT = flow_modulator_tf(tf.norm(X_NxTxd, axis=2))
+        Awinflow = A.with_inflow(fl_mod_NxT, 0.9*(1.0 - fl_mod_NxT))
+        self._evolution_cache[key] = A, Awinflow
+         
+        return A, Awinflow
+
+    def _define_evolution_network_matrices(self, X_NxTxd, Ids, Inputs_NxTxi=None):
+        """
+        Builds the evolution network at X_NxTxd and returns the
+        `EvolutionMatrices` A(x_t) with the structure of its output head.
+        """
+        params = self.params
+        xDim = self.xDim
+        
         Nsamps = tf.shape(X_NxTxd)[0]
         NTbins = tf.shape(X_NxTxd)[1]
-        # Expand the parameters according to the provided trial Ids
-        ev_params_Nxp = tf.gather(self.ev_params_Pxp, indices=Ids)
-        ev_params_NxTxp = tf.tile(tf.expand_dims(ev_params_Nxp, axis=1), [1, NTbins, 1])
-
-        if params.with_mod_dynamics:
-            Inputs_NxTxi = self.I if Inputs is None else Inputs
+        # The parameters corresponding to the provided trial Ids. They are
+        # shared by all the time points of a trial, the first layer broadcasts
+        # them over time.
+        ev_params_Nxp = tf.nn.embedding_lookup(self.ev_params_Pxp, Ids)
 
         rangeB = self.params.initrange_B
         evnodes = 200
-        # Concatenate the parameters to the state at time t
+        # The output head and its initial range, chosen so that the entries of
+        # B start with the same spread in every structure.
+        structure = self.evolution_structure
+        if structure == 'dense':
+            outDim, rangeOut = xDim**2, rangeB
+        elif structure == 'lowrank':
+            r = self.evolution_rank
+            outDim, rangeOut = 2*xDim*r, (3.0/r)**0.25*np.sqrt(rangeB)
+        else:
+            b = self.evolution_block_size
+            outDim, rangeOut = xDim*b, rangeB
         
-        State_NxTxr = ( tf.concat([X_NxTxd, ev_params_NxTxp, Inputs_NxTxi], axis=2)
-                        if params.with_mod_dynamics else
-                        tf.concat([X_NxTxd, ev_params_NxTxp], axis=2) )
-        State_NTxr = tf.reshape(State_NxTxr, [Nsamps*NTbins, rDim])
+        # The state at time t, concatenated to the parameters and the inputs in
+        # the first layer, in the same [x, params, inputs] order as the rows of
+        # its weights in older checkpoints.
         fully_connected_layer = FullLayer(collections=['EVOLUTION_PARS'])
         with tf.variable_scope("ev_nn", reuse=tf.AUTO_REUSE):
-            full1 = fully_connected_layer(State_NTxr, evnodes, 'softmax', 'full1')
+            full1_NxTxe = fully_connected_layer(X_NxTxd, evnodes, 'softmax', 'full1',
+                                                trial_Input=ev_params_Nxp,
+                                                bin_Input=( Inputs_NxTxi if
+                                                            params.with_mod_dynamics else None ))
+            full1 = tf.reshape(full1_NxTxe, [Nsamps*NTbins, evnodes])
             full2 = fully_connected_layer(full1, evnodes//2, 'softplus', 'full2',
                                           initializer=tf.orthogonal_initializer())
-            output = fully_connected_layer(full2, xDim**2, nl='linear', scope='output',
-                                           initializer=tf.random_uniform_initializer(-rangeB, rangeB))
-        B_NxTxdxd = tf.reshape(output, [Nsamps, NTbins, xDim, xDim], name='B')
-        B_NTxdxd = tf.reshape(output, [Nsamps*NTbins, xDim, xDim])
-        
-        A_NTxdxd = self.alpha*B_NTxdxd + self.Alinear_dxd # Broadcast
-        A_NxTxdxd = tf.reshape(A_NTxdxd, [Nsamps, NTbins, xDim, xDim], name='A')
+            output = fully_connected_layer(full2, outDim, nl='linear', scope='output',
+                                           initializer=tf.random_uniform_initializer(-rangeOut,
+                                                                                     rangeOut))
+        if structure == 'dense':
+            A = EvolutionMatrices(self.Alinear_dxd, self.alpha,
+                                  B_NxTxdxd=tf.reshape(output, [Nsamps, NTbins, xDim, xDim]))
+        elif structure == 'lowrank':
+            UV_NxTxdx2r = tf.reshape(output, [Nsamps, NTbins, xDim, 2*r])
+            A = EvolutionMatrices(self.Alinear_dxd, self.alpha, U_NxTxdxr=UV_NxTxdx2r[...,:r],
+                                  V_NxTxdxr=UV_NxTxdx2r[...,r:])
+        else:
+            Bblocks_NxTxkxbxb = tf.reshape(output, [Nsamps, NTbins, xDim//b, b, b])
+            A = EvolutionMatrices(self.Alinear_dxd, self.alpha,
+                                  Bblocks_NxTxkxbxb=Bblocks_NxTxkxbxb)
         
-        X_norms = tf.norm(State_NTxr[:,:xDim], axis=1)
-        fl_mod = flow_modulator_tf(X_norms)
-        eye_swap = tf.transpose(tf.tile(tf.expand_dims(tf.eye(self.xDim), 0),
-                                        [Nsamps*NTbins, 1, 1]), [2,1,0])
-        Awinflow_NTxdxd = tf.transpose(fl_mod*tf.transpose(
-                                A_NTxdxd, [2,1,0]) + 0.9*(1.0-fl_mod)*eye_swap, [2,1,0])
-        Awinflow_NxTxdxd = tf.reshape(Awinflow_NTxdxd, 
-                                      [Nsamps, NTbins, xDim, xDim], name='Awinflow')
-         
-        return A_NxTxdxd, Awinflow_NxTxdxd, B_NxTxdxd
+        return A
 
-    def get_A_grads(self, xin=None, idin=None, iin=None):
+    def get_A_jacobian(self, X=None, Ids=None, with_inflow=False, Inputs=None):
+        """
+        Returns the Jacobian of the evolution matrices with respect to the
+        state at every point, dA_ij(x_t)/dx_tk as a [N x T x d x d x d] tensor.
+        
+        A(x_t) only depends on x_t, so the derivative of A along the direction
+        e_k, taken at every point at once, yields the slice dA(x_t)/dx_tk of
+        the whole batch. These are forward-mode products, obtained by
+        differentiating the vector-Jacobian product of A with respect to its
+        (dummy) cotangent. The Jacobian then takes d of these products through
+        the evolution network instead of one backward pass per entry of A.
+        """
         xDim = self.xDim
-        if xin is None: xin = self.x
+        X_NxTxd = self.X if X is None else X
+        if X is None and Ids is None and Inputs is None:
+            A_NxTxdxd = self.A_NxTxdxd if not with_inflow else self.Awinflow_NxTxdxd
+        else:
+            A_NxTxdxd = self._define_evolution_network_wi(X, Ids,
+                                                          Inputs)[1 if with_inflow else 0]
+        Nsamps = tf.shape(X_NxTxd)[0]
+        NTbins = tf.shape(X_NxTxd)[1]
+        
+        # U -> sum_t U_t:dA(x_t)/dx_t is linear in U, so its gradient with
+        # respect to U along e_k is the JVP dA/dx_k.
+        U_NxTxdxd = tf.zeros_like(A_NxTxdxd)
+        UtdA_NxTxd = tf.gradients(A_NxTxdxd, X_NxTxd, grad_ys=U_NxTxdxd)[0]
+        if UtdA_NxTxd is None:
+            return tf.zeros([Nsamps, NTbins, xDim, xDim, xDim], dtype=A_NxTxdxd.dtype)
+        Agrads_dxNxTxdxd = []
+        for k in range(xDim):
+            e_NxTxd = tf.zeros_like(X_NxTxd) + tf.one_hot(k, xDim, dtype=X_NxTxd.dtype)
+            Agrad_NxTxdxd = tf.gradients(UtdA_NxTxd, U_NxTxdxd, grad_ys=e_NxTxd)[0]
+            Agrads_dxNxTxdxd.append(tf.zeros_like(A_NxTxdxd) if Agrad_NxTxdxd is None
+                                    else Agrad_NxTxdxd)
         
-        singleA_1x1xdxd = ( self._define_evolution_network_wi(xin, idin, iin)[0]
-                            if self.params.with_mod_dynamics else
-                            self._define_evolution_network_wi(xin, idin)[0] )
-        singleA_d2 = tf.reshape(singleA_1x1xdxd, [xDim**2])
-        grad_list_d2xd = tf.squeeze(tf.stack([tf.gradients(Ai, xin) for Ai
-                                              in tf.unstack(singleA_d2)]))
+        return tf.stack(Agrads_dxNxTxdxd, axis=4)
 
-        return grad_list_d2xd 
+    def get_map_jacobian(self, X=None, Ids=None, with_inflow=False, Inputs=None):
+        """
+        Returns the Jacobian of the deterministic map f(x) = xA(x) at every
+        point, in the row convention of the evolution, J_jk = df_k/dx_j, so
+        that a perturbation evolves as dx_{t+1} = dx_t J(x_t).
+        
+        J = A(x) + sum_i x_i dA_i./dx, see `get_A_jacobian`.
+        """
+        X_NxTxd = self.X if X is None else X
+        if X is None and Ids is None and Inputs is None:
+            A_NxTxdxd = self.A_NxTxdxd if not with_inflow else self.Awinflow_NxTxdxd
+        else:
+            A_NxTxdxd = self._define_evolution_network_wi(X, Ids,
+                                                          Inputs)[1 if with_inflow else 0]
+        Agrads_NxTxdxdxd = self.get_A_jacobian(X, Ids, with_inflow=with_inflow, Inputs=Inputs)
+        
+        return A_NxTxdxd + tf.einsum('nti,ntikj->ntjk', X_NxTxd, Agrads_NxTxdxdxd)
+    
+    def fixed_points_graph(self, X0_NxMxd, Ids_N, num_steps, tol, with_inflow=False,
+                           max_step=5.0, damping=1e-6, Input_Nxi=None):
+        """
+        Adds to the graph batched Newton iterations for the fixed points x =
+        xA(x) of the evolution. Trial n holds M seeds for the entity Ids_N[n],
+        so that the evolution network sees them as the M time points of a
+        single trial and all the seeds of all the entities are iterated
+        together.
+        
+        Each step solves dx(J - I) = x - xA(x) in the damped least squares
+        sense, with the ridge damping on the normal equations, so that
+        directions along which the map is the identity do not blow up. The
+        step is clipped to a norm of max_step. The loop stops after num_steps
+        or when every residual |xA(x) - x| is below tol.
+        
+        With input dependent dynamics, the fixed points are those of the map at
+        the constant input Input_Nxi of every trial, zero if None.
+        
+        Returns:
+            X_NxMxd: The final points
+            res_NxM: The norm of the residual xA(x) - x at them
+            J_NxMxdxd: The Jacobian of the map at them, see `get_map_jacobian`
+        """
+        xDim = self.xDim
+        Id_dxd = tf.eye(xDim, dtype=self.dtype)
+        Inputs_NxMxi = None
+        if self.params.with_mod_dynamics:
+            Nsamps, Mseeds = tf.shape(X0_NxMxd)[0], tf.shape(X0_NxMxd)[1]
+            if Input_Nxi is None: Input_Nxi = tf.zeros([Nsamps, self.iDim], dtype=self.dtype)
+            Inputs_NxMxi = tf.tile(tf.expand_dims(Input_Nxi, 1), [1, Mseeds, 1])
+        def residual(X_NxMxd):
+            A = self._define_evolution_matrices(X_NxMxd, Ids_N,
+                                                Inputs_NxMxi)[1 if with_inflow else 0]
+            return A.rmatvec(X_NxMxd) - X_NxMxd
+        
+        def newton_step(i, X_NxMxd, max_res):
+            # The residual and the Jacobian share the copy of the network at X.
+            F_NxMxd = residual(X_NxMxd)
+            M_NxMxdxd = self.get_map_jacobian(X_NxMxd, Ids_N, with_inflow=with_inflow,
+                                              Inputs=Inputs_NxMxi) - Id_dxd
+            # dx M = -F  =>  (M M^T + damping*I) dx^T = -M F^T
+            MMt_NxMxdxd = tf.matmul(M_NxMxdxd, M_NxMxdxd, transpose_b=True) + damping*Id_dxd
+            MF_NxMxdx1 = tf.matmul(M_NxMxdxd, tf.expand_dims(F_NxMxd, -1))
+            dX_NxMxd = -tf.matrix_solve(MMt_NxMxdxd, MF_NxMxdx1)[...,0]
+            return [i + 1, X_NxMxd + tf.clip_by_norm(dX_NxMxd, max_step, axes=[2]),
+                    tf.reduce_max(tf.norm(F_NxMxd, axis=2))]
+        
+        # The residual that decides whether to go on is the one before the last
+        # step, which costs at most one extra step.
+        _, X_NxMxd, _ = tf.while_loop(lambda i, X_NxMxd, max_res : tf.logical_and(
+                                            i < num_steps, max_res > tol),
+                                      newton_step,
+                                      loop_vars=[tf.constant(0), X0_NxMxd,
+                                                 tf.constant(np.inf, dtype=self.dtype)])
+        res_NxM = tf.norm(residual(X_NxMxd), axis=2)
+        J_NxMxdxd = self.get_map_jacobian(X_NxMxd, Ids_N, with_inflow=with_inflow,
+                                          Inputs=Inputs_NxMxi)
+        
+        return X_NxMxd, res_NxM, J_NxMxdxd
 
-    def eval_nextX(self, session, Xdata, Xvar_name='X:0', scope="", with_inflow=False, Id=0):
+    def _sample_paths(self, x0_Nxd, Ids_N, NTbins, with_inflow=False, with_noise=True):
+        """
+        Rolls N latent paths forward together, in graph, starting at x0_Nxd. 
+        Input dependent dynamics are rolled forward with zero inputs, as in
+        `eval_nextX`.
+        """
+        xDim = self.xDim
+        Nsamps = tf.shape(x0_Nxd)[0]
+        Inputs_Nx1xi = ( tf.zeros([Nsamps, 1, self.iDim], dtype=self.dtype)
+                         if self.params.with_mod_dynamics else None )
+        
+        noise_NTm1xd = ( tf.matmul(tf.random_normal([Nsamps*(NTbins-1), xDim], dtype=self.dtype),
+                                   self.QChol_dxd) if with_noise else
+                         tf.zeros([Nsamps*(NTbins-1), xDim], dtype=self.dtype) )
+        noise_Tm1xNxd = tf.reshape(noise_NTm1xd, [NTbins-1, Nsamps, xDim])
+        def step(x_Nxd, noise_Nxd):
+            x_Nx1xd = tf.expand_dims(x_Nxd, axis=1)
+            A = self._define_evolution_matrices(x_Nx1xd, Ids_N,
+                                                Inputs_Nx1xi)[1 if with_inflow else 0]
+            return A.rmatvec(x_Nx1xd)[:,0] + noise_Nxd
+        X_Tm1xNxd = tf.scan(fn=step, elems=noise_Tm1xNxd, initializer=x0_Nxd)
+        
+        return tf.transpose(tf.concat([tf.expand_dims(x0_Nxd, 0), X_Tm1xNxd], axis=0), [1,0,2])
+    
+    def sample_X_graph(self, Nsamps, NTbins, Ids_N, X0_Nxd=None, with_inflow=False,
+                       path_mse_threshold=0.1, x0scale=15.0, max_redraws=100):
+        """
+        Adds to the graph N samples from the latent dynamics. 
+        
+        Paths whose mean step size is below path_mse_threshold (trivial paths,
+        x = const) are redrawn, only them, until none is left or max_redraws is
+        hit. If X0_Nxd is None, the starting points are drawn from the prior
+        with an extra scale x0scale, and they are redrawn as well.
+        
+        Returns:
+            X_NxTxd: The sampled paths
+        """
+        def draw_paths(idxs_n):
+            n = tf.shape(idxs_n)[0]
+            x0_nxd = ( x0scale*tf.matmul(tf.random_normal([n, self.xDim], dtype=self.dtype),
+                                         self.Q0Chol_dxd)
+                       if X0_Nxd is None else tf.gather(X0_Nxd, idxs_n) )
+            return self._sample_paths(x0_nxd, tf.gather(Ids_N, idxs_n), NTbins,
+                                      with_inflow=with_inflow)
+        path_mse = lambda X_NxTxd : tf.reduce_mean(tf.norm(X_NxTxd[:,1:] - X_NxTxd[:,:-1],
+                                                           axis=2), axis=1)
+        is_trivial = lambda X_NxTxd : path_mse(X_NxTxd) < path_mse_threshold
+        
+        def redraw(i, X_NxTxd):
+            idxs_nx1 = tf.where(is_trivial(X_NxTxd))
+            X_nxTxd = draw_paths(tf.cast(idxs_nx1[:,0], tf.int32))
+            X_NxTxd += tf.scatter_nd(idxs_nx1, X_nxTxd - tf.gather_nd(X_NxTxd, idxs_nx1),
+                                     tf.shape(X_NxTxd, out_type=tf.int64))
+            return [i + 1, X_NxTxd]
+        
+        X_NxTxd = draw_paths(tf.range(Nsamps))
+        _, X_NxTxd = tf.while_loop(lambda i, X_NxTxd : tf.logical_and(
+                                        i < max_redraws, tf.reduce_any(is_trivial(X_NxTxd))),
+                                   redraw, loop_vars=[tf.constant(0), X_NxTxd])
+        
+        return X_NxTxd
+    
+    def forecast_graph(self, X0_Nxd, Ids_N, num_steps, num_particles=1, with_inflow=False,
+                       with_noise=True):
+        """
+        Adds to the graph forecasts num_steps steps ahead from the N points
+        X0_Nxd. Each point is copied into num_particles particles that are
+        rolled forward together with independent draws of the evolution noise,
+        so that the N*M particles go through a single `_sample_paths`.
+        
+        Returns:
+            X_NxMxkxd: The particles at steps 1, ..., k
+        """
+        xDim = self.xDim
+        Nsamps = tf.shape(X0_Nxd)[0]
+        x0_NMxd = tf.reshape(tf.tile(tf.expand_dims(X0_Nxd, 1), [1, num_particles, 1]),
+                             [Nsamps*num_particles, xDim])
+        Ids_NM = tf.reshape(tf.tile(tf.expand_dims(Ids_N, 1), [1, num_particles]), [-1])
+        X_NMxkp1xd = self._sample_paths(x0_NMxd, Ids_NM, num_steps + 1, with_inflow=with_inflow,
+                                        with_noise=with_noise)
+        
+        return tf.reshape(X_NMxkp1xd[:,1:], [Nsamps, num_particles, num_steps, xDim])
+    
+    def kstep_forecast_graph(self, X_NxTxd, Ids_N, num_steps, num_particles=1,
+                             with_inflow=False, with_noise=True):
+        """
+        Adds to the graph the forecasts of X[:,t+k] from X[:,t] for every
+        t < T - k of every trial, k = num_steps. All the N*(T-k) starting points
+        are rolled forward together. See `forecast_graph`.
+        
+        Returns:
+            Xpred_NxTmkxMxd: The M particles forecast for X[:,k:]
+        """
+        xDim = self.xDim
+        Nsamps = tf.shape(X_NxTxd)[0]
+        NTmkbins = tf.shape(X_NxTxd)[1] - num_steps
+        X0_NTmkxd = tf.reshape(X_NxTxd[:,:NTmkbins], [Nsamps*NTmkbins, xDim])
+        Ids_NTmk = tf.reshape(tf.tile(tf.expand_dims(Ids_N, 1), [1, NTmkbins]), [-1])
+        Xpred_NTmkxMxd = self.forecast_graph(X0_NTmkxd, Ids_NTmk, num_steps, num_particles,
+                                             with_inflow=with_inflow,
+                                             with_noise=with_noise)[:,:,-1]
+        
+        return tf.reshape(Xpred_NTmkxMxd, [Nsamps, NTmkbins, num_particles, xDim])
+    
+    def eval_nextX(self, session, Xdata, Xvar_name='X:0', scope="", with_inflow=False, Id=0,
+                   use_A_grid=False):
         """
         Given a symbolic array of points in latent space Xdata = [X0, X1,...,XT], \
         gives the prediction for the next time point
@@ -256,9 +619,26 @@ class NoisyEvolution():
             determined.
             X_var_name : The name of the tensorflow node
             with_inflow : Should an inward flow from infinity be superimposed to A(X)?
+            Id : The entity, or an array with the entity of every trial in
+                Xdata. All the trials go through the network in one run.
+            use_A_grid : Interpolate A(X) from the table of `get_A_grid`
+                instead of running the evolution network. The trials are
+                grouped by entity, and all the trials of an entity are
+                interpolated in a single call.
         """
         Nsamps, Tbins = Xdata.shape[0], Xdata.shape[1]
         
+        if use_A_grid:
+            id_groups = IdGroups(np.broadcast_to(Id, [Nsamps]))
+            X_NxTm1xd = Xdata[:,:-1,:]
+            nextX_NxTm1xd = np.empty_like(X_NxTm1xd)
+            for Id_, X_nxTm1xd in id_groups.split(id_groups.sort(X_NxTm1xd)).items():
+                X_Mxd = X_nxTm1xd.reshape(-1, self.xDim)
+                A_Mxdxd = self.interpolate_A(session, X_Mxd, Id_, with_inflow=with_inflow)
+                nextX_NxTm1xd[id_groups.indices(Id_)] = np.einsum(
+                    'ij,ijk->ik', X_Mxd, A_Mxdxd).reshape(X_nxTm1xd.shape)
+            return nextX_NxTm1xd
+        
         Iddata = np.full(len(Xdata), Id, dtype=np.int32)
         totalA = self.A_NxTxdxd if not with_inflow else self.Awinflow_NxTxdxd
         
@@ -275,6 +655,191 @@ class NoisyEvolution():
                 
         return np.einsum('ij,ijk->ik', Xdata, A).reshape(Nsamps, Tbins-1, self.xDim)
     
+    def get_A_grid(self, session, Id=0, with_inflow=False):
+        """
+        Returns the evolution matrices A(x) tabulated on a regular grid of
+        A_grid_points per dimension over [-A_grid_range, A_grid_range]^xDim,
+        for the entity Id. The table is computed the first time it is asked
+        for and kept until `invalidate_A_grid` is called, which must be done
+        whenever the weights of the evolution network change.
+        
+        Only meant for xDim <= 3. The inputs, if any, are taken to be zero, as
+        in `eval_nextX`.
+        
+        Returns:
+            grid_G: The coordinates of the grid along each dimension
+            A_GxGx...xdxd: The table
+        """
+        if (Id, with_inflow) in self._A_grids: return self._A_grids[(Id, with_inflow)]
+        if self.xDim > 3:
+            raise ValueError("The A(x) grid is only meant for xDim <= 3")
+        
+        xDim = self.xDim
+        grid_G = np.linspace(-self.A_grid_range, self.A_grid_range, self.A_grid_points)
+        lattice_Mxd = np.stack(np.meshgrid(*[grid_G]*xDim, indexing='ij'),
+                               axis=-1).reshape(-1, xDim)
+        totalA = self.A_NxTxdxd if not with_inflow else self.Awinflow_NxTxdxd
+        
+        # The lattice goes through the network as a single trial, in chunks to
+        # bound the memory of the hidden layers.
+        chunk_size = 2**14
+        A_Mxdxd = []
+        for i in range(0, len(lattice_Mxd), chunk_size):
+            lattice_1xCxd = lattice_Mxd[np.newaxis,i:i+chunk_size]
+            feed_dict = {self.X : lattice_1xCxd, self.Ids : np.array([Id], dtype=np.int32)}
+            if self.params.with_mod_dynamics:
+                feed_dict[self.I] = np.zeros(lattice_1xCxd.shape[:2] + (self.iDim,))
+            A_Mxdxd.append(session.run(totalA, feed_dict=feed_dict)[0])
+        A_table = np.concatenate(A_Mxdxd).reshape([self.A_grid_points]*xDim + [xDim, xDim])
+        self._A_grids[(Id, with_inflow)] = grid_G, A_table
+        
+        return grid_G, A_table
+    
+    def sample_X_grid(self, session, Ids_N, NTbins, X0data=None, with_inflow=False,
+                      path_mse_threshold=0.1, x0scale=15.0, max_redraws=100):
+        """
+        Same as `sample_X_graph`, but rolled forward in numpy with A(x)
+        interpolated from the tables of `get_A_grid`, one per entity in Ids_N.
+        """
+        xDim = self.xDim
+        QChol_dxd, Q0Chol_dxd = session.run([self.QChol_dxd, self.Q0Chol_dxd])
+        def draw_paths(idxs_n):
+            n, Ids_n = len(idxs_n), Ids_N[idxs_n]
+            X_nxTxd = np.zeros([n, NTbins, xDim])
+            X_nxTxd[:,0] = ( x0scale*np.dot(np.random.randn(n, xDim), Q0Chol_dxd)
+                             if X0data is None else X0data[idxs_n] )
+            noise_nxTm1xd = np.dot(np.random.randn(n, NTbins-1, xDim), QChol_dxd)
+            A_nxdxd = np.zeros([n, xDim, xDim])
+            for t in range(NTbins-1):
+                for Id in np.unique(Ids_n):
+                    A_nxdxd[Ids_n == Id] = self.interpolate_A(session, X_nxTxd[Ids_n == Id, t],
+                                                              Id, with_inflow=with_inflow)
+                X_nxTxd[:,t+1] = ( np.einsum('ij,ijk->ik', X_nxTxd[:,t], A_nxdxd) +
+                                   noise_nxTm1xd[:,t] )
+            return X_nxTxd
+        is_trivial = lambda X_NxTxd : ( np.mean(np.linalg.norm(np.diff(X_NxTxd, axis=1), axis=2),
+                                                axis=1) < path_mse_threshold )
+        
+        X_NxTxd = draw_paths(np.arange(len(Ids_N)))
+        for _ in range(max_redraws):
+            idxs_n = np.flatnonzero(is_trivial(X_NxTxd))
+            if not len(idxs_n): break
+            X_NxTxd[idxs_n] = draw_paths(idxs_n)
+        
+        return X_NxTxd
+    
+    def invalidate_A_grid(self):
+        """
+        Drops the tables of `get_A_grid`. Call after every update of the weights.
+        """
+        self._A_grids = {}
+    
+    def interpolate_A(self, session, X_Mxd, Id=0, with_inflow=False):
+        """
+        Multilinear interpolation of A(x) at the points X_Mxd from the table of
+        `get_A_grid`. Points outside of the grid are clamped to its boundary.
+        
+        The error is O(h^2) in the spacing h = 2*A_grid_range/(A_grid_points-1)
+        for smooth A(x).
+        """
+        grid_G, A_table = self.get_A_grid(session, Id, with_inflow)
+        spacing = grid_G[1] - grid_G[0]
+        u_Mxd = np.clip((X_Mxd - grid_G[0])/spacing, 0, len(grid_G) - 1)
+        i0_Mxd = np.minimum(np.floor(u_Mxd).astype(int), len(grid_G) - 2)
+        f_Mxd = u_Mxd - i0_Mxd
+        
+        A_Mxdxd = 0.0
+        for corner in itertools.product([0, 1], repeat=self.xDim):
+            w_M = np.prod(np.where(corner, f_Mxd, 1.0 - f_Mxd), axis=1)
+            A_Mxdxd = A_Mxdxd + w_M[:,None,None]*A_table[tuple((i0_Mxd + corner).T)]
+        
+        return A_Mxdxd
+    
+    def find_fixed_points(self, session, Ids=None, num_seeds=1000, X0data=None, seed_range=30.0,
+                          num_steps=50, tol=1e-4, dedup_tol=1e-2, stability_tol=1e-3,
+                          with_inflow=False, Input=None):
+        """
+        Finds the fixed points x = xA(x) of the learned dynamics for every
+        entity in Ids (all of them by default) and classifies their linear
+        stability. See `fixed_points_graph`.
+        
+        Args:
+            session: The external tf.Session
+            Ids: The entities to analyze
+            num_seeds: The number of starting points per entity, drawn
+                uniformly from [-seed_range, seed_range]^xDim
+            X0data: Alternatively, an [M x d] array of seeds shared by all the
+                entities
+            tol: The residual |xA(x) - x| below which a seed has converged
+            dedup_tol: The distance below which two converged points are the
+                same fixed point
+            stability_tol: The tolerance around |lambda| = 1 for the
+                'marginal' class
+            Input: With input dependent dynamics, the constant [i] input at
+                which the fixed points are found. Zero by default.
+        
+        Returns:
+            A dict Id -> (X_Kxd, eigvals_Kxd, stability_K, counts_K) with the K
+            distinct fixed points, the eigenvalues of the Jacobian of the map
+            at them, their class ('stable', 'unstable', 'saddle' or
+            'marginal') and the number of seeds that converged to each.
+        """
+        xDim = self.xDim
+        Ids = np.arange(self.num_diff_entities) if Ids is None else np.asarray(Ids)
+        
+        # The finder is added to the graph the first time it is needed.
+        finder_key = with_inflow
+        if finder_key not in self._fixed_point_finders:
+            with tf.variable_scope(self.var_scope, reuse=True):
+                X0_ph = tf.placeholder(self.dtype, [None, None, xDim], name='fp_X0')
+                Ids_ph = tf.placeholder(tf.int32, [None], name='fp_Ids')
+                num_steps_ph = tf.placeholder(tf.int32, [], name='fp_num_steps')
+                tol_ph = tf.placeholder(self.dtype, [], name='fp_tol')
+                Input_ph = ( tf.placeholder(self.dtype, [None, self.iDim], name='fp_Input')
+                             if self.params.with_mod_dynamics else None )
+                outputs = self.fixed_points_graph(X0_ph, Ids_ph, num_steps_ph, tol_ph,
+                                                  with_inflow=with_inflow, Input_Nxi=Input_ph)
+            self._fixed_point_finders[finder_key] = outputs, (X0_ph, Ids_ph, num_steps_ph, tol_ph,
+                                                              Input_ph)
+        outputs, (X0_ph, Ids_ph, num_steps_ph, tol_ph,
+                  Input_ph) = self._fixed_point_finders[finder_key]
+        
+        if X0data is None:
+            X0data = np.random.uniform(-seed_range, seed_range, [len(Ids), num_seeds, xDim])
+        else:
+            X0data = np.broadcast_to(X0data, (len(Ids),) + X0data.shape)
+        feed_dict = {X0_ph : X0data, Ids_ph : Ids, num_steps_ph : num_steps, tol_ph : tol}
+        if Input_ph is not None:
+            feed_dict[Input_ph] = np.broadcast_to(np.zeros(self.iDim) if Input is None else Input,
+                                                  (len(Ids), self.iDim))
+        X_NxMxd, res_NxM, J_NxMxdxd = session.run(outputs, feed_dict=feed_dict)
+        
+        fixed_points = {}
+        for n, Id in enumerate(Ids):
+            # Deduplicate the converged seeds, best residuals first.
+            order = np.argsort(res_NxM[n])
+            order = order[res_NxM[n, order] < tol]
+            X_Mxd, J_Mxdxd = X_NxMxd[n, order], J_NxMxdxd[n, order]
+            idxs_K, counts_K = [], []
+            remaining = np.arange(len(X_Mxd))
+            while len(remaining):
+                is_same = np.linalg.norm(X_Mxd[remaining] - X_Mxd[remaining[0]],
+                                         axis=1) < dedup_tol
+                idxs_K.append(remaining[0])
+                counts_K.append(np.sum(is_same))
+                remaining = remaining[~is_same]
+            
+            eigvals_Kxd = ( np.linalg.eigvals(J_Mxdxd[idxs_K]) if idxs_K else 
+                            np.zeros([0, xDim], dtype=complex) )
+            abs_Kxd = np.abs(eigvals_Kxd)
+            stability_K = np.where(np.any(np.abs(abs_Kxd - 1.0) < stability_tol, axis=1),
+                                   'marginal', np.where(np.all(abs_Kxd < 1.0, axis=1), 'stable',
+                                   np.where(np.all(abs_Kxd > 1.0, axis=1), 'unstable', 'saddle')))
+            fixed_points[int(Id)] = (X_Mxd[idxs_K].reshape(-1, xDim), eigvals_Kxd, stability_K,
+                                np.array(counts_K, dtype=int))
+        
+        return fixed_points
+    
     @staticmethod
     def define2DLattice(x1range=(-30.0, 30.0), x2range=(-30.0, 30.0)):
         x1coords = np.linspace(x1range[0], x1range[1])
@@ -285,10 +850,11 @@ class NoisyEvolution():
     def quiver2D_flow(self, session, Xvar_name='X:0', scope="", clr='black', scale=25,
                       x1range=(-35.0, 35.0), x2range=(-35.0, 35.0), figsize=(13,13), 
                       pause=False, draw=False, with_inflow=False, newfig=True, savefile=None,
-                      Id=0):
+                      Id=0, use_A_grid=False, nextX=None):
         """
         Draws a quiver plot representing the hidden dynamics when the latent
-        space is 2D.
+        space is 2D. nextX, if given, is the flow already evaluated on the
+        lattice of x1range, x2range.
         """
         import matplotlib.pyplot as plt
         if newfig:
@@ -298,8 +864,9 @@ class NoisyEvolution():
         Tbins = lattice.shape[0]
         lattice = np.reshape(lattice, [1, Tbins, self.xDim])
         
-        nextX = self.eval_nextX(session, lattice, Xvar_name=Xvar_name, scope=scope,
-                                with_inflow=with_inflow, Id=Id)
+        if nextX is None:
+            nextX = self.eval_nextX(session, lattice, Xvar_name=Xvar_name, scope=scope,
+                                    with_inflow=with_inflow, Id=Id, use_A_grid=use_A_grid)
         nextX = nextX.reshape(Tbins-1, self.xDim)
         X = lattice[:,:-1,:].reshape(Tbins-1, self.xDim)
 
@@ -344,7 +911,8 @@ class NoisyEvolution():
     def plot_2Dquiver_paths(self, session, Xdata, Xvar_name='X:0', scope="", 
                             rlt_dir=TEST_DIR+addDateTime()+'/', 
                             rslt_file='quiver_plot', with_inflow=False, savefig=False, draw=False,
-                            pause=False, skipped=1, feed_range=True, range_xs=20.0, Id=0):
+                            pause=False, skipped=1, feed_range=True, range_xs=20.0, Id=0,
+                            use_A_grid=False):
         """
         Plots a superposition of the 2D quiver plot and the paths in latent
         space. Useful to check that the trajectories roughly follow the
@@ -365,13 +933,50 @@ class NoisyEvolution():
         
         self.quiver2D_flow(session, Xvar_name=Xvar_name, scope=scope, pause=pause, 
                            x1range=x1range, x2range=x2range, scale=s, newfig=False, 
-                           with_inflow=with_inflow, draw=draw, Id=Id)
+                           with_inflow=with_inflow, draw=draw, Id=Id, use_A_grid=use_A_grid)
         if savefig:
             plt.savefig(rslt_file)
         else:
             pass
         plt.close()
 
+    def plot_2Dquiver_paths_grouped(self, session, Xdata, id_groups, Xvar_name='X:0', scope="",
+                                    rlt_dir=TEST_DIR+addDateTime()+'/', rslt_file='quiver_plot',
+                                    with_inflow=False, savefig=False, draw=False, skipped=1,
+                                    use_A_grid=False):
+        """
+        `plot_2Dquiver_paths` for every entity of id_groups (a `utils.IdGroups`
+        for the trials of Xdata), saved to rslt_file + '_' + str(Id). The flows
+        of all the entities are evaluated together, in a single run of the
+        evolution network, each on the lattice spanned by its own paths.
+        """
+        if savefig:
+            if not os.path.exists(rlt_dir): os.makedirs(rlt_dir)
+            rslt_file = rlt_dir + rslt_file
+        
+        import matplotlib.pyplot as plt
+        ids_E = id_groups.ids_E
+        Xdata_E = [Xdata[id_groups.indices(Id)] for Id in ids_E]
+        # The data limits plus matplotlib's default 5% margins
+        ranges_E = []
+        for X_NxTxd in Xdata_E:
+            mins, maxs = np.min(X_NxTxd, axis=(0,1)), np.max(X_NxTxd, axis=(0,1))
+            margins = 0.05*(maxs - mins)
+            ranges_E.append([(mins[i] - margins[i], maxs[i] + margins[i]) for i in range(2)])
+        lattice_ExMxd = np.stack([self.define2DLattice(*ranges) for ranges in ranges_E])
+        nextX_ExMm1xd = self.eval_nextX(session, lattice_ExMxd, Xvar_name=Xvar_name, scope=scope,
+                                        with_inflow=with_inflow, Id=ids_E, use_A_grid=use_A_grid)
+        
+        for Id, X_NxTxd, (x1range, x2range), nextX in zip(ids_E, Xdata_E, ranges_E,
+                                                           nextX_ExMm1xd):
+            self.plot2D_sampleX(X_NxTxd, pause=False, draw=draw, newfig=True, skipped=skipped)
+            s = int(5*max(abs(x1range[0]) + abs(x1range[1]), abs(x2range[0]) + abs(x2range[1]))/3)
+            self.quiver2D_flow(session, x1range=x1range, x2range=x2range, scale=s, newfig=False,
+                               draw=draw, nextX=nextX)
+            if savefig:
+                plt.savefig(rslt_file + '_' + str(Id))
+            plt.close()
+
 
 class LocallyLinearEvolution(NoisyEvolution):
     """
@@ -412,16 +1017,20 @@ class LocallyLinearEvolution(NoisyEvolution):
         NTbins = tf.shape(IInput_NxTxi)[1]
         Ids = self.Ids
         
-        self.input_params_p = tf.get_variable('input_params', shape=[self.num_diff_entities],)
+        self.input_params_p = self._define_entity_table('input_params', [self.num_diff_entities])
         tf.add_to_collection('INPUT', self.input_params_p)
-        input_params_N = tf.gather(self.input_params_p, indices=Ids)
+        input_params_N = tf.nn.embedding_lookup(self.input_params_p, Ids)
         
         IInput_NTxi = tf.reshape(IInput_NxTxi, [Nsamps*NTbins, iDim])
         fully_connected_layer = FullLayer(collections=['INPUT'])
-        with tf.variable_scope("input_nn", reuse=tf.AUTO_REUSE):
-            full1 = fully_connected_layer(IInput_NTxi, 128, 'relu', 'full1')
-            full = fully_connected_layer(full1, xDim, 'linear', 'full',
-                                         initializer=tf.random_normal_initializer(stddev=0.1))
+        def input_nn(IInput_Mxi):
+            with tf.variable_scope("input_nn", reuse=tf.AUTO_REUSE):
+                full1 = fully_connected_layer(IInput_Mxi, 128, 'relu', 'full1')
+                return fully_connected_layer(full1, xDim, 'linear', 'full',
+                                             initializer=tf.random_normal_initializer(stddev=0.1))
+        # Most bins usually have no input. The network only runs on the
+        # nonzero ones and f(0) is shared by the rest.
+        full = apply_to_nonzero_rows(input_nn, IInput_NTxi)
 
         # put sample dimension last to broadcast
         Iterm_dxTxN = tf.transpose(tf.reshape(full, [Nsamps, NTbins, xDim]), [2,1,0])
@@ -441,30 +1050,28 @@ class LocallyLinearEvolution(NoisyEvolution):
         xDim = self.xDim
         X_NxTxd = self.X if X is None else X
         if X is None:
-            A_NxTxdxd = self.A_NxTxdxd if not with_inflow else self.Awinflow_NxTxdxd
+            A = self.A_evol if not with_inflow else self.Awinflow_evol
         else:
 #             A_NxTxdxd, Awinflow_NxTxdxd, _ = self._define_evolution_network(X_NxTxd)
-            A_NxTxdxd, Awinflow_NxTxdxd, _ = self._define_evolution_network_wi(X_NxTxd)
-            A_NxTxdxd = A_NxTxdxd if not with_inflow else Awinflow_NxTxdxd
+            A, Awinflow = self._define_evolution_matrices(X_NxTxd)
+            A = A if not with_inflow else Awinflow
         Nsamps = tf.shape(X_NxTxd)[0]
         NTbins = tf.shape(X_NxTxd)[1]
         
-        Xprime_NxTm1xd = tf.squeeze(tf.matmul(tf.expand_dims(X_NxTxd[:,:-1], axis=2),
-                                              A_NxTxdxd[:,:-1]))
-        resX_NxTm1x1xd = tf.expand_dims(X_NxTxd[:,1:] - Xprime_NxTm1xd, axis=2)
+        Xprime_NxTm1xd = A.rmatvec(X_NxTxd)[:,:-1]
+        resX_NxTm1xd = X_NxTxd[:,1:] - Xprime_NxTm1xd
         resX0_Nxd = X_NxTxd[:,0] - self.x0
         if self.params.with_inputs and self.params.with_Iterm:
-            Iterm_NxTx1xd = tf.expand_dims(self.Iterm_NxTxd, axis=2)
-            resX_NxTm1x1xd = resX_NxTm1x1xd - Iterm_NxTx1xd[:,:-1]
-            
-        QInv_NxTm1xdxd = tf.tile(tf.reshape(self.QInv_dxd, [1, 1, xDim, xDim]),
-                                 [Nsamps, NTbins-1, 1, 1])
+            resX_NxTm1xd = resX_NxTm1xd - self.Iterm_NxTxd[:,:-1]
+        # Contract all the residuals against the single QInv
+        resX_NTm1xd = tf.reshape(resX_NxTm1xd, [Nsamps*(NTbins-1), xDim])
 
-        LX1 = -0.5*tf.reduce_sum(resX0_Nxd*tf.matmul(resX0_Nxd, self.Q0Inv_dxd), name='LX0')
-        LX2 = -0.5*tf.reduce_sum(resX_NxTm1x1xd*tf.matmul(resX_NxTm1x1xd, QInv_NxTm1xdxd), name='L2')
-        LX3 = 0.5*tf.log(tf.matrix_determinant(self.Q0Inv_dxd))*tf.cast(Nsamps, DTYPE)
-        LX4 = 0.5*tf.log(tf.matrix_determinant(self.QInv_dxd))*tf.cast(Nsamps*(NTbins-1), DTYPE)
-        LX5 = -0.5*np.log(2*np.pi)*tf.cast(Nsamps*NTbins*xDim, DTYPE)
+        LX1 = -0.5*tf.reduce_sum(resX0_Nxd*self.rmul_QInv(resX0_Nxd, initial=True), name='LX0')
+        LX2 = -0.5*tf.reduce_sum(resX_NTm1xd*self.rmul_QInv(resX_NTm1xd), name='L2')
+        # 0.5*log|QInv| is the sum of the log-diagonal of QInvChol
+        LX3 = tf.reduce_sum(self.Q0InvChol_logdiag_d)*tf.cast(Nsamps, self.dtype)
+        LX4 = tf.reduce_sum(self.QInvChol_logdiag_d)*tf.cast(Nsamps*(NTbins-1), self.dtype)
+        LX5 = -0.5*np.log(2*np.pi)*tf.cast(Nsamps*NTbins*xDim, self.dtype)
         
         LatentDensity = LX1 + LX2 + LX3 + LX4 + LX5
         
@@ -475,9 +1082,15 @@ class LocallyLinearEvolution(NoisyEvolution):
     #** graph. They should only be used standalone.
 
     def sample_X(self, sess, Xvar_name, Nsamps=2, NTbins=3, X0data=None, with_inflow=False,
-                 path_mse_threshold=0.1, draw_plots=False, init_variables=True, num_ids=1):
+                 path_mse_threshold=0.1, draw_plots=False, init_variables=True, num_ids=1,
+                 use_A_grid=False):
         """
-        Runs forward the stochastic model for the latent space.
+        Runs forward the stochastic model for the latent space. All the paths
+        are sampled together, in graph, with a single call to sess.run. See
+        `sample_X_graph`.
+        
+        If use_A_grid, the paths are instead rolled forward in numpy with A(x)
+        interpolated from the table of `get_A_grid`. See `sample_X_grid`.
          
         Returns a numpy array of samples
         """
@@ -485,45 +1098,38 @@ class LocallyLinearEvolution(NoisyEvolution):
         if init_variables: 
             sess.run(tf.global_variables_initializer())
         
-        xDim = self.xDim
-        Q0Chol = sess.run(self.Q0Chol_dxd)
-        QChol = sess.run(self.QChol_dxd)
-        Nsamps = X0data.shape[0] if X0data is not None else Nsamps
-        Xdata_NxTxd = np.zeros([Nsamps, NTbins, self.xDim])
-        x0scale = 15.0
+        if use_A_grid:
+            Nsamps = X0data.shape[0] if X0data is not None else Nsamps
+            Xdata_NxTxd = self.sample_X_grid(sess, np.random.randint(num_ids, size=Nsamps),
+                                             NTbins, X0data=X0data, with_inflow=with_inflow,
+                                             path_mse_threshold=path_mse_threshold)
+            if draw_plots:
+                self.plot_2Dquiver_paths(sess, Xdata_NxTxd, Xvar_name, with_inflow=with_inflow,
+                                         use_A_grid=True)
+            return Xdata_NxTxd
         
-        A_NxTxdxd = self.Awinflow_NxTxdxd if with_inflow else self.A_NxTxdxd
-        A_NTxdxd = tf.reshape(A_NxTxdxd, shape=[-1, xDim, xDim])
-        for samp in range(Nsamps):
-            samp_norm = 0.0 # needed to avoid paths that start too close to an attractor
-            
-            # lower path_mse_threshold to keep paths closer to trivial
-            # trajectories, x = const.
-            this_id = random.randint(1, num_ids)
-            while samp_norm < path_mse_threshold:
-                X_single_samp_1xTxd = np.zeros([1, NTbins, self.xDim])
-                x0 = ( x0scale*np.dot(np.random.randn(self.xDim), Q0Chol) if 
-                       X0data is None else X0data[samp] )
-                X_single_samp_1xTxd[0,0] = x0
-                
-                noise_samps = np.random.randn(NTbins, self.xDim)
-                for curr_tbin in range(NTbins-1):
-                    curr_X_1x1xd = X_single_samp_1xTxd[:,curr_tbin:curr_tbin+1,:]
-                    A_1xdxd = sess.run(A_NTxdxd, feed_dict={Xvar_name : curr_X_1x1xd,
-                                                            'Ids:0' : np.array([this_id])})
-                    A_dxd = np.squeeze(A_1xdxd, axis=0)
-                    X_single_samp_1xTxd[0,curr_tbin+1,:] = ( 
-                        np.dot(X_single_samp_1xTxd[0,curr_tbin,:], A_dxd) + 
-                        np.dot(noise_samps[curr_tbin+1], QChol) )
-            
-                # Compute MSE and discard path is MSE < path_mse_threshold
-                # (trivial paths)
-                Xsamp_mse = np.mean([np.linalg.norm(X_single_samp_1xTxd[0,tbin+1] - 
-                                    X_single_samp_1xTxd[0,tbin]) for tbin in 
-                                                    range(NTbins-1)])
-                samp_norm = Xsamp_mse
-        
-            Xdata_NxTxd[samp,:,:] = X_single_samp_1xTxd
+        # The sampler is added to the graph the first time it is needed.
+        sampler_key = (with_inflow, X0data is None)
+        if sampler_key not in self._samplers:
+            with tf.variable_scope(self.var_scope, reuse=True):
+                Nsamps_ph = tf.placeholder(tf.int32, [], name='sample_Nsamps')
+                NTbins_ph = tf.placeholder(tf.int32, [], name='sample_NTbins')
+                Ids_ph = tf.placeholder(tf.int32, [None], name='sample_Ids')
+                X0_ph = ( None if X0data is None else 
+                          tf.placeholder(self.dtype, [None, self.xDim], name='sample_X0') )
+                threshold_ph = tf.placeholder(self.dtype, [], name='sample_threshold')
+                X_NxTxd = self.sample_X_graph(Nsamps_ph, NTbins_ph, Ids_ph, X0_ph,
+                                              with_inflow=with_inflow,
+                                              path_mse_threshold=threshold_ph)
+            self._samplers[sampler_key] = (X_NxTxd, Nsamps_ph, NTbins_ph, Ids_ph, X0_ph,
+                                           threshold_ph)
+        X_NxTxd, Nsamps_ph, NTbins_ph, Ids_ph, X0_ph, threshold_ph = self._samplers[sampler_key]
+        
+        Nsamps = X0data.shape[0] if X0data is not None else Nsamps
+        feed_dict = {Nsamps_ph : Nsamps, NTbins_ph : NTbins, threshold_ph : path_mse_threshold,
+                     Ids_ph : np.random.randint(num_ids, size=Nsamps)}
+        if X0data is not None: feed_dict[X0_ph] = X0data
+        Xdata_NxTxd = sess.run(X_NxTxd, feed_dict=feed_dict)
         
         if draw_plots:
             self.plot_2Dquiver_paths(sess, Xdata_NxTxd, Xvar_name, with_inflow=with_inflow)
@@ -14,19 +14,20 @@
 #
 # ==============================================================================
 import numpy as np
+from scipy.special import gammaln
 
 import tensorflow as tf
 
 # The lines below were first seen in the walls of Alcatraz.
 if __name__ == 'ObservationModels':
     from layers import FullLayer  # @UnresolvedImport @UnusedImport
+    from utils import get_dtypes, lower_chol_variable  # @UnresolvedImport @UnusedImport
 else:
     from .layers import FullLayer  # @Reimport
+    from .utils import get_dtypes, lower_chol_variable  # @Reimport
 
 TEST_DIR = './tests/test_results/'
 
-DTYPE = tf.float32
-
 class ObsModel():
     """
     Abstract class for the observation models. The important methods are:
@@ -43,6 +44,7 @@ class ObsModel():
         """
         self.X = X
         self.params = params
+        self.dtype, self.fact_dtype = get_dtypes(params)
 
         self.yDim = params.yDim
         self.xDim = params.xDim
@@ -52,6 +54,11 @@ class ObsModel():
         self.Nsamps = tf.shape(self.X)[0]
         self.NTbins = tf.shape(self.X)[1]
         
+        # The variable scope of the observation network, needed to add the
+        # forecasters to the graph later on.
+        self.var_scope = tf.get_variable_scope()
+        self._forecasters = {}
+        
     def compute_LogDensity(self):
         """
         """
@@ -64,6 +71,119 @@ class ObsModel():
         raise NotImplementedError("This is an abstract method. Please define it in "
                                   "the children classes")
 
+    def _define_output_mean(self, X_NxTxd):
+        """
+        Returns the mean of the observations at X_NxTxd.
+        """
+        raise NotImplementedError("This is an abstract method. Please define it in "
+                                  "the children classes")
+
+    def _forecast_nll(self, sess, Ydata_NxTxD, Ymean_NxTxD):
+        """
+        Returns the negative loglikelihood of each observation vector under
+        the predicted mean.
+        """
+        raise NotImplementedError("This is an abstract method. Please define it in "
+                                  "the children classes")
+
+    def _get_forecaster(self, kind, with_inflow, with_noise):
+        """
+        Adds to the graph the latent forecasts of `NoisyEvolution.forecast_graph`
+        ('forecast') or `NoisyEvolution.kstep_forecast_graph` ('kstep'), and the
+        observation means at them, the first time they are needed.
+        """
+        key = (kind, with_inflow, with_noise)
+        if key in self._forecasters: return self._forecasters[key]
+        
+        latm = self.lat_ev_model
+        xDim, yDim = self.xDim, self.yDim
+        with tf.variable_scope(self.var_scope, reuse=True):
+            X_ph = tf.placeholder(self.dtype, [None, xDim] if kind == 'forecast' else
+                                  [None, None, xDim], name=kind+'_X')
+            Ids_ph = tf.placeholder(tf.int32, [None], name=kind+'_Ids')
+            num_steps_ph = tf.placeholder(tf.int32, [], name=kind+'_num_steps')
+            num_particles_ph = tf.placeholder(tf.int32, [], name=kind+'_num_particles')
+            forecast_graph = ( latm.forecast_graph if kind == 'forecast' else
+                               latm.kstep_forecast_graph )
+            Xpred = forecast_graph(X_ph, Ids_ph, num_steps_ph, num_particles_ph,
+                                   with_inflow=with_inflow, with_noise=with_noise)
+            # Xpred is either N x M x k x d or N x (T-k) x M x d. The
+            # observation network sees the last three axes as time.
+            Xpred_shape = tf.shape(Xpred)
+            Xpred_NxPxd = tf.reshape(Xpred, [Xpred_shape[0], -1, xDim])
+            Ymean = tf.reshape(self._define_output_mean(Xpred_NxPxd),
+                               tf.concat([Xpred_shape[:-1], [yDim]], axis=0))
+        self._forecasters[key] = ( (Xpred, Ymean),
+                                   (X_ph, Ids_ph, num_steps_ph, num_particles_ph) )
+        
+        return self._forecasters[key]
+
+    #** These methods take a session as input and are not part of the main
+    #** graph. They are meant to be used as standalone.
+    
+    def forecast(self, sess, X0data, Ids=None, num_steps=10, num_particles=100,
+                 with_inflow=False, with_noise=True, with_Y=True):
+        """
+        Forecasts num_steps steps ahead from the N points X0data (e.g.
+        postX_NxTxd[:,-1]) with num_particles draws of the evolution noise per
+        point, all of them rolled forward in a single call to sess.run.
+        
+        Returns:
+            Xpred_NxMxkxd: The latent particles at steps 1, ..., k
+            Ypred_NxMxkxD: The observation means (rates for Poisson) at them,
+                if with_Y
+        """
+        Ids = np.zeros(len(X0data), dtype=np.int32) if Ids is None else Ids
+        (Xpred, Ymean), (X_ph, Ids_ph, num_steps_ph, num_particles_ph) = self._get_forecaster(
+            'forecast', with_inflow, with_noise)
+        feed_dict = {X_ph : X0data, Ids_ph : Ids, num_steps_ph : num_steps,
+                     num_particles_ph : num_particles}
+        if not with_Y: return sess.run(Xpred, feed_dict=feed_dict)
+        
+        return tuple(sess.run([Xpred, Ymean], feed_dict=feed_dict))
+    
+    def kstep_forecast_error(self, sess, postX_NxTxd, Ydata_NxTxD=None, Ids=None, num_steps=1,
+                             num_particles=100, with_inflow=False, with_noise=True):
+        """
+        Computes the error of the num_steps ahead forecasts of every time point
+        t >= k from the posterior at t - k, for model selection. The forecast
+        is the mean over num_particles particles.
+        
+        Returns:
+            A dict with
+            X_mse_Tmk: The squared distance between the latent forecasts and
+                postX[:,t], averaged over trials, for every t >= k
+            X_mse: Its average over t
+            and if Ydata_NxTxD is provided, Y_mse_Tmk, Y_mse for the observation
+            means and Y_nll_Tmk, Y_nll for the negative loglikelihood of the
+            data under them.
+        """
+        Ids = np.zeros(len(postX_NxTxd), dtype=np.int32) if Ids is None else Ids
+        (Xpred, Ymean), (X_ph, Ids_ph, num_steps_ph, num_particles_ph) = self._get_forecaster(
+            'kstep', with_inflow, with_noise)
+        feed_dict = {X_ph : postX_NxTxd, Ids_ph : Ids, num_steps_ph : num_steps,
+                     num_particles_ph : num_particles}
+        k = num_steps
+        
+        errors = {}
+        if Ydata_NxTxD is None:
+            Xpred_NxTmkxMxd = sess.run(Xpred, feed_dict=feed_dict)
+        else:
+            Xpred_NxTmkxMxd, Ypred_NxTmkxMxD = sess.run([Xpred, Ymean], feed_dict=feed_dict)
+            Ymean_NxTmkxD = np.mean(Ypred_NxTmkxMxD, axis=2)
+            errors['Y_mse_Tmk'] = np.mean(np.sum((Ymean_NxTmkxD - Ydata_NxTxD[:,k:])**2,
+                                                 axis=2), axis=0)
+            errors['Y_nll_Tmk'] = np.mean(self._forecast_nll(sess, Ydata_NxTxD[:,k:],
+                                                             Ymean_NxTmkxD), axis=0)
+            errors['Y_mse'], errors['Y_nll'] = ( np.mean(errors['Y_mse_Tmk']),
+                                                 np.mean(errors['Y_nll_Tmk']) )
+        Xmean_NxTmkxd = np.mean(Xpred_NxTmkxMxd, axis=2)
+        errors['X_mse_Tmk'] = np.mean(np.sum((Xmean_NxTmkxd - postX_NxTxd[:,k:])**2, axis=2),
+                                      axis=0)
+        errors['X_mse'] = np.mean(errors['X_mse_Tmk'])
+        
+        return errors
+
 
 class PoissonObs(ObsModel):
     """
@@ -118,9 +238,30 @@ class PoissonObs(ObsModel):
                     full3 = fully_connected_layer(full2, yDim, 'linear', scope='output')
     #                            initializer=tf.random_uniform_initializer(-rangeY, rangeY))
                     rate_NTxD = tf.exp(inv_tau*full3)
-            self.rate_NxTxD = tf.reshape(rate_NTxD, [Nsamps, NTbins, yDim], name='outY') 
+            rate_NxTxD = tf.reshape(rate_NTxD, [Nsamps, NTbins, yDim], name='outY') 
+            if not hasattr(self, 'rate_NxTxD'): self.rate_NxTxD = rate_NxTxD
             
         return rate_NTxD
+    
+    def _define_output_mean(self, X_NxTxd):
+        """
+        Returns the [N x T x D] Poisson rates at X_NxTxd, the mean of the
+        observations. See `_define_rate`.
+        """
+        return tf.reshape(self._define_rate(X_NxTxd),
+                          [tf.shape(X_NxTxd)[0], tf.shape(X_NxTxd)[1], self.yDim])
+    
+    def _forecast_nll(self, sess, Ydata_NxTxD, Ymean_NxTxD):
+        """
+        Returns the [N x T] Poisson negative loglikelihood of each observation
+        vector with the rates Ymean_NxTxD,
+        
+            sum_i rate_i - y_i*log(rate_i) + log(y_i!)
+        
+        The session is not used.
+        """
+        return np.sum(Ymean_NxTxD - Ydata_NxTxD*np.log(Ymean_NxTxD) + gammaln(Ydata_NxTxD + 1.0),
+                      axis=-1)
         
     def compute_LogDensity(self, Input=None, with_inflow=False):
         """
@@ -180,7 +321,7 @@ class PoissonObs(ObsModel):
         return Ydata_NxTxD, Xdata_NxTxd
     
     
-class GaussianObs():
+class GaussianObs(ObsModel):
     """
     """
     def __init__(self, Y, X, params, lat_ev_model):
@@ -204,7 +345,8 @@ class GaussianObs():
 
         Input = tf.reshape(Input, [Nsamps*NTbins, xDim], name='X_input')
         
-        rangeY = tf.get_variable('rangeY', initializer=params.initrange_Goutmean)
+        rangeY = tf.get_variable('rangeY', dtype=self.dtype,
+                                 initializer=tf.constant(params.initrange_Goutmean, self.dtype))
         initSigma = params.initrange_Goutvar
         init_b = params.initbias_Goutmean
         obs_nodes = 64
@@ -222,14 +364,36 @@ class GaussianObs():
                                                 b_initializer=tf.random_normal_initializer(init_b) )
             MuY_NxTxD = tf.reshape(MuY_NTxD, [Nsamps, NTbins, yDim], name='outY')
         with tf.variable_scope("obs_var", reuse=tf.AUTO_REUSE):
-            SigmaInvChol_DxD = tf.get_variable('SigmaInvChol', 
-                                                initializer=tf.cast(initSigma*tf.eye(yDim), DTYPE))
-            self.SigmaChol_1x1xDxD = tf.reshape(tf.matrix_inverse(SigmaInvChol_DxD),
-                                                [1, 1, yDim, yDim]) # Needed only for sampling
-            SigmaInv_DxD = tf.matmul(SigmaInvChol_DxD, SigmaInvChol_DxD,
-                                        transpose_b=True)
+            # Lower triangular with a log-parameterized diagonal, see
+            # utils.lower_chol_variable
+            self.SigmaInvChol_DxD, self.SigmaInvChol_logdiag_D = lower_chol_variable(
+                'SigmaInvChol', yDim, initSigma, dtype=self.dtype)
+            SigmaInv_DxD = tf.matmul(self.SigmaInvChol_DxD, self.SigmaInvChol_DxD,
+                                     transpose_b=True)
             
         return MuY_NxTxD, SigmaInv_DxD 
+    
+    def _define_output_mean(self, X_NxTxd):
+        """
+        Returns the [N x T x D] mean MuY of the Gaussian observations at
+        X_NxTxd. See `_define_mean_variance`.
+        """
+        return self._define_mean_variance(X_NxTxd)[0]
+    
+    def _forecast_nll(self, sess, Ydata_NxTxD, Ymean_NxTxD):
+        """
+        Returns the [N x T] Gaussian negative loglikelihood of each observation
+        vector with mean Ymean_NxTxD and the learned precision SigmaInvY,
+        
+            0.5*dy^T*SigmaInvY*dy - 0.5*log|SigmaInvY| + 0.5*D*log(2*pi)
+        
+        with dy = y - Ymean. SigmaInvY and its log-determinant, 2 times the
+        sum of the log-diagonal of its Cholesky factor, are read with sess.
+        """
+        SigmaInvY_DxD, logdiag_D = sess.run([self.SigmaInvY_DxD, self.SigmaInvChol_logdiag_D])
+        DeltaY_NxTxD = Ydata_NxTxD - Ymean_NxTxD
+        return ( 0.5*np.sum(DeltaY_NxTxD*np.dot(DeltaY_NxTxD, SigmaInvY_DxD), axis=-1) -
+                 np.sum(logdiag_D) + 0.5*self.yDim*np.log(2*np.pi) )
         
     def compute_LogDensity(self, X=None, with_inflow=False):
         """
@@ -246,14 +410,15 @@ class GaussianObs():
             MuY_NxTxD, SigmaInvY_DxD = self._define_mean_variance(X_NxTxd)
         yDim = self.yDim
         
-        SigmaInvY_NTxDxD = tf.tile(tf.expand_dims(SigmaInvY_DxD, axis=0), [Nsamps*NTbins, 1, 1])
-        MuY_NTx1xD = tf.reshape(MuY_NxTxD, [Nsamps*NTbins, 1, yDim])
-        Y_NTx1xD = tf.reshape(self.Y, [Nsamps*NTbins, 1, yDim])
+        MuY_NTxD = tf.reshape(MuY_NxTxD, [Nsamps*NTbins, yDim])
+        Y_NTxD = tf.reshape(self.Y, [Nsamps*NTbins, yDim])
         
-        DeltaY_NTx1xD = Y_NTx1xD - MuY_NTx1xD
+        DeltaY_NTxD = Y_NTxD - MuY_NTxD
         
-        LY1 = -0.5*tf.reduce_sum(DeltaY_NTx1xD*tf.matmul(DeltaY_NTx1xD, SigmaInvY_NTxDxD))
-        LY2 = 0.5*tf.reduce_sum(tf.log(tf.matrix_determinant(SigmaInvY_DxD)))*tf.cast(Nsamps*NTbins, DTYPE)
+        # Contract all the residuals against the single SigmaInv
+        LY1 = -0.5*tf.reduce_sum(DeltaY_NTxD*tf.matmul(DeltaY_NTxD, SigmaInvY_DxD))
+        LY2 = ( tf.reduce_sum(self.SigmaInvChol_logdiag_D)*
+                tf.cast(Nsamps*NTbins, self.dtype) )
         LY = tf.add(LY1, LY2, name='LY')
         
         checks = [LY, LX, LY1, LY2]
@@ -280,10 +445,12 @@ class GaussianObs():
                                            init_variables=init_variables)
         
         MuY_NxTxD = self.MuY_NxTxD
-        SigmaChol_NxTxDxD = tf.tile(self.SigmaChol_1x1xDxD, [Nsamps, NTbins, 1, 1])
-        noise_NxTx1xD = tf.random_normal([Nsamps, NTbins, 1, yDim])
+        noise_NTxD = tf.random_normal([Nsamps*NTbins, yDim], dtype=self.dtype)
         
-        sampleY_NxTxD = MuY_NxTxD + tf.reshape(tf.matmul(noise_NxTx1xD, SigmaChol_NxTxDxD),
+        # noise*SigmaInvChol^{-1}, from a triangular solve with SigmaInvChol^T
+        noise_DxNT = tf.matrix_triangular_solve(self.SigmaInvChol_DxD,
+                                                tf.transpose(noise_NTxD), adjoint=True)
+        sampleY_NxTxD = MuY_NxTxD + tf.reshape(tf.transpose(noise_DxNT),
                                                [Nsamps, NTbins, yDim])
         Ydata_NxTxD = sess.run(sampleY_NxTxD, feed_dict={Xvar_name : Xdata_NxTxd})
         
@@ -19,11 +19,10 @@ import tensorflow as tf
 from .ObservationModels import PoissonObs, GaussianObs
 from .RecognitionModels import SmoothingNLDSTimeSeries
 from .datetools import addDateTime
+from .utils import get_dtypes, IdGroups
 
 import time
 
-DTYPE = tf.float32
-
 def data_iterator_simple(Ydata, Xdata, Ids, Inputs=None, batch_size=1, shuffle=True):
     """
     """
@@ -49,6 +48,7 @@ class Optimizer_TS():
         """
         """        
         self.params = params
+        self.dtype, _ = get_dtypes(params)
 
         gen_mod_classes = {'Poisson' : PoissonObs, 'Gaussian' : GaussianObs}
         rec_mod_classes = {'SmoothLl' : SmoothingNLDSTimeSeries}
@@ -60,10 +60,10 @@ class Optimizer_TS():
         self.yDim = yDim = params.yDim
         
         with tf.variable_scope('VAEC', reuse=tf.AUTO_REUSE):
-            self.learning_rate = lr = tf.get_variable('lr', dtype=DTYPE,
+            self.learning_rate = lr = tf.get_variable('lr', dtype=self.dtype,
                                                       initializer=params.learning_rate)
-            self.Y = Y = tf.placeholder(DTYPE, [None, None, yDim], name='Y')
-            self.X = X = tf.placeholder(DTYPE, [None, None, xDim], name='X')
+            self.Y = Y = tf.placeholder(self.dtype, [None, None, yDim], name='Y')
+            self.X = X = tf.placeholder(self.dtype, [None, None, xDim], name='X')
             self.mrec = RecModel(Y, X, params)
 #             
             self.lat_ev_model = lat_ev_model = self.mrec.lat_ev_model
@@ -85,6 +85,11 @@ class Optimizer_TS():
             
         # The optimizer ops
         opt = tf.train.AdamOptimizer(lr, beta1=0.9, beta2=0.999, epsilon=1e-8)
+        # Lazy updates of the per-entity tables, see _apply_gradients
+        self.lazy_entity_updates = ( params.lazy_entity_updates if
+                                     hasattr(params, 'lazy_entity_updates') else False )
+        entity_opt = ( tf.contrib.opt.LazyAdamOptimizer(lr, beta1=0.9, beta2=0.999, epsilon=1e-8)
+                       if self.lazy_entity_updates else None )
         self.train_step = tf.get_variable("global_step", [], tf.int64,
                                           tf.zeros_initializer(),
                                           trainable=False)
@@ -93,10 +98,8 @@ class Optimizer_TS():
                                                                  self.train_vars)
         self.gradsvars = gradsvars = opt.compute_gradients(self.cost, self.train_vars)
 
-        self.train_op_ng = opt.apply_gradients(gradsvars_ng, global_step=self.train_step,
-                                               name='train_op')
-        self.train_op = opt.apply_gradients(gradsvars, global_step=self.train_step,
-                                            name='train1_op')
+        self.train_op_ng = self._apply_gradients(opt, entity_opt, gradsvars_ng, name='train_op')
+        self.train_op = self._apply_gradients(opt, entity_opt, gradsvars, name='train1_op')
         
 #         if params.with_inputs:
 #             self.input_varsgrads_ng = opt.compute_gradients(self.cost_ng, 
@@ -106,6 +109,24 @@ class Optimizer_TS():
 
         self.saver = tf.train.Saver(tf.global_variables())
 
+    def _apply_gradients(self, opt, entity_opt, gradsvars, name):
+        """
+        Applies the gradients with opt. With lazy_entity_updates, the
+        per-entity tables (the 'ENTITY' collection) are instead updated by
+        entity_opt, a LazyAdamOptimizer that touches the Adam moments of the
+        rows gathered in the batch only. The cost per step is then independent
+        of the number of entities.
+        """
+        entity_vars = tf.get_collection('ENTITY')
+        is_entity = lambda var : any(var is entity_var for entity_var in entity_vars)
+        entity_gradsvars = [(g, v) for g, v in gradsvars if is_entity(v) and g is not None]
+        if not self.lazy_entity_updates or not entity_gradsvars:
+            return opt.apply_gradients(gradsvars, global_step=self.train_step, name=name)
+        
+        other_gradsvars = [(g, v) for g, v in gradsvars if not is_entity(v)]
+        return tf.group(opt.apply_gradients(other_gradsvars, global_step=self.train_step),
+                        entity_opt.apply_gradients(entity_gradsvars), name=name)
+    
     def cost_ELBO(self, with_inflow=False, use_grads=False):
         """
         The negative ELBO cost ought to be minimized.
@@ -142,6 +163,8 @@ class Optimizer_TS():
             Idtrain = np.zeros(shape=[Nsamps], dtype=np.int32)
             Idvalid = np.zeros(shape=[Nsamps_valid], dtype=np.int32)
         fd_train['VAEC/Ids:0'], fd_valid['VAEC/Ids:0'] = Idtrain, Idvalid
+        # The training trials grouped by entity, for the per-entity plots
+        self.id_groups = IdGroups(Idtrain)
         
         # If the data has input information, add first only the data with
         # trivial inputs
@@ -187,6 +210,7 @@ class Optimizer_TS():
                 fd_train, fd_valid = {'VAEC/Y:0' : Ytrain_NxTxD}, {'VAEC/Y:0' : Yvalid_VxTxD}
                 fd_train['VAEC/X:0'], fd_valid['VAEC/X:0'] = Xpassed_NxTxd, Xvalid_VxTxd
                 fd_train['VAEC/Ids:0'], fd_valid['VAEC/Ids:0'] = Idtrain, Idvalid
+                self.id_groups = IdGroups(Idtrain)
                 
                 if params.with_inputs:
                     Input_train = np.concatenate([Input_train, datadict['Itrain']])
@@ -241,6 +265,8 @@ class Optimizer_TS():
                     sess.run([train_op], feed_dict=fd_batch)
                 t1 = time.time()
                 print('Time train/samp:', (t1 - t0)/Nsamps) 
+            # The weights of the evolution changed, any table of A(x) is stale
+            self.lat_ev_model.invalidate_A_grid()
                 
             # Add some summaries
             cost, summaries = sess.run([self.cost, merged_summaries], feed_dict=fd_train)
@@ -250,19 +276,15 @@ class Optimizer_TS():
             # Save if validation improvement
             if ep % 5 == 0 and self.xDim == 2:
                 if params.with_ids:
-                    for ent in range(self.params.num_diff_entities):
-                        print('Plottins DS for entity ', str(ent), '...')
-                        list_idxs = [i for i, Id in enumerate(Idtrain) if Id == ent]
-                        print(list_idxs)
-                        Xdata_thisid = Xpassed_NxTxd[list_idxs]
-                        rlt_file = 'qplot'+str(ep)+'_'+str(ent)
-                        self.lat_ev_model.plot_2Dquiver_paths(sess, Xdata_thisid,
-                                                              scope = "VAEC/", 
-                                                              rlt_dir=rlt_dir,
-                                                              rslt_file=rlt_file,
-                                                              savefig=True, draw=False,
-                                                              skipped=5, feed_range=True,
-                                                              Id=ent)
+                    # The flows of all the entities in a single run
+                    print('Plotting DS for entities', self.id_groups.ids_E, '...')
+                    self.lat_ev_model.plot_2Dquiver_paths_grouped(sess, Xpassed_NxTxd,
+                                                                  self.id_groups,
+                                                                  scope="VAEC/",
+                                                                  rlt_dir=rlt_dir,
+                                                                  rslt_file='qplot'+str(ep),
+                                                                  savefig=True, draw=False,
+                                                                  skipped=5)
                 else:
                     self.lat_ev_model.plot_2Dquiver_paths(sess, Xpassed_NxTxd,
                                                           scope = "VAEC/", 
@@ -21,15 +21,15 @@ import tensorflow as tf
 # Jupyter notebook. A fairy dies in Neverland every time you run this.s
 if __name__ == 'RecognitionModels':
     from LatEvModels import LocallyLinearEvolution #@UnresolvedImport #@UnusedImport
-    from utils import blk_tridiag_chol, blk_chol_inv #@UnresolvedImport #@UnusedImport
+    from utils import (BlockTridiagPrecision, LinearGaussianPrecision, get_dtypes, #@UnresolvedImport #@UnusedImport
+                       lower_chol_variable) #@UnresolvedImport #@UnusedImport
     from layers import FullLayer #@UnresolvedImport #@UnusedImport
 else:
     from .LatEvModels import LocallyLinearEvolution #@Reimport
-    from .utils import blk_tridiag_chol, blk_chol_inv #@Reimport
+    from .utils import (BlockTridiagPrecision, LinearGaussianPrecision, get_dtypes, #@Reimport
+                        lower_chol_variable) #@Reimport
     from .layers import FullLayer #@Reimport
 
-DTYPE = tf.float32
-
 class GaussianRecognition():
     """
     """
@@ -37,12 +37,17 @@ class GaussianRecognition():
         """
         """
         self.params = params
+        self.dtype, self.fact_dtype = get_dtypes(params)
 
         self.Y = Y
         self.X = X
 
         self.yDim = params.yDim
         self.xDim = params.xDim
+        # Whether Lambda is a single learned matrix, the same for every time
+        # bin, instead of the output of the recognition network.
+        self.stationary_Lambda = ( params.stationary_Lambda
+                                   if hasattr(params, 'stationary_Lambda') else False )
                 
         self.Nsamps = tf.shape(self.Y)[0]
         self.NTbins = tf.shape(self.Y)[1]
@@ -73,20 +78,30 @@ class GaussianRecognition():
             Mu_NxTxd = tf.reshape(Mu_NTxd, [Nsamps, NTbins, xDim], name='MuX')
 
         with tf.variable_scope("recog_nn_lambda", reuse=tf.AUTO_REUSE):
-            full1 = fully_connected_layer(Y_input_NTxD, rec_nodes, 'softplus', 'full1',
-                                          initializer=tf.random_normal_initializer(stddev=rangeLambda))
-            full2 = fully_connected_layer(full1, rec_nodes, 'softplus', 'full2',
-                                          initializer=tf.random_normal_initializer(stddev=rangeLambda))
-            full3 = fully_connected_layer(full2, xDim**2, 'linear', 'output',
-                                        initializer=tf.orthogonal_initializer(gain=rangeLambda))
-#                                         initializer=tf.random_uniform_initializer(-0.01, 0.01))
-            LambdaChol_NTxdxd = tf.reshape(full3, [Nsamps*NTbins, xDim, xDim])
-            Lambda_NTxdxd = tf.matmul(LambdaChol_NTxdxd, LambdaChol_NTxdxd,
-                                     transpose_b=True)
-            Lambda_NxTxdxd = tf.reshape(Lambda_NTxdxd, [Nsamps, NTbins, xDim, xDim], name='Lambda')
-        
-        LambdaMu_NTxd = tf.squeeze(tf.matmul(Lambda_NTxdxd,
-                                             tf.expand_dims(Mu_NTxd, axis=2)), axis=2)
+            if self.stationary_Lambda:
+                LambdaChol_dxd, _ = lower_chol_variable('LambdaChol', xDim, rangeLambda,
+                                                        dtype=self.dtype)
+                self.Lambda_dxd = tf.matmul(LambdaChol_dxd, LambdaChol_dxd, transpose_b=True)
+                # Lambda is not tiled over trials and time, the [1, 1, d, d]
+                # tensor broadcasts wherever it is consumed.
+                Lambda_NxTxdxd = tf.reshape(self.Lambda_dxd, [1, 1, xDim, xDim], name='Lambda')
+                LambdaMu_NTxd = tf.matmul(Mu_NTxd, self.Lambda_dxd)
+            else:
+                init_hidden = tf.random_normal_initializer(stddev=rangeLambda)
+                full1 = fully_connected_layer(Y_input_NTxD, rec_nodes, 'softplus', 'full1',
+                                              initializer=init_hidden)
+                full2 = fully_connected_layer(full1, rec_nodes, 'softplus', 'full2',
+                                              initializer=init_hidden)
+                full3 = fully_connected_layer(full2, xDim**2, 'linear', 'output',
+                                            initializer=tf.orthogonal_initializer(gain=rangeLambda))
+#                                             initializer=tf.random_uniform_initializer(-0.01, 0.01))
+                LambdaChol_NTxdxd = tf.reshape(full3, [Nsamps*NTbins, xDim, xDim])
+                Lambda_NTxdxd = tf.matmul(LambdaChol_NTxdxd, LambdaChol_NTxdxd,
+                                         transpose_b=True)
+                Lambda_NxTxdxd = tf.reshape(Lambda_NTxdxd, [Nsamps, NTbins, xDim, xDim],
+                                            name='Lambda')
+                LambdaMu_NTxd = tf.squeeze(tf.matmul(Lambda_NTxdxd,
+                                                     tf.expand_dims(Mu_NTxd, axis=2)), axis=2)
         LambdaMu_NxTxd = tf.reshape(LambdaMu_NTxd, [Nsamps, NTbins, xDim])
     
         return Mu_NxTxd, Lambda_NxTxdxd, LambdaMu_NxTxd
@@ -105,12 +120,41 @@ class SmoothingNLDSTimeSeries(GaussianRecognition):
         lat_mod_classes = {'llinear' : LocallyLinearEvolution}
         LatModel = lat_mod_classes[params.lat_mod_class]
         self.lat_ev_model = LatModel(X, params, Ids=Ids)
+        
+        # The block-tridiagonal solver. 'sequential' scans over time,
+        # 'parallel' has O(log T) depth and pays off for long sequences.
+        self.tridiag_solver = ( params.tridiag_solver if hasattr(params, 'tridiag_solver')
+                                else 'sequential' )
+        # Backpropagate through the Cholesky with its analytic gradient, which
+        # stores only the factor, instead of through the scan over time.
+        self.analytic_chol_grads = ( params.analytic_chol_grads
+                                     if hasattr(params, 'analytic_chol_grads') else True )
+        # How the gradient term of the posterior mean is computed. 'vjp' takes
+        # one backward pass through the evolution network, 'jacobian' builds
+        # the full Jacobian of A(x).
+        self.grad_term_method = ( params.grad_term_method if hasattr(params, 'grad_term_method')
+                                  else 'vjp' )
+        # Globally linear dynamics (alpha = 0) are smoothed with a dedicated
+        # linear-Gaussian precision that does not depend on X. See
+        # `_compute_linear_TheChol`.
+        self.is_linear = not bool(params.alpha)
+        self.steady_state_tol = ( params.steady_state_tol if hasattr(params, 'steady_state_tol')
+                                  else 1e-6 )
                     
         # ***** COMPUTATION OF THE CHOL AND POSTERIOR *****#
-        self.TheChol_2xxNxTxdxd, self.checks1 = self._compute_TheChol()
+        # The posterior precision owns the Cholesky factor. Everything below
+        # is built through it.
+        self.precision, self.checks1 = self._compute_TheChol()
+        self.TheChol_2xxNxTxdxd = [self.precision.AChol_NxTxdxd,
+                                   self.precision.BChol_NxTm1xdxd]
         self.postX_NxTxd, self.postX_ng_NxTxd, self.checks2 = self._compute_postX()
         self.noisy_postX, self.noisy_postX_ng = self.sample_postX()
         
+        # Posterior marginal covariances Cov(x_t) and lag-one covariances
+        # Cov(x_{t+1}, x_t), by selected inversion of the precision.
+        self.postX_cov_NxTxdxd, self.postX_crosscov_NxTm1xdxd = self.compute_postX_cov()
+        
+        self._entropy_cache = {}
         self.Entropy = self.compute_Entropy()
 
     def _compute_TheChol(self, InputX=None, Ids=None, InputY=None):
@@ -123,6 +167,10 @@ class SmoothingNLDSTimeSeries(GaussianRecognition):
         X_NxTxd = self.X if InputX is None else InputX
         if Ids is None: Ids = self.Ids
         
+        if self.is_linear:
+            if InputX is None: self.A_evol = self.lat_ev_model.A_evol
+            return self._compute_linear_TheChol(Lambda_NxTxdxd)
+        
         Nsamps = tf.shape(X_NxTxd)[0]
         NTbins = tf.shape(X_NxTxd)[1]
         xDim = self.xDim
@@ -130,145 +178,117 @@ class SmoothingNLDSTimeSeries(GaussianRecognition):
         # Some serious tensorflow gymnastics in the next 150 lines or so
 #         A_NxTxdxd = ( self.lat_ev_model.A_NxTxdxd if InputX is None else
 #                       self.lat_ev_model._define_evolution_network(InputX, Ids)[0])
-        A_NxTxdxd = ( self.lat_ev_model.A_NxTxdxd if InputX is None else
-                      self.lat_ev_model._define_evolution_network_wi(InputX, Ids)[0])
-        self.A_NTm1xdxd = A_NTm1xdxd = tf.reshape(A_NxTxdxd[:,:-1,:,:],
-                                                  [Nsamps*(NTbins-1), xDim, xDim])
+        # The evolution matrices keep the structure of the evolution network
+        # (dense, low-rank or block-diagonal). The products below use it.
+        A = ( self.lat_ev_model.A_evol if InputX is None else
+              self.lat_ev_model._define_evolution_matrices(InputX, Ids)[0] )
+        A_NxTxdxd = A.dense()
+        if InputX is None:
+            # The evolution at the posterior, used by _compute_postX
+            self.A_evol = A
+            self.A_NTm1xdxd = tf.reshape(A_NxTxdxd[:,:-1,:,:], [Nsamps*(NTbins-1), xDim, xDim])
 
         QInv_dxd = self.lat_ev_model.QInv_dxd
         Q0Inv_dxd = self.lat_ev_model.Q0Inv_dxd
+        # For diagonal Q, the products of A with QInv only scale rows/columns
+        QInv_d = self.lat_ev_model.QInv_d
+        QInv = QInv_dxd if QInv_d is None else QInv_d
         
-        # Constructs the block diagonal matrix:
+        # Constructs the block diagonal matrix, the same for every trial:
         #     Qt^-1 = diag{Q0^-1, Q^-1, ..., Q^-1}
-        self.QInvs_NTm1xdxd = QInvs_NTm1xdxd = tf.tile(tf.expand_dims(QInv_dxd, axis=0),
-                                                       [Nsamps*(NTbins-1), 1, 1])
-        QInvs_Tm2xdxd = tf.tile(tf.expand_dims(QInv_dxd, axis=0), [NTbins-2, 1, 1])
+        QInvs_Tm1xdxd = tf.tile(tf.expand_dims(QInv_dxd, axis=0), [NTbins-1, 1, 1])
         Q0Inv_1xdxd = tf.expand_dims(Q0Inv_dxd, axis=0)
-        Q0QInv_Tm1xdxd = tf.concat([Q0Inv_1xdxd, QInvs_Tm2xdxd], axis=0)
-        QInvsTot_NTm1xdxd = tf.tile(Q0QInv_Tm1xdxd, [Nsamps, 1, 1])
+        QInvsTot_Txdxd = tf.concat([Q0Inv_1xdxd, QInvs_Tm1xdxd], axis=0)
 
         # The diagonal blocks of Omega(z) up to T-1:
         #     Omega(z)_ii = A(z)^T*Qq^{-1}*A(z) + Qt^{-1},     for i in {1,...,T-1 }
         use_tt = self.params.use_transpose_trick
-        AQInvsA_NTm1xdxd = ( tf.matmul(A_NTm1xdxd, 
-                        tf.matmul(QInvs_NTm1xdxd, A_NTm1xdxd, transpose_b=not use_tt),
-                        transpose_a=use_tt) + QInvsTot_NTm1xdxd )
-        AQInvsA_NxTm1xdxd = tf.reshape(AQInvsA_NTm1xdxd, [Nsamps, NTbins-1, xDim, xDim])                                     
+        A_tt = A if use_tt else A.transpose()
+        AQInvsA_NxTm1xdxd = A_tt.quad_form(QInv)[:,:-1]
         
         # The off-diagonal blocks of Omega(z):
         #     Omega(z)_{i,i+1} = -A(z)^T*Q^-1,     for i in {1,..., T-2}
-        AQInvs_NTm1xdxd = -tf.matmul(A_NTm1xdxd, QInvs_NTm1xdxd, transpose_a=use_tt)
+        BB_NxTm1xdxd = -A_tt.transpose_dot(QInv)[:,:-1]
         
-        # Tile in the last block Omega_TT. 
+        # Pad in the last block Omega_TT, which is just Q^-1. 
         # This one does not depend on A. There is no latent evolution beyond T.
-        QInvs_Nx1xdxd = tf.tile(tf.reshape(QInv_dxd, shape=[1, 1, xDim, xDim]),
-                                [Nsamps, 1, 1, 1])
-        AQInvsAQInv_NxTxdxd = tf.concat([AQInvsA_NxTm1xdxd, QInvs_Nx1xdxd], axis=1)
+        AQInvsA_NxTxdxd = tf.pad(AQInvsA_NxTm1xdxd, [[0,0], [0,1], [0,0], [0,0]])
         
-        # Add in the covariance coming from the observations
-        AA_NxTxdxd = Lambda_NxTxdxd + AQInvsAQInv_NxTxdxd
-        BB_NxTm1xdxd = tf.reshape(AQInvs_NTm1xdxd, [Nsamps, NTbins-1, xDim, xDim])        
+        # Add in Qt^-1, broadcast over trials, and the covariance coming from
+        # the observations
+        AA_NxTxdxd = Lambda_NxTxdxd + AQInvsA_NxTxdxd + QInvsTot_Txdxd
         
-        # Computation of the Cholesky decomposition for the total covariance
-        aux_fn1 = lambda _, seqs : blk_tridiag_chol(seqs[0], seqs[1])
-        TheChol_2xxNxTxdxd = tf.scan(fn=aux_fn1, 
-                                    elems=[AA_NxTxdxd, BB_NxTm1xdxd],
-                                    initializer=[tf.zeros_like(AA_NxTxdxd[0]), 
-                                                 tf.zeros_like(BB_NxTm1xdxd[0])] )
+        # Computation of the Cholesky decomposition for the total covariance.
+        # All trials are factorized together, in fact_dtype.
+        precision = BlockTridiagPrecision(AA_NxTxdxd, BB_NxTm1xdxd, solver=self.tridiag_solver,
+                                          dtype=self.fact_dtype,
+                                          analytic_grads=self.analytic_chol_grads)
 
-        return TheChol_2xxNxTxdxd, [A_NxTxdxd, AA_NxTxdxd, BB_NxTm1xdxd]
+        return precision, [A_NxTxdxd, AA_NxTxdxd, BB_NxTm1xdxd]
+    
+    def _compute_linear_TheChol(self, Lambda_NxTxdxd):
+        """
+        The posterior precision for globally linear dynamics, A = Alinear. The
+        blocks coming from the evolution are d x d matrices shared by every
+        trial, and the off-diagonal block is a single -A^T*Q^-1, so neither the
+        evolution network nor any per-time A is needed. If Lambda is
+        stationary too, the factorization stops at the steady state of the
+        Riccati recursion. See `utils.LinearGaussianPrecision`.
+        """
+        Nsamps = tf.shape(self.LambdaMu_NxTxd)[0]
+        NTbins = tf.shape(self.LambdaMu_NxTxd)[1]
+        
+        A_dxd = self.lat_ev_model.Alinear_dxd
+        QInv_dxd = self.lat_ev_model.QInv_dxd
+        Q0Inv_dxd = self.lat_ev_model.Q0Inv_dxd
+        A_tt_dxd = A_dxd if self.params.use_transpose_trick else tf.transpose(A_dxd)
+        AQInvA_dxd = tf.matmul(A_tt_dxd, tf.matmul(QInv_dxd, A_tt_dxd), transpose_a=True)
+        BB_dxd = -tf.matmul(A_tt_dxd, QInv_dxd, transpose_a=True)
+        
+        # Omega_11 = A^T*Q^-1*A + Q0^-1, Omega_tt = A^T*Q^-1*A + Q^-1 and
+        # Omega_TT = Q^-1
+        Omega_Txdxd = tf.concat([tf.expand_dims(AQInvA_dxd + Q0Inv_dxd, axis=0),
+                                 tf.tile(tf.expand_dims(AQInvA_dxd + QInv_dxd, axis=0),
+                                         [NTbins-2, 1, 1]),
+                                 tf.expand_dims(QInv_dxd, axis=0)], axis=0)
+        AA_NxTxdxd = Lambda_NxTxdxd + Omega_Txdxd
+        if self.stationary_Lambda:
+            AA_NxTxdxd = tf.tile(AA_NxTxdxd, [Nsamps, 1, 1, 1])
+        
+        precision = LinearGaussianPrecision(AA_NxTxdxd, BB_dxd, solver=self.tridiag_solver,
+                                            dtype=self.fact_dtype,
+                                            analytic_grads=self.analytic_chol_grads,
+                                            steady_state_tol=( self.steady_state_tol if
+                                                               self.stationary_Lambda else None ))
+        
+        return precision, [A_dxd, AA_NxTxdxd, BB_dxd]
     
     def _compute_postX(self):
         """
         """
         X_NxTxd = self.X
-        Ids = self.lat_ev_model.Ids
         Nsamps = tf.shape(X_NxTxd)[0]
         NTbins = tf.shape(X_NxTxd)[1]
         xDim = self.xDim
 
-        with_inputs = self.params.with_inputs
-        if with_inputs:
-            iDim = self.lat_ev_model.iDim
-            Input_NxTxi = self.lat_ev_model.I
-        
-        QInvs_NTm1xdxd = self.QInvs_NTm1xdxd
-        TheChol_2xxNxTxdxd = self.TheChol_2xxNxTxdxd
-        A_NTm1xdxd = self.A_NTm1xdxd
+        precision = self.precision
         LambdaMu_NxTxd = self.LambdaMu_NxTxd
         
-        Ids_NTm1x1 = tf.reshape(tf.tile(tf.expand_dims(Ids, axis=1), [1, NTbins-1]),
-                                [Nsamps*(NTbins-1), 1])
-        X_f_NTm1x1xd = tf.reshape(X_NxTxd[:,:-1,:], [Nsamps*(NTbins-1), 1, xDim])
-        X_f_NTm1x1x1xd = tf.expand_dims(X_f_NTm1x1xd, axis=1) # for use with tf.map_fn
-        X_b_NTm1x1xd = tf.reshape(X_NxTxd[:,1:,:], [Nsamps*(NTbins-1), 1, xDim])
-        if with_inputs:
-            Input_f_NTm1x1xi = tf.reshape(Input_NxTxi[:,:-1,:], [Nsamps*(NTbins-1), 1, iDim])
-            Input_f_NTm1x1x1xi = tf.expand_dims(Input_f_NTm1x1xi, axis=1)
-            get_grads = lambda xin_id : self.lat_ev_model.get_A_grads(xin_id[0],
-                                                                      xin_id[1], xin_id[2])        
-            Agrads_NTm1xd2xd = tf.map_fn(get_grads, 
-                                         elems=[X_f_NTm1x1x1xd, Ids_NTm1x1, Input_f_NTm1x1x1xi],
-                                         dtype=DTYPE)
-        else:
-            get_grads = lambda xin_id : self.lat_ev_model.get_A_grads(xin_id[0], xin_id[1])        
-            Agrads_NTm1xd2xd = tf.map_fn(get_grads, 
-                                         elems=[X_f_NTm1x1x1xd, Ids_NTm1x1],
-                                         dtype=DTYPE)
-        Agrads_NTm1xdxdxd = tf.reshape(Agrads_NTm1xd2xd,
-                                      [Nsamps*(NTbins-1), xDim, xDim, xDim])
-
-        # Move the gradient dimension to the 0 position, then unstack.
-        Agrads_split_dxxNTm1xdxd = tf.unstack(tf.transpose(Agrads_NTm1xdxdxd,
-                                                         [3, 0, 1, 2]))
-
         use_tt = self.params.use_transpose_trick
-        # G_k = -0.5(X_i.*A_ij;k.*Q_jl.*A^T_lm.*X_m + X_i.*A_ij.*Q_jl.*A^T_lm;k.*X_m)  
-        grad_tt_postX_dxNTm1 = -0.5*tf.squeeze(tf.stack(
-            [tf.matmul(tf.matmul(tf.matmul(tf.matmul(X_f_NTm1x1xd, Agrad_NTm1xdxd), 
-                QInvs_NTm1xdxd), A_NTm1xdxd, transpose_b=True),
-                X_f_NTm1x1xd, transpose_b=True) +
-            tf.matmul(tf.matmul(tf.matmul(tf.matmul(
-                X_f_NTm1x1xd, A_NTm1xdxd), 
-                QInvs_NTm1xdxd), Agrad_NTm1xdxd, transpose_b=True),
-                X_f_NTm1x1xd, transpose_b=True)
-                for Agrad_NTm1xdxd 
-                in Agrads_split_dxxNTm1xdxd]), axis=[2,3] )
-        # G_ttp1 = -0.5*X_i*A_ij;k*Q_jl*X_l
-        grad_ttp1_postX_dxNTm1 = 0.5*tf.squeeze(tf.stack(
-            [tf.matmul(tf.matmul(tf.matmul(X_f_NTm1x1xd, Agrad_NTm1xdxd),
-            QInvs_NTm1xdxd), X_b_NTm1x1xd, transpose_b=True) 
-                for Agrad_NTm1xdxd in Agrads_split_dxxNTm1xdxd ]), axis=[2,3])
-        # G_ttp1 = -0.5*X_i*Q_ij*A^T_jl;k*X_l
-        grad_tp1t_postX_dxNTm1 = 0.5*tf.squeeze(tf.stack(
-            [tf.matmul(tf.matmul(tf.matmul(X_b_NTm1x1xd, QInvs_NTm1xdxd),
-            Agrad_NTm1xdxd, transpose_b=True), X_f_NTm1x1xd, transpose_b=True) 
-                for Agrad_NTm1xdxd in Agrads_split_dxxNTm1xdxd ]), axis=[2,3])
-        gradterm_postX_dxNTm1 = ( grad_tt_postX_dxNTm1 + grad_ttp1_postX_dxNTm1 +
-                              grad_tp1t_postX_dxNTm1 )
-        
         # The following term is the second term in Eq. (13) in the paper: 
         # https://github.com/dhernandd/vind/blob/master/paper/nips_workshop.pdf 
-        zeros_Nx1xd = tf.zeros([Nsamps, 1, xDim], dtype=DTYPE)
-        postX_gradterm_NxTxd = tf.concat(
-            [tf.reshape(tf.transpose(gradterm_postX_dxNTm1, [1, 0]),
-                       [Nsamps, NTbins-1, xDim]), zeros_Nx1xd], axis=1)
+        postX_gradterm_NxTxd = self._compute_postX_gradterm()
         
-        def postX_from_chol(tc1, tc2, lm):
-            """
-            postX = (Lambda1 + S)^{-1}.(Lambda1_ij.*Mu_j + X^T_k.*S_kj;i.*X_j)
-            """
-            return blk_chol_inv(tc1, tc2, blk_chol_inv(tc1, tc2, lm), 
-                                lower=False, transpose=True)
-        aux_fn2 = lambda _, seqs : postX_from_chol(seqs[0], seqs[1], seqs[2])
+        # postX = (Lambda1 + S)^{-1}.(Lambda1_ij.*Mu_j + X^T_k.*S_kj;i.*X_j)
         if self.params.with_inputs and self.params.with_Iterm:
             # Bring the extra input term f(I) in X_{t+1} = A(X_t, I_t)X_t + f(I_t) 
-            Iterm_NxTm1xd = self.lat_ev_model.Iterm_NxTxd[:,:-1]
-            Iterm_NTm1xdx1 = tf.reshape(Iterm_NxTm1xd, [Nsamps*(NTbins-1), xDim, 1])
-            QI_NTm1xdx1 = tf.matmul(QInvs_NTm1xdxd, Iterm_NTm1xdx1)
-            QI_NxTm1xd = tf.reshape(QI_NTm1xdx1, [Nsamps, NTbins-1, xDim])
-            AQI_NTm1xdx1 = -tf.matmul(A_NTm1xdxd, QI_NTm1xdx1, transpose_a=use_tt)
-            AQI_NxTm1xd = tf.reshape(AQI_NTm1xdx1, [Nsamps, NTbins-1, xDim])
+            # QI = Q^-1*f(I) and AQI = -A^T*Q^-1*f(I), as row vectors
+            Iterm_NTxd = tf.reshape(self.lat_ev_model.Iterm_NxTxd, [Nsamps*NTbins, xDim])
+            QI_NxTxd = tf.reshape(self.lat_ev_model.rmul_QInv(Iterm_NTxd),
+                                  [Nsamps, NTbins, xDim])
+            A_tt = self.A_evol if use_tt else self.A_evol.transpose()
+            QI_NxTm1xd = QI_NxTxd[:,:-1]
+            AQI_NxTm1xd = -A_tt.rmatvec(QI_NxTxd)[:,:-1]
             
             Ipostterm_a = AQI_NxTm1xd[:,:1]
             Ipostterm_b = QI_NxTm1xd[:,:-1] + AQI_NxTm1xd[:,1:]
@@ -276,46 +296,124 @@ class SmoothingNLDSTimeSeries(GaussianRecognition):
             Ipostterm_NxTxd = tf.concat([Ipostterm_a, Ipostterm_b, Ipostterm_c], axis=1)
             
             num_NxTxd = LambdaMu_NxTxd + Ipostterm_NxTxd
-            postX_ng = tf.scan(fn=aux_fn2, 
-                               elems=[TheChol_2xxNxTxdxd[0], TheChol_2xxNxTxdxd[1], num_NxTxd],
-                               initializer=tf.zeros_like(LambdaMu_NxTxd[0], dtype=DTYPE) )      
-            # postX with gradients. At the moment, we are not using this.      
-            postX = tf.scan(fn=aux_fn2,
-                        elems=[TheChol_2xxNxTxdxd[0], TheChol_2xxNxTxdxd[1],
-                               num_NxTxd + postX_gradterm_NxTxd],
-                        initializer=tf.zeros_like(LambdaMu_NxTxd[0], dtype=DTYPE) )
         else:
-            # postX without gradients.      
-            postX_ng = tf.scan(fn=aux_fn2, 
-                               elems=[TheChol_2xxNxTxdxd[0], TheChol_2xxNxTxdxd[1], LambdaMu_NxTxd],
-                               initializer=tf.zeros_like(LambdaMu_NxTxd[0], dtype=DTYPE) )
-            # postX with gradients. At the moment, we are not using this.      
-            postX = tf.scan(fn=aux_fn2,
-                        elems=[TheChol_2xxNxTxdxd[0], TheChol_2xxNxTxdxd[1],
-                               LambdaMu_NxTxd + postX_gradterm_NxTxd],
-                        initializer=tf.zeros_like(LambdaMu_NxTxd[0], dtype=DTYPE) )
+            num_NxTxd = LambdaMu_NxTxd
+        
+        # postX without and with gradients (at the moment, we are not using the
+        # latter), together with the posterior noise L^{-T}*eps used by
+        # sample_postX. The three right-hand sides are stacked so that they
+        # share a single forward and a single backward pass over the factor.
+        num_NxTxdx2 = tf.stack([num_NxTxd, num_NxTxd + postX_gradterm_NxTxd], axis=-1)
+        prenoise_NxTxdx1 = tf.random_normal([Nsamps, NTbins, xDim, 1], dtype=self.dtype)
+        postX_NxTxdx2, noise_NxTxdx1 = precision.inv_dot_and_sample(num_NxTxdx2,
+                                                                    prenoise_NxTxdx1)
+        postX_ng, postX = postX_NxTxdx2[...,0], postX_NxTxdx2[...,1]
+        self.postX_noise_NxTxd = noise_NxTxdx1[...,0]
 
         postX = tf.identity(postX, name='postX')
         postX_ng = tf.identity(postX_ng, name='postX_ng') # tensorflow triple axel! :)
                 
         return postX, postX_ng, [postX_gradterm_NxTxd]
 
-    def sample_postX(self):
+    def _compute_postX_gradterm(self, method=None):
         """
+        Computes the gradient of the quadratic evolution energy
+        
+            E = -0.5*sum_t (x_{t+1} - x_t.A(x_t)).Q^{-1}.(x_{t+1} - x_t.A(x_t))^T
+        
+        with respect to the row vectors x_t, differentiating only through A. The last time bin
+        has no evolution term and gets zeros.
+        
+        Args:
+            method: 'vjp' takes the gradient of E in a single backward pass
+                through the evolution network, with the explicit occurrences of
+                x held fixed by stop_gradient. 'jacobian' materializes the
+                [NT x d x d x d] Jacobian of A and contracts it. Defaults to
+                self.grad_term_method.
+        
+        Returns:
+            postX_gradterm_NxTxd
         """
-        Nsamps, NTbins, xDim = self.Nsamps, self.NTbins, self.xDim
-        prenoise_NxTxd = tf.random_normal([Nsamps, NTbins, xDim], dtype=DTYPE)
+        if method is None: method = self.grad_term_method
+        X_NxTxd = self.X
+        # A does not depend on X for linear dynamics
+        if self.is_linear: return tf.zeros_like(X_NxTxd)
+        Nsamps = tf.shape(X_NxTxd)[0]
+        NTbins = tf.shape(X_NxTxd)[1]
+        xDim = self.xDim
+
+        rmul_QInv = self.lat_ev_model.rmul_QInv
+        
+        if method == 'vjp':
+            # Terms of E that are constant in A drop out of the gradient.
+            X_b_NTm1xd = tf.stop_gradient(tf.reshape(X_NxTxd[:,1:,:],
+                                                     [Nsamps*(NTbins-1), xDim]))
+            XA_NTm1xd = tf.reshape(self.A_evol.rmatvec(tf.stop_gradient(X_NxTxd))[:,:-1],
+                                   [Nsamps*(NTbins-1), xDim])
+            XAQInv_NTm1xd = rmul_QInv(XA_NTm1xd)
+            Energy = -0.5*tf.reduce_sum(XAQInv_NTm1xd*XA_NTm1xd) + 0.5*tf.reduce_sum(
+                XAQInv_NTm1xd*X_b_NTm1xd + rmul_QInv(X_b_NTm1xd)*XA_NTm1xd)
+            postX_gradterm_NxTxd = tf.gradients(Energy, X_NxTxd)[0]
+            if postX_gradterm_NxTxd is None:
+                postX_gradterm_NxTxd = tf.zeros_like(X_NxTxd)
+        elif method == 'jacobian':
+            # The Jacobian A_ij;k of the evolution at every point but the last.
+            Agrads_NxTxdxdxd = self.lat_ev_model.get_A_jacobian()
+            Agrads_NTm1xdxdxd = tf.reshape(Agrads_NxTxdxdxd[:,:-1],
+                                           [Nsamps*(NTbins-1), xDim, xDim, xDim])
+            X_f_NTm1xd = tf.reshape(X_NxTxd[:,:-1,:], [Nsamps*(NTbins-1), xDim])
+            X_b_NTm1xd = tf.reshape(X_NxTxd[:,1:,:], [Nsamps*(NTbins-1), xDim])
+            
+            # XA_j = X_i.*A_ij and XAgrad_jk = X_i.*A_ij;k
+            XA_NTm1xd = tf.einsum('pi,pij->pj', X_f_NTm1xd, self.A_NTm1xdxd)
+            XAgrad_NTm1xdxd = tf.einsum('pi,pijk->pjk', X_f_NTm1xd, Agrads_NTm1xdxdxd)
+            # G_k = -0.5(X_i.*A_ij;k.*Q_jl.*A^T_lm.*X_m + X_i.*A_ij.*Q_jl.*A^T_lm;k.*X_m)  
+            XAQInv_NTm1xd = rmul_QInv(XA_NTm1xd)
+            grad_tt_postX_NTm1xd = -0.5*(
+                tf.einsum('pjk,pj->pk', XAgrad_NTm1xdxd, XAQInv_NTm1xd) +
+                tf.einsum('pj,pjk->pk', XAQInv_NTm1xd, XAgrad_NTm1xdxd) )
+            # G_ttp1 = -0.5*X_i*A_ij;k*Q_jl*X_l
+            grad_ttp1_postX_NTm1xd = 0.5*tf.einsum('pjk,pj->pk', XAgrad_NTm1xdxd,
+                                                   rmul_QInv(X_b_NTm1xd))
+            # G_ttp1 = -0.5*X_i*Q_ij*A^T_jl;k*X_l
+            grad_tp1t_postX_NTm1xd = 0.5*tf.einsum('pj,pjk->pk', rmul_QInv(X_b_NTm1xd),
+                                                   XAgrad_NTm1xdxd)
+            gradterm_postX_NTm1xd = ( grad_tt_postX_NTm1xd + grad_ttp1_postX_NTm1xd +
+                                      grad_tp1t_postX_NTm1xd )
+            
+            zeros_Nx1xd = tf.zeros([Nsamps, 1, xDim], dtype=self.dtype)
+            postX_gradterm_NxTxd = tf.concat(
+                [tf.reshape(gradterm_postX_NTm1xd, [Nsamps, NTbins-1, xDim]), zeros_Nx1xd],
+                axis=1)
+        else:
+            raise ValueError("Unknown grad_term_method {}".format(method))
         
-        aux_fn = lambda _, seqs : blk_chol_inv(seqs[0], seqs[1], seqs[2],
-                                               lower=False, transpose=True)
-        noise = tf.scan(fn=aux_fn, elems=[self.TheChol_2xxNxTxdxd[0],
-                                          self.TheChol_2xxNxTxdxd[1], prenoise_NxTxd],
-                        initializer=tf.zeros_like(prenoise_NxTxd[0], dtype=DTYPE) )
+        return postX_gradterm_NxTxd
+
+    def sample_postX(self):
+        """
+        Adds a posterior noise draw to postX and postX_ng. The noise was solved
+        for in _compute_postX, in the same pass as the means.
+        """
+        noise = self.postX_noise_NxTxd
         noisy_postX_ng = tf.add(self.postX_ng_NxTxd, noise, name='noisy_postX')
         noisy_postX = tf.add(self.postX_NxTxd, noise, name='noisy_postX')
                     
         return noisy_postX, noisy_postX_ng
     
+    def compute_postX_cov(self):
+        """
+        Computes the diagonal and first off-diagonal blocks of the posterior
+        covariance in O(T*d^3), from the Cholesky factor of the precision. Use
+        these for credible bands on the latent paths instead of drawing many
+        noisy_postX samples.
+        """
+        postX_cov_NxTxdxd, postX_crosscov_NxTm1xdxd = self.precision.marginal_covariances()
+        postX_cov_NxTxdxd = tf.identity(postX_cov_NxTxdxd, name='postX_cov')
+        postX_crosscov_NxTm1xdxd = tf.identity(postX_crosscov_NxTm1xdxd, name='postX_crosscov')
+        
+        return postX_cov_NxTxdxd, postX_crosscov_NxTm1xdxd
+    
     def compute_Entropy(self, Input=None, Ids=None):
         """
         Computes the Entropy. Takes an Input to provide that later on, we can
@@ -324,25 +422,28 @@ class SmoothingNLDSTimeSeries(GaussianRecognition):
         if Input is None and Ids is not None: raise ValueError("Must provide an Input for these Ids")
         X_NxTxd = self.X if Input is None else Input
         if Ids is None: Ids = self.Ids
+        # The Entropy is built once per input
+        if (X_NxTxd, Ids) in self._entropy_cache: return self._entropy_cache[(X_NxTxd, Ids)]
 
         xDim = self.xDim
         Nsamps = tf.shape(X_NxTxd)[0]
         NTbins = tf.shape(X_NxTxd)[1]
 
-        TheChol_2xxNxTxdxd = ( self.TheChol_2xxNxTxdxd if Input is None else
-                               self._compute_TheChol(Input, Ids)[0] ) 
+        precision = ( self.precision if Input is None or self.is_linear else
+                      self._compute_TheChol(Input, Ids)[0] ) 
              
         with tf.variable_scope('entropy'):
-            self.thechol0 = tf.reshape(TheChol_2xxNxTxdxd[0], 
-                                       [Nsamps*NTbins, xDim, xDim])
-            LogDet = -2.0*tf.reduce_sum(tf.log(tf.matrix_determinant(self.thechol0)))
+            # The log-determinant of the posterior covariance, i.e. minus that
+            # of the precision. 
+            LogDet = -tf.reduce_sum(precision.logdet())
                     
-            Nsamps = tf.cast(Nsamps, DTYPE)        
-            NTbins = tf.cast(NTbins, DTYPE)        
-            xDim = tf.cast(xDim, DTYPE)                
+            Nsamps = tf.cast(Nsamps, self.dtype)        
+            NTbins = tf.cast(NTbins, self.dtype)        
+            xDim = tf.cast(xDim, self.dtype)                
             
             Entropy = tf.add(0.5*Nsamps*NTbins*(1 + np.log(2*np.pi)),
                              0.5*LogDet, name='Entropy')  # Yuanjun has xDim here so I put it but I don't think this is right.
+        self._entropy_cache[(X_NxTxd, Ids)] = Entropy
         
         return Entropy
     
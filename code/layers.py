@@ -20,8 +20,6 @@ if __name__ == 'layers':
 else:
     from .utils import variable_in_cpu  # @Reimport
 
-DTYPE = tf.float32
-
 class FullLayer():
     """
     """
@@ -35,11 +33,22 @@ class FullLayer():
         
     def __call__(self, Input, nodes, nl='softplus', scope=None, name='out',
                  initializer=tf.orthogonal_initializer(),
-                 b_initializer=tf.zeros_initializer()):
+                 b_initializer=tf.zeros_initializer(), trial_Input=None, bin_Input=None):
         """
+        If trial_Input [N x p] is provided, Input must be [N x T x r]. The layer
+        then acts on the concatenation of Input and trial_Input repeated over T,
+        without materializing the repetition, and returns [N x T x nodes].
+        
+        bin_Input [N x T x i] (e.g. external inputs) is concatenated after
+        trial_Input, so that the rows of the weights are ordered as [Input,
+        trial_Input, bin_Input].
         """
         nonlinearity = self.nl_dict[nl]
         input_dim = Input.get_shape()[-1]
+        if bin_Input is not None:
+            input_dim += bin_Input.get_shape()[-1]
+        if trial_Input is not None:
+            input_dim += trial_Input.get_shape()[-1]
         
         if self.collections:
             self.collections += [tf.GraphKeys.GLOBAL_VARIABLES, tf.GraphKeys.TRAINABLE_VARIABLES]
@@ -47,12 +56,31 @@ class FullLayer():
         with tf.variable_scope(scope or 'fullL'):
             self.weights = weights = variable_in_cpu('weights', [input_dim, nodes], 
                                                      initializer=initializer,
-                                                     collections=self.collections)
+                                                     collections=self.collections,
+                                                     dtype=Input.dtype)
             biases = variable_in_cpu('biases', [nodes],
                                      initializer=b_initializer,
-                                     collections=self.collections)
-            full = nonlinearity(tf.matmul(Input, weights) + biases,
-                                name=name)
+                                     collections=self.collections,
+                                     dtype=Input.dtype)
+            if trial_Input is None and bin_Input is None:
+                full = nonlinearity(tf.matmul(Input, weights) + biases,
+                                    name=name)
+            else:
+                r = Input.get_shape().as_list()[-1]
+                p = trial_Input.get_shape().as_list()[-1] if trial_Input is not None else 0
+                shape = tf.shape(Input)
+                Input_NTxr = tf.reshape(Input, [-1, r])
+                out_NTxn = tf.matmul(Input_NTxr, weights[:r])
+                if bin_Input is not None:
+                    i = bin_Input.get_shape().as_list()[-1]
+                    out_NTxn += tf.matmul(tf.reshape(bin_Input, [-1, i]), weights[r+p:r+p+i])
+                out_NxTxn = tf.reshape(out_NTxn, [shape[0], shape[1], nodes])
+                if trial_Input is None:
+                    full = nonlinearity(out_NxTxn + biases, name=name)
+                else:
+                    trial_out_Nx1xn = tf.expand_dims(tf.matmul(trial_Input, weights[r:r+p]) +
+                                                     biases, 1)
+                    full = nonlinearity(out_NxTxn + trial_out_Nx1xn, name=name)
                     
         return full
     
@@ -0,0 +1,194 @@
+# Copyright 2018 Daniel Hernandez Diaz, Columbia University
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+# ==============================================================================
+"""
+NumPy/SciPy backend for the Gaussian smoothing step of the recognition model.
+It does not import tensorflow, so it can be used for offline analyses without
+paying for a session.run per call. All functions are vectorized across trials
+and give the same results as their counterparts in utils.py and
+RecognitionModels.py.
+"""
+import numpy as np
+from scipy.linalg import cholesky_banded, solve_banded, solveh_banded
+
+
+def blk_tridiag_chol(A_NxTxdxd, B_NxTm1xdxd):
+    """
+    Compute the Cholesky decompositions of N symmetric, positive definite
+    block-tridiagonal matrices. Same as `utils.blk_tridiag_chol_batch`.
+
+    The N matrices are factored together by a single banded Cholesky, see
+    `blk_tridiag_to_banded`, and the blocks are read off the band.
+
+    Inputs:
+    A - [N x T x n x n]   array of block diagonals
+    B - [N x T-1 x n x n] array of (upper) 1st block off-diagonals
+
+    Outputs:
+    R - python list with two elements
+        * R[0] - [N x T x n x n] array of block diagonal elements of Cholesky
+        * R[1] - [N x T-1 x n x n] array of (lower) 1st block off-diagonal
+        elements of Cholesky
+    """
+    Nsamps, NTbins, xDim = A_NxTxdxd.shape[0], A_NxTxdxd.shape[1], A_NxTxdxd.shape[2]
+    cb = cholesky_banded(blk_tridiag_to_banded(A_NxTxdxd, B_NxTm1xdxd), lower=True,
+                         check_finite=False)
+
+    # cb[i-j, j] = L[i, j]
+    rows, cols = np.tril_indices(xDim)
+    blocks = np.arange(Nsamps*NTbins)
+    AChol_NTxdxd = np.zeros([Nsamps*NTbins, xDim, xDim], dtype=A_NxTxdxd.dtype)
+    AChol_NTxdxd[:, rows, cols] = cb[rows - cols, blocks[:,None]*xDim + cols]
+    rows, cols = np.indices([xDim, xDim]).reshape(2, -1)
+    blocks = ( np.arange(Nsamps)[:,None]*NTbins + np.arange(NTbins-1) ).flatten()
+    BChol_NTm1xdxd = np.zeros([Nsamps*(NTbins-1), xDim, xDim], dtype=B_NxTm1xdxd.dtype)
+    BChol_NTm1xdxd[:, rows, cols] = cb[xDim + rows - cols, blocks[:,None]*xDim + cols]
+
+    return [AChol_NTxdxd.reshape(A_NxTxdxd.shape), BChol_NTm1xdxd.reshape(B_NxTm1xdxd.shape)]
+
+
+def blk_chol_inv(A_NxTxdxd, B_NxTm1xdxd, b_NxTxd, lower=True, transpose=False):
+    """
+    Solve the equations Cx = b for N block-bidiagonal triangular matrices C.
+    Same as `utils.blk_chol_inv_batch`. All the trials go through a single
+    banded solve, see `blk_bidiag_to_banded`.
+
+    Inputs:
+    A - [N x T x n x n]   array of (lower triangular) block diagonals
+    B - [N x T-1 x n x n] array of (upper or lower) 1st block off-diagonals
+    b - [N x T x n] array of right-hand sides
+
+    lower, transpose - see `utils.blk_chol_inv`
+
+    Outputs:
+    x - [N x T x n] array, solution of Cx = b for every trial
+    """
+    if transpose:
+        A_NxTxdxd = np.swapaxes(A_NxTxdxd, 2, 3)
+        B_NxTm1xdxd = np.swapaxes(B_NxTm1xdxd, 2, 3)
+
+    l_and_u, ab = blk_bidiag_to_banded(A_NxTxdxd, B_NxTm1xdxd, lower=lower)
+    x = solve_banded(l_and_u, ab, b_NxTxd.reshape(-1), check_finite=False)
+    return x.reshape(b_NxTxd.shape)
+
+
+def blk_bidiag_to_banded(A_NxTxdxd, B_NxTm1xdxd, lower=True):
+    """
+    Packs N block-bidiagonal matrices, with B on the lower (upper if
+    lower=False) 1st block off-diagonal, into the (l, u) banded storage used
+    by scipy.linalg.solve_banded (ab[u+i-j, j] = M[i, j]). As in
+    `blk_tridiag_to_banded`, the N trials are laid one after the other.
+
+    Returns:
+        (l, u), ab: The lower and upper bandwidths and the band
+    """
+    Nsamps, NTbins, xDim = A_NxTxdxd.shape[0], A_NxTxdxd.shape[1], A_NxTxdxd.shape[2]
+    l, u = (2*xDim - 1, xDim - 1) if lower else (xDim - 1, 2*xDim - 1)
+    ab = np.zeros([l + u + 1, Nsamps*NTbins*xDim], dtype=A_NxTxdxd.dtype)
+
+    rows, cols = np.indices([xDim, xDim]).reshape(2, -1)
+    blocks = np.arange(Nsamps*NTbins)
+    ab[u + rows - cols, blocks[:,None]*xDim + cols] = (
+        A_NxTxdxd.reshape(-1, xDim, xDim)[:, rows, cols] )
+
+    # B_t is the block (t+1, t) if lower, (t, t+1) otherwise
+    blocks = ( np.arange(Nsamps)[:,None]*NTbins + np.arange(NTbins-1) ).flatten()
+    B_NTm1xd2 = B_NxTm1xdxd.reshape(-1, xDim, xDim)[:, rows, cols]
+    if lower:
+        ab[u + xDim + rows - cols, blocks[:,None]*xDim + cols] = B_NTm1xd2
+    else:
+        ab[u - xDim + rows - cols, (blocks[:,None] + 1)*xDim + cols] = B_NTm1xd2
+
+    return (l, u), ab
+
+
+def blk_tridiag_to_banded(A_NxTxdxd, B_NxTm1xdxd):
+    """
+    Packs N block-tridiagonal matrices into the lower banded storage used by
+    scipy.linalg (ab[i-j, j] = M[i, j]). The N trials are laid one after the
+    other as a single block-diagonal matrix of size N*T*d with bandwidth 2d-1,
+    so that a single banded factorization handles all of them.
+    """
+    Nsamps, NTbins, xDim = A_NxTxdxd.shape[0], A_NxTxdxd.shape[1], A_NxTxdxd.shape[2]
+    ab = np.zeros([2*xDim, Nsamps*NTbins*xDim], dtype=A_NxTxdxd.dtype)
+
+    # The lower triangles of the diagonal blocks
+    rows, cols = np.tril_indices(xDim)
+    blocks = np.arange(Nsamps*NTbins)
+    ab[rows - cols, blocks[:,None]*xDim + cols] = A_NxTxdxd.reshape(-1, xDim, xDim)[:, rows, cols]
+
+    # The lower off-diagonal blocks, that is B^T, for all but the last time
+    # bin of every trial.
+    rows, cols = np.indices([xDim, xDim]).reshape(2, -1)
+    blocks = ( np.arange(Nsamps)[:,None]*NTbins + np.arange(NTbins-1) ).flatten()
+    ab[xDim + rows - cols, blocks[:,None]*xDim + cols] = (
+        B_NxTm1xdxd.reshape(-1, xDim, xDim)[:, cols, rows] )
+
+    return ab
+
+
+def blk_tridiag_solve(A_NxTxdxd, B_NxTm1xdxd, b_NxTxd):
+    """
+    Solves Mx = b for N symmetric, positive definite block-tridiagonal
+    matrices M with a single banded Cholesky solve.
+    """
+    ab = blk_tridiag_to_banded(A_NxTxdxd, B_NxTm1xdxd)
+    x = solveh_banded(ab, b_NxTxd.reshape(-1), lower=True, check_finite=False)
+    return x.reshape(b_NxTxd.shape)
+
+
+def compute_precision(Lambda_NxTxdxd, A_NxTxdxd, QInv_dxd, Q0Inv_dxd, use_transpose_trick=True):
+    """
+    Assembles the blocks of the posterior precision exactly as
+    `SmoothingNLDSTimeSeries._compute_TheChol` does.
+
+    Args:
+        Lambda_NxTxdxd: The precision from the recognition network
+        A_NxTxdxd: The evolution matrices A(x_t)
+        QInv_dxd, Q0Inv_dxd: The inverse covariances of the evolution noise and
+            of the initial point
+
+    Returns:
+        AA_NxTxdxd, BB_NxTm1xdxd: The diagonal and upper off-diagonal blocks
+    """
+    A_NxTm1xdxd = A_NxTxdxd[:,:-1]
+    At_NxTm1xdxd = np.swapaxes(A_NxTm1xdxd, 2, 3)
+    if use_transpose_trick:
+        AQInvsA_NxTm1xdxd = np.matmul(At_NxTm1xdxd, np.matmul(QInv_dxd, A_NxTm1xdxd))
+        BB_NxTm1xdxd = -np.matmul(At_NxTm1xdxd, QInv_dxd)
+    else:
+        AQInvsA_NxTm1xdxd = np.matmul(A_NxTm1xdxd, np.matmul(QInv_dxd, At_NxTm1xdxd))
+        BB_NxTm1xdxd = -np.matmul(A_NxTm1xdxd, QInv_dxd)
+
+    # Qt^-1 = diag{Q0^-1, Q^-1, ..., Q^-1} on the first T-1 blocks. The last
+    # block does not depend on A.
+    AQInvsA_NxTm1xdxd[:,0] += Q0Inv_dxd
+    AQInvsA_NxTm1xdxd[:,1:] += QInv_dxd
+    AQInvsAQInv_NxTxdxd = np.concatenate(
+        [AQInvsA_NxTm1xdxd, np.broadcast_to(QInv_dxd, AQInvsA_NxTm1xdxd[:,:1].shape)], axis=1)
+    AA_NxTxdxd = Lambda_NxTxdxd + AQInvsAQInv_NxTxdxd
+
+    return AA_NxTxdxd, BB_NxTm1xdxd
+
+
+def compute_postX(Lambda_NxTxdxd, LambdaMu_NxTxd, A_NxTxdxd, QInv_dxd, Q0Inv_dxd,
+                  use_transpose_trick=True):
+    """
+    Computes the posterior mean postX = (Lambda + S(A))^{-1}*LambdaMu without
+    the gradient term, i.e. `SmoothingNLDSTimeSeries.postX_ng_NxTxd`.
+    """
+    AA_NxTxdxd, BB_NxTm1xdxd = compute_precision(Lambda_NxTxdxd, A_NxTxdxd, QInv_dxd, Q0Inv_dxd,
+                                                 use_transpose_trick=use_transpose_trick)
+    return blk_tridiag_solve(AA_NxTxdxd, BB_NxTm1xdxd, LambdaMu_NxTxd)
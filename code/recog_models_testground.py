@@ -27,9 +27,9 @@ def FullLayer(Input, nodes, input_dim=None, nl='softplus'):
     nonlinearity = nl_dict[nl]
     
     weights_full1 = variable_in_cpu('weights', [input_dim, nodes], 
-                          initializer=tf.random_normal_initializer())
+                          initializer=tf.random_normal_initializer(), dtype=Input.dtype)
     biases_full1 = variable_in_cpu('biases', [nodes], 
-                             initializer=tf.constant_initializer())
+                             initializer=tf.constant_initializer(), dtype=Input.dtype)
     full = nonlinearity(tf.matmul(Input, weights_full1) + biases_full1,
                           name='full1')
     return full
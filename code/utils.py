@@ -17,13 +17,145 @@ import numpy as np
 
 import tensorflow as tf
 
-DTYPE = tf.float32
+# The numeric precision of the model, set by params.dtype. The first element is
+# the dtype of all placeholders, variables and network layers, the second one
+# that of the block-tridiagonal factorizations and log-determinants. 'mixed'
+# keeps the networks in float32 but factorizes in float64.
+DTYPES = {'float32' : (tf.float32, tf.float32),
+          'float64' : (tf.float64, tf.float64),
+          'mixed' : (tf.float32, tf.float64)}
 
-def variable_in_cpu(name, shape, initializer, collections=None):
+def get_dtypes(params):
     """
+    Returns the pair (dtype, factorization dtype) corresponding to params.dtype.
+    Defaults to float32 throughout.
+    """
+    return DTYPES[params.dtype] if hasattr(params, 'dtype') else DTYPES['float32']
+
+# Block sizes for which the d x d kernels below are unrolled into elementwise
+# ops. For such tiny blocks, the fixed cost per call of the batched linear
+# algebra ops is what dominates.
+SMALL_DIMS = (2, 3)
+
+def _small_dim(*Ms):
+    """
+    Returns the block size d if it is statically known and in SMALL_DIMS for
+    all the square matrices Ms, None otherwise.
+    """
+    dims = set(tuple(tf.convert_to_tensor(M).get_shape().as_list()[-2:]) for M in Ms)
+    if len(dims) != 1: return None
+    d, d2 = dims.pop()
+    return d if d == d2 and d in SMALL_DIMS else None
+
+def chol_dxd(M_dxd):
+    """
+    Batched Cholesky factor of d x d positive definite matrices. Unrolled into
+    elementwise ops (Cholesky-Banachiewicz) for d in SMALL_DIMS.
+    """
+    d = _small_dim(M_dxd)
+    if d is None: return tf.cholesky(M_dxd)
+    
+    M = [[M_dxd[...,i,j] for j in range(d)] for i in range(d)]
+    L = [[tf.zeros_like(M[0][0])]*d for _ in range(d)]
+    for j in range(d):
+        L[j][j] = tf.sqrt(M[j][j] - sum(L[j][k]**2 for k in range(j)))
+        for i in range(j+1, d):
+            L[i][j] = (M[i][j] - sum(L[i][k]*L[j][k] for k in range(j)))/L[j][j]
+    return tf.stack([tf.stack(row, axis=-1) for row in L], axis=-2)
+
+def tri_solve_dxd(L_dxd, rhs_dxk, adjoint=False):
+    """
+    Batched solution of L*X = rhs (or L^T*X = rhs if adjoint) for lower
+    triangular d x d matrices L. Unrolled into elementwise forward (backward)
+    substitution for d in SMALL_DIMS.
+    """
+    d = _small_dim(L_dxd)
+    if d is None: return tf.matrix_triangular_solve(L_dxd, rhs_dxk, lower=True, adjoint=adjoint)
+    
+    # The (i,j) entry of L or L^T, ready to broadcast against a row of rhs
+    entry = lambda i, j : tf.expand_dims(L_dxd[...,j,i] if adjoint else L_dxd[...,i,j], -1)
+    X = [None]*d
+    for i in (range(d-1, -1, -1) if adjoint else range(d)):
+        X[i] = ( (rhs_dxk[...,i,:] - sum(entry(i, j)*X[j] for j in range(d) if X[j] is not None))/
+                 entry(i, i) )
+    return tf.stack(X, axis=-2)
+
+def matmul_dxd(a_dxd, b_dxk, transpose_a=False, transpose_b=False):
+    """
+    Batched product of d x d matrices a with d x k matrices b. For d in
+    SMALL_DIMS it is computed as a broadcast product and a sum instead of a
+    batched matmul.
+    """
+    if _small_dim(a_dxd) is None:
+        return tf.matmul(a_dxd, b_dxk, transpose_a=transpose_a, transpose_b=transpose_b)
+    
+    if transpose_a: a_dxd = tf.matrix_transpose(a_dxd)
+    if transpose_b: b_dxk = tf.matrix_transpose(b_dxk)
+    return tf.reduce_sum(tf.expand_dims(a_dxd, -1)*tf.expand_dims(b_dxk, -3), axis=-2)
+
+def lower_chol_variable(name, dim, init_scale, dtype, trainable=True, structure='full'):
+    """
+    A dim x dim lower triangular factor L with a positive diagonal, to be used
+    as the Cholesky factor of L*L^T. It is parameterized by the log of its
+    diagonal (name+'_logdiag', initialized to log(init_scale)) and, for the
+    'full' structure, by the entries below the diagonal (name+'_offdiag',
+    initialized to zero). L*L^T is then positive definite for any value of the
+    variables, and its log-determinant is just 2*sum(logdiag). dtype is the
+    model dtype, see `get_dtypes`.
+    
+    structure is one of
+    
+        'full'      : L lower triangular
+        'diagonal'  : L diagonal, d free entries
+        'isotropic' : L a multiple of the identity, a single scalar variable
+    
+    Returns:
+        L_dxd, logdiag_d
+    """
+    if structure not in ['full', 'diagonal', 'isotropic']:
+        raise ValueError("Unknown structure {}".format(structure))
+    logdiag_shape = [] if structure == 'isotropic' else [dim]
+    logdiag = tf.get_variable(name + '_logdiag',
+                              initializer=tf.constant(np.full(logdiag_shape, np.log(init_scale)),
+                                                      dtype=dtype),
+                              trainable=trainable)
+    logdiag_d = logdiag*tf.ones([dim], dtype=dtype) if structure == 'isotropic' else logdiag
+    if structure != 'full':
+        return tf.matrix_diag(tf.exp(logdiag_d), name=name), logdiag_d
+    
+    offdiag_dxd = tf.get_variable(name + '_offdiag', initializer=tf.zeros([dim, dim], dtype=dtype),
+                                  trainable=trainable)
+    L_dxd = tf.matrix_set_diag(tf.matrix_band_part(offdiag_dxd, -1, 0), tf.exp(logdiag_d),
+                               name=name)
+    return L_dxd, logdiag_d
+
+def is_diagonal(M):
+    """
+    Whether the constant matrix M is given by its [d] diagonal instead of as a
+    d x d matrix.
+    """
+    return M.get_shape().ndims == 1
+
+def apply_to_nonzero_rows(fn, X_Mxi):
+    """
+    Returns fn(X) for a row-wise map fn and a batch of rows X that is expected
+    to be mostly zeros, e.g. absent inputs. fn runs on the nonzero rows only,
+    plus once on a single zero row whose output is broadcast to all the zero
+    rows. The static last dimension of X must be known.
+    """
+    iDim = X_Mxi.get_shape().as_list()[-1]
+    idxs_nx1 = tf.where(tf.reduce_any(tf.not_equal(X_Mxi, 0.0), axis=1))
+    fn0_1xk = fn(tf.zeros([1, iDim], dtype=X_Mxi.dtype))
+    fn_nxk = fn(tf.gather_nd(X_Mxi, idxs_nx1))
+    shape = tf.cast(tf.concat([tf.shape(X_Mxi)[:1], tf.shape(fn0_1xk)[1:]], axis=0), tf.int64)
+    return fn0_1xk + tf.scatter_nd(idxs_nx1, fn_nxk - fn0_1xk, shape) # Broadcast
+
+def variable_in_cpu(name, shape, initializer, dtype, collections=None):
+    """
+    A variable pinned to the CPU. dtype is the model dtype, see `get_dtypes`.
     """
     with tf.device('/cpu:0'):
-        var = tf.get_variable(name, shape, dtype=DTYPE, initializer=initializer,
+        var = tf.get_variable(name, shape, dtype=dtype, initializer=initializer,
                               collections=collections)
     return var
 
@@ -43,26 +175,124 @@ def blk_tridiag_chol(A_Txdxd, B_Tm1xdxd):
         * R[0] - [T x n x n] tensor of block diagonal elements of Cholesky decomposition
         * R[1] - [T-1 x n x n] tensor of (lower) 1st block off-diagonal elements of Cholesky
     """
-    def compute_chol(LC, AB_2xdxd):
-        L_dxd = LC[0]
-        A_dxd, B_dxd = AB_2xdxd[0], AB_2xdxd[1]
-        C_dxd = tf.matmul(B_dxd, tf.matrix_inverse(L_dxd), 
-                      transpose_a=True, transpose_b=True)
-        D = A_dxd - tf.matmul(C_dxd, C_dxd, transpose_b=True)
-        L_dxd = tf.cholesky(D)
-        return [L_dxd, C_dxd]
-        
-    L1_dxd = tf.cholesky(A_Txdxd[0])
-    C1_dxd = tf.zeros_like(B_Tm1xdxd[0], dtype=DTYPE)
+    AChol_1xTxdxd, BChol_1xTm1xdxd = blk_tridiag_chol_batch(tf.expand_dims(A_Txdxd, 0),
+                                                            tf.expand_dims(B_Tm1xdxd, 0))
+    return [AChol_1xTxdxd[0], BChol_1xTm1xdxd[0]]
+
+
+def blk_tridiag_chol_batch(A_NxTxdxd, B_NxTm1xdxd):
+    """
+    Batched version of `blk_tridiag_chol`. Computes the Cholesky decompositions
+    of N block-tridiagonal matrices at once with a single scan over time. At
+    every time step, the N trials are handled together with batched matmuls.
+
+    Inputs:
+    A - [N x T x n x n]   tensor, where each A[k,i,:,:] is the ith block diagonal
+        matrix of the kth trial
+    B - [N x T-1 x n x n] tensor, where each B[k,i,:,:] is the ith (upper) 1st
+        block off-diagonal matrix of the kth trial
+
+    Outputs: 
+    R - python list with two elements
+        * R[0] - [N x T x n x n] tensor of block diagonal elements of Cholesky
+        decomposition
+        * R[1] - [N x T-1 x n x n] tensor of (lower) 1st block off-diagonal
+        elements of Cholesky
+    """
+    def compute_chol(LC, AB_2xNxdxd):
+        L_Nxdxd = LC[0]
+        A_Nxdxd, B_Nxdxd = AB_2xNxdxd[0], AB_2xNxdxd[1]
+        # C = B^T*L^{-T}, obtained as the transpose of the triangular solve
+        # L*C^T = B. No explicit inverse of L is ever formed.
+        C_Nxdxd = tf.matrix_transpose(tri_solve_dxd(L_Nxdxd, B_Nxdxd))
+        D = A_Nxdxd - matmul_dxd(C_Nxdxd, C_Nxdxd, transpose_b=True)
+        L_Nxdxd = chol_dxd(D)
+        return [L_Nxdxd, C_Nxdxd]
+    
+    # Put time first so that tf.scan runs over it
+    A_TxNxdxd = tf.transpose(A_NxTxdxd, [1,0,2,3])
+    B_Tm1xNxdxd = tf.transpose(B_NxTm1xdxd, [1,0,2,3])
     
-    result_2xTm1xdxd = tf.scan(fn=compute_chol, elems=[A_Txdxd[1:], B_Tm1xdxd],
-                               initializer=[L1_dxd, C1_dxd])
+    L1_Nxdxd = chol_dxd(A_TxNxdxd[0])
+    C1_Nxdxd = tf.zeros_like(B_Tm1xNxdxd[0])
+    
+    result_2xTm1xNxdxd = tf.scan(fn=compute_chol, elems=[A_TxNxdxd[1:], B_Tm1xNxdxd],
+                                 initializer=[L1_Nxdxd, C1_Nxdxd])
 
-    AChol_Txdxd = tf.concat([tf.expand_dims(L1_dxd, 0), result_2xTm1xdxd[0]], 
-                            axis=0)    
-    BChol_Tm1xdxd = result_2xTm1xdxd[1]
+    AChol_TxNxdxd = tf.concat([tf.expand_dims(L1_Nxdxd, 0), result_2xTm1xNxdxd[0]], 
+                              axis=0)    
+    AChol_NxTxdxd = tf.transpose(AChol_TxNxdxd, [1,0,2,3])
+    BChol_NxTm1xdxd = tf.transpose(result_2xTm1xNxdxd[1], [1,0,2,3])
     
-    return [AChol_Txdxd, BChol_Tm1xdxd]
+    return [AChol_NxTxdxd, BChol_NxTm1xdxd]
+
+
+def blk_tridiag_chol_shared(A_NxTxdxd, B_dxd, steady_state_tol=None):
+    """
+    Same as `blk_tridiag_chol_batch` for N block-tridiagonal matrices whose
+    upper off-diagonal blocks are all equal to B_dxd, as in the precision of a
+    linear-Gaussian state-space model. Requires T >= 2.
+    
+    The diagonal blocks of the factor follow the Riccati recursion
+    
+    L_t*L_t^T = A_t - B^T*(L_{t-1}*L_{t-1}^T)^{-1}*B
+    
+    If steady_state_tol is not None, the diagonal blocks A_t must moreover be
+    the same for 0 < t < T-1. The recursion then converges to a steady state,
+    and it is stopped as soon as consecutive factors differ by less than
+    steady_state_tol. The converged L and C = B^T*L^{-T} are reused for the
+    remaining time bins, so that the cost of the factorization no longer grows
+    with T. The last block is always computed.
+    
+    Outputs:
+        See `blk_tridiag_chol_batch`
+    """
+    Nsamps = tf.shape(A_NxTxdxd)[0]
+    NTbins = tf.shape(A_NxTxdxd)[1]
+    B_Nxdxd = tf.tile(tf.expand_dims(B_dxd, 0), [Nsamps, 1, 1])
+    def compute_chol(LC, A_Nxdxd):
+        C_Nxdxd = tf.matrix_transpose(tri_solve_dxd(LC[0], B_Nxdxd))
+        L_Nxdxd = chol_dxd(A_Nxdxd - matmul_dxd(C_Nxdxd, C_Nxdxd, transpose_b=True))
+        return [L_Nxdxd, C_Nxdxd]
+    
+    A_TxNxdxd = tf.transpose(A_NxTxdxd, [1,0,2,3])
+    L1_Nxdxd = chol_dxd(A_TxNxdxd[0])
+    if steady_state_tol is None:
+        L_Tm1xNxdxd, C_Tm1xNxdxd = tf.scan(fn=compute_chol, elems=A_TxNxdxd[1:],
+                                           initializer=[L1_Nxdxd, tf.zeros_like(B_Nxdxd)])
+    else:
+        Ass_Nxdxd = A_TxNxdxd[1]
+        def step(t, L_Nxdxd, delta, Ls, Cs):
+            Lnext_Nxdxd, C_Nxdxd = compute_chol([L_Nxdxd], Ass_Nxdxd)
+            return [t + 1, Lnext_Nxdxd, tf.reduce_max(tf.abs(Lnext_Nxdxd - L_Nxdxd)),
+                    Ls.write(t, Lnext_Nxdxd), Cs.write(t, C_Nxdxd)]
+        Ls = tf.TensorArray(A_NxTxdxd.dtype, size=0, dynamic_size=True, infer_shape=False)
+        Cs = tf.TensorArray(A_NxTxdxd.dtype, size=0, dynamic_size=True, infer_shape=False)
+        t_ss, Lss_Nxdxd, _, Ls, Cs = tf.while_loop(
+            lambda t, L, delta, Ls, Cs : tf.logical_and(t < NTbins-2, delta > steady_state_tol),
+            step, loop_vars=[tf.constant(0), L1_Nxdxd,
+                             tf.constant(np.inf, dtype=A_NxTxdxd.dtype), Ls, Cs])
+        
+        # The steady state for the remaining bins, if any, and the last block
+        Css_Nxdxd = tf.matrix_transpose(tri_solve_dxd(Lss_Nxdxd, B_Nxdxd))
+        num_ss = NTbins - 2 - t_ss
+        Llast_Nxdxd, Clast_Nxdxd = compute_chol([Lss_Nxdxd], A_TxNxdxd[-1])
+        # For T = 2 the loop makes no iteration and the TensorArrays are empty
+        shape_t_ssxNxdxd = tf.concat([[t_ss], tf.shape(B_Nxdxd)], 0)
+        stack = lambda TA : tf.cond(t_ss > 0,
+                                    lambda : tf.reshape(TA.stack(), shape_t_ssxNxdxd),
+                                    lambda : tf.zeros(shape_t_ssxNxdxd, dtype=A_NxTxdxd.dtype))
+        steady = lambda M_Nxdxd : tf.tile(tf.expand_dims(M_Nxdxd, 0), [num_ss, 1, 1, 1])
+        L_Tm1xNxdxd = tf.concat([stack(Ls), steady(Lss_Nxdxd), tf.expand_dims(Llast_Nxdxd, 0)],
+                                axis=0)
+        C_Tm1xNxdxd = tf.concat([stack(Cs), steady(Css_Nxdxd), tf.expand_dims(Clast_Nxdxd, 0)],
+                                axis=0)
+    
+    AChol_TxNxdxd = tf.concat([tf.expand_dims(L1_Nxdxd, 0), L_Tm1xNxdxd], axis=0)
+    AChol_NxTxdxd = tf.transpose(AChol_TxNxdxd, [1,0,2,3])
+    BChol_NxTm1xdxd = tf.transpose(C_Tm1xNxdxd, [1,0,2,3])
+    
+    return [AChol_NxTxdxd, BChol_NxTm1xdxd]
 
 
 def blk_chol_inv(A_Txdxd, B_Tm1xdxd, b_Txd, lower=True, transpose=False):
@@ -71,12 +301,16 @@ def blk_chol_inv(A_Txdxd, B_Tm1xdxd, b_Txd, lower=True, transpose=False):
     diagonal triangular matrix - only the first lower/upper off-diagonal block
     is nonvanishing.
     
+    The diagonal blocks A[i,:,:] must be lower triangular, as returned by
+    `blk_tridiag_chol`. Each step is then a triangular solve. 
+    
     This function will be used to solve the equation Mx = b where M is a
     block-tridiagonal matrix due to the fact that M = C^T*C where C is block-
     bidiagonal triangular.
     
     Inputs:
-    A - [T x n x n]   tensor, where each A[i,:,:] is the ith block diagonal matrix 
+    A - [T x n x n]   tensor, where each A[i,:,:] is the ith (lower triangular)
+        block diagonal matrix 
     B - [T-1 x n x n] tensor, where each B[i,:,:] is the ith (upper or lower) 
         1st block off-diagonal matrix
      
@@ -85,40 +319,816 @@ def blk_chol_inv(A_Txdxd, B_Tm1xdxd, b_Txd, lower=True, transpose=False):
     transpose (default: False) - boolean specifying whether to transpose the 
           off-diagonal blocks B[i,:,:] (useful if you want to compute solve 
           the problem C^T x = b with a representation of C.) 
+    
+    b may also be a [T x n x K] tensor of K stacked right-hand sides, which are
+    then all solved for in the same pass.
  
     Outputs: 
-    x - solution of Cx = b
+    x - solution of Cx = b, shaped like b
+    """
+    x_1xTxd = blk_chol_inv_batch(tf.expand_dims(A_Txdxd, 0), tf.expand_dims(B_Tm1xdxd, 0),
+                                 tf.expand_dims(b_Txd, 0), lower=lower, transpose=transpose)
+    return x_1xTxd[0]
+
+
+def _stack_rhs(b_NxTxd):
+    """
+    Returns the right-hand side b as a [N x T x n x K] tensor, and whether it
+    was a [N x T x n] tensor of single right-hand sides, in which case K = 1.
+    """
+    b_NxTxd = tf.convert_to_tensor(b_NxTxd)
+    is_vector = len(b_NxTxd.get_shape()) == 3
+    return (tf.expand_dims(b_NxTxd, axis=-1) if is_vector else b_NxTxd), is_vector
+
+
+def blk_chol_inv_batch(A_NxTxdxd, B_NxTm1xdxd, b_NxTxd, lower=True, transpose=False):
+    """
+    Batched version of `blk_chol_inv`. Solves the N equations C_k x_k = b_k,
+    one per trial, with a single scan over time.
+    
+    Inputs:
+    A - [N x T x n x n]   tensor of (lower triangular) block diagonals
+    B - [N x T-1 x n x n] tensor of (upper or lower) 1st block off-diagonals
+    b - [N x T x n] tensor of right-hand sides, or [N x T x n x K] tensor of K
+        stacked right-hand sides per trial
+    
+    lower, transpose - see `blk_chol_inv`
+    
+    Outputs: 
+    x - tensor shaped like b, solution of Cx = b for every trial
     """
-    # Define a matrix-vector dot product because the tensorflow developers feel
-    # this is beneath them.
-    tf_dot = lambda M, v : tf.reduce_sum(tf.multiply(M, v), axis=1)
+    b_NxTxdxK, is_vector = _stack_rhs(b_NxTxd)
+    # The diagonal blocks are never transposed explicitly. If transpose=True,
+    # the triangular solve is told to use their adjoint instead.
+    tri_solve = lambda L, v : tri_solve_dxd(L, v, adjoint=transpose)
     if transpose:
-        A_Txdxd = tf.transpose(A_Txdxd, [0,2,1])
-        B_Tm1xdxd = tf.transpose(B_Tm1xdxd, [0,2,1])
+        B_NxTm1xdxd = tf.transpose(B_NxTm1xdxd, [0,1,3,2])
+    
+    # Put time first so that tf.scan runs over it
+    A_TxNxdxd = tf.transpose(A_NxTxdxd, [1,0,2,3])
+    B_Tm1xNxdxd = tf.transpose(B_NxTm1xdxd, [1,0,2,3])
+    b_TxNxdxK = tf.transpose(b_NxTxdxK, [1,0,2,3])
     
     # Whether B is lower or upper doesn't matter. The function to be passed to
     # scan is the same.
-    def step(x_d, ABb_2x_):
-        A_dxd, B_dxd, b_d = ABb_2x_[0], ABb_2x_[1], ABb_2x_[2]
-        return tf_dot(tf.matrix_inverse(A_dxd),
-                         b_d - tf_dot(B_dxd, x_d))
+    def step(x_NxdxK, ABb_3x_):
+        A_Nxdxd, B_Nxdxd, b_NxdxK = ABb_3x_[0], ABb_3x_[1], ABb_3x_[2]
+        return tri_solve(A_Nxdxd, b_NxdxK - matmul_dxd(B_Nxdxd, x_NxdxK))
     if lower:
-        x0_d = tf_dot(tf.matrix_inverse(A_Txdxd[0]), b_Txd[0])
-        result_Tm1xd = tf.scan(fn=step, elems=[A_Txdxd[1:], B_Tm1xdxd, b_Txd[1:]], 
-                             initializer=x0_d)
-        result_Txd = tf.concat([tf.expand_dims(x0_d, axis=0), result_Tm1xd], axis=0)
+        x0_NxdxK = tri_solve(A_TxNxdxd[0], b_TxNxdxK[0])
+        result_Tm1xNxdxK = tf.scan(fn=step, elems=[A_TxNxdxd[1:], B_Tm1xNxdxd, b_TxNxdxK[1:]], 
+                                   initializer=x0_NxdxK)
+        result_TxNxdxK = tf.concat([tf.expand_dims(x0_NxdxK, axis=0), result_Tm1xNxdxK], axis=0)
     else:
-        xN_d = tf_dot(tf.matrix_inverse(A_Txdxd[-1]), b_Txd[-1])
-        result_Tm1xd = tf.scan(fn=step, 
-                             elems=[A_Txdxd[:-1][::-1], B_Tm1xdxd[::-1], b_Txd[:-1][::-1]],
-                             initializer=xN_d )
-        result_Txd = tf.concat([tf.expand_dims(xN_d, axis=0), result_Tm1xd],
-                               axis=0)[::-1]
+        xN_NxdxK = tri_solve(A_TxNxdxd[-1], b_TxNxdxK[-1])
+        result_Tm1xNxdxK = tf.scan(fn=step, 
+                                   elems=[A_TxNxdxd[:-1][::-1], B_Tm1xNxdxd[::-1],
+                                          b_TxNxdxK[:-1][::-1]],
+                                   initializer=xN_NxdxK)
+        result_TxNxdxK = tf.concat([tf.expand_dims(xN_NxdxK, axis=0), result_Tm1xNxdxK],
+                                   axis=0)[::-1]
+    
+    x_NxTxdxK = tf.transpose(result_TxNxdxK, [1,0,2,3])
+    return x_NxTxdxK[...,0] if is_vector else x_NxTxdxK
 
-    return result_Txd 
 
+def _parallel_prefix(combine, elems_Tx_):
+    """
+    Inclusive parallel prefix (Hillis-Steele) of a list of time-major tensors
+    under an associative operator. Runs in ceil(log2(T)) iterations of a
+    tf.while_loop, each of which combines every element with the one `offset`
+    steps behind it.
+    
+    Args:
+        combine: Function (earlier, later) -> combined, where each argument is
+            a list of tensors shaped like `elems_Tx_` (minus a leading slice).
+        elems_Tx_: List of tensors whose leading dimension is time.
+    """
+    NTbins = tf.shape(elems_Tx_[0])[0]
+    
+    def body(offset, xs):
+        combined = combine([x[:NTbins-offset] for x in xs], [x[offset:] for x in xs])
+        new_xs = [tf.concat([x[:offset], c], axis=0) for x, c in zip(xs, combined)]
+        return [2*offset, new_xs]
+    
+    shape_invariants = [tf.TensorShape([]),
+                        [tf.TensorShape([None]).concatenate(x.shape[1:]) for x in elems_Tx_]]
+    _, result = tf.while_loop(lambda offset, _ : offset < NTbins, body,
+                              loop_vars=[tf.constant(1), elems_Tx_],
+                              shape_invariants=shape_invariants)
+    return result
 
 
+def blk_tridiag_chol_parallel(A_NxTxdxd, B_NxTm1xdxd):
+    """
+    Parallel-in-time version of `blk_tridiag_chol_batch`. Same inputs and
+    outputs, but O(log T) sequential depth instead of O(T).
+    
+    The Schur complements D_t = L_t*L_t^T of the block Cholesky obey 
+    
+    D_t = f_t(D_{t-1}) = A_t - B_{t-1}^T*D_{t-1}^{-1}*B_{t-1}
+    
+    Maps of the form f(D) = P - R^T*(D + S)^{-1}*R are closed under
+    composition, so all the D_t are found with a parallel prefix over the
+    triples (P, R, S). The matrices inverted along the way are Schur
+    complements of principal submatrices, hence positive definite. The
+    Cholesky blocks then follow independently for every t.
+    """
+    A_TxNxdxd = tf.transpose(A_NxTxdxd, [1,0,2,3])
+    B_Tm1xNxdxd = tf.transpose(B_NxTm1xdxd, [1,0,2,3])
+    
+    # f_0 ignores its input: R_0 = 0.
+    R_TxNxdxd = tf.concat([tf.zeros_like(B_Tm1xNxdxd[:1]), B_Tm1xNxdxd], axis=0)
+    S_TxNxdxd = tf.zeros_like(A_TxNxdxd)
+    
+    def combine(f, g):
+        """
+        Returns the triple for g(f(D))
+        """
+        P1, R1, S1 = f
+        P2, R2, S2 = g
+        WChol = chol_dxd(P1 + S2)
+        cholesky_solve = lambda rhs : tri_solve_dxd(WChol, tri_solve_dxd(WChol, rhs),
+                                                    adjoint=True)
+        WInvR2 = cholesky_solve(R2)
+        WInvR1T = cholesky_solve(tf.matrix_transpose(R1))
+        P = P2 - matmul_dxd(R2, WInvR2, transpose_a=True)
+        R = matmul_dxd(R1, WInvR2)
+        S = S1 - matmul_dxd(R1, WInvR1T)
+        return [0.5*(P + tf.matrix_transpose(P)), R, 0.5*(S + tf.matrix_transpose(S))]
+    
+    D_TxNxdxd, _, _ = _parallel_prefix(combine, [A_TxNxdxd, R_TxNxdxd, S_TxNxdxd])
+    
+    L_TxNxdxd = chol_dxd(D_TxNxdxd)
+    C_Tm1xNxdxd = tf.matrix_transpose(tri_solve_dxd(L_TxNxdxd[:-1], B_Tm1xNxdxd))
+    AChol_NxTxdxd = tf.transpose(L_TxNxdxd, [1,0,2,3])
+    BChol_NxTm1xdxd = tf.transpose(C_Tm1xNxdxd, [1,0,2,3])
+    
+    return [AChol_NxTxdxd, BChol_NxTm1xdxd]
+
+
+def blk_chol_inv_parallel(A_NxTxdxd, B_NxTm1xdxd, b_NxTxd, lower=True, transpose=False):
+    """
+    Parallel-in-time version of `blk_chol_inv_batch`. Same inputs and outputs,
+    but O(log T) sequential depth instead of O(T).
+    
+    Block forward (or backward) substitution is the affine recursion
+    
+    x_t = M_t*x_{t-1} + v_t,    M_t = -A_t^{-1}*B_{t-1},  v_t = A_t^{-1}*b_t
+    
+    whose steps compose associatively. Hence all x_t are found with a
+    parallel prefix over the pairs (M_t, v_t).
+    """
+    b_NxTxdxK, is_vector = _stack_rhs(b_NxTxd)
+    if transpose:
+        B_NxTm1xdxd = tf.transpose(B_NxTm1xdxd, [0,1,3,2])
+    
+    A_TxNxdxd = tf.transpose(A_NxTxdxd, [1,0,2,3])
+    B_Tm1xNxdxd = tf.transpose(B_NxTm1xdxd, [1,0,2,3])
+    b_TxNxdxK = tf.transpose(b_NxTxdxK, [1,0,2,3])
+    if not lower:
+        # Solve backwards in time. Reversing everything turns it into a
+        # forward solve.
+        A_TxNxdxd, B_Tm1xNxdxd, b_TxNxdxK = A_TxNxdxd[::-1], B_Tm1xNxdxd[::-1], b_TxNxdxK[::-1]
+    
+    M_Tm1xNxdxd = -tri_solve_dxd(A_TxNxdxd[1:], B_Tm1xNxdxd, adjoint=transpose)
+    M_TxNxdxd = tf.concat([tf.zeros_like(A_TxNxdxd[:1]), M_Tm1xNxdxd], axis=0)
+    v_TxNxdxK = tri_solve_dxd(A_TxNxdxd, b_TxNxdxK, adjoint=transpose)
+    
+    def combine(f, g):
+        """
+        Returns the pair for the step g after the step f
+        """
+        M1, v1 = f
+        M2, v2 = g
+        return [matmul_dxd(M2, M1), matmul_dxd(M2, v1) + v2]
+    
+    _, x_TxNxdxK = _parallel_prefix(combine, [M_TxNxdxd, v_TxNxdxK])
+    if not lower:
+        x_TxNxdxK = x_TxNxdxK[::-1]
+    
+    x_NxTxdxK = tf.transpose(x_TxNxdxK, [1,0,2,3])
+    return x_NxTxdxK[...,0] if is_vector else x_NxTxdxK
+
+
+def _chol_grad(L_Nxdxd, Lbar_Nxdxd):
+    """
+    Backpropagates the (batched) gradient Lbar with respect to the Cholesky
+    factor L = chol(A) to a symmetric gradient with respect to A. Same as
+    tensorflow's gradient for tf.cholesky, with triangular solves instead of
+    the inverse of L. The upper triangle of Lbar is ignored.
+    """
+    middle = matmul_dxd(L_Nxdxd, Lbar_Nxdxd, transpose_a=True)
+    middle = tf.matrix_set_diag(middle, 0.5*tf.matrix_diag_part(middle))
+    middle = tf.matrix_band_part(middle, -1, 0)
+    # L^{-T}*middle*L^{-1}
+    X_Nxdxd = tri_solve_dxd(L_Nxdxd, middle, adjoint=True)
+    X_Nxdxd = tf.matrix_transpose(tri_solve_dxd(L_Nxdxd, tf.matrix_transpose(X_Nxdxd),
+                                                adjoint=True))
+    return 0.5*(X_Nxdxd + tf.matrix_transpose(X_Nxdxd))
+
+
+def blk_tridiag_chol_grad(AChol_NxTxdxd, BChol_NxTm1xdxd, ACholbar_NxTxdxd, BCholbar_NxTm1xdxd):
+    """
+    Reverse-mode gradient of `blk_tridiag_chol_batch`. Takes the Cholesky
+    factor and the gradients with respect to it, returns the gradients with
+    respect to the blocks A, B of the original matrix.
+    
+    The forward recursion is
+    
+    C_t = B_{t-1}^T*L_{t-1}^{-T},   L_t = chol(A_t - C_t*C_t^T)
+    
+    so the adjoints are propagated backwards in time with a single scan whose
+    only input is the factor itself. No intermediate of the forward pass is
+    needed.
+    """
+    L_TxNxdxd = tf.transpose(AChol_NxTxdxd, [1,0,2,3])
+    C_Tm1xNxdxd = tf.transpose(BChol_NxTm1xdxd, [1,0,2,3])
+    Lbar_TxNxdxd = tf.transpose(ACholbar_NxTxdxd, [1,0,2,3])
+    Cbar_Tm1xNxdxd = tf.transpose(BCholbar_NxTm1xdxd, [1,0,2,3])
+    
+    def step(AbBbLb, elems_5xNxdxd):
+        L_Nxdxd, Lprev_Nxdxd, C_Nxdxd, Cbar_Nxdxd, Lbar_Nxdxd = elems_5xNxdxd
+        # Add the contribution to Lbar_t coming from C_{t+1}
+        Lbar_Nxdxd = Lbar_Nxdxd + AbBbLb[2]
+        Abar_Nxdxd = _chol_grad(L_Nxdxd, Lbar_Nxdxd)
+        Cbar_Nxdxd = Cbar_Nxdxd - 2.0*matmul_dxd(Abar_Nxdxd, C_Nxdxd)
+        # Bbar = L_{t-1}^{-T}*Cbar^T
+        Bbar_Nxdxd = tri_solve_dxd(Lprev_Nxdxd, tf.matrix_transpose(Cbar_Nxdxd), adjoint=True)
+        return [Abar_Nxdxd, Bbar_Nxdxd, -matmul_dxd(Bbar_Nxdxd, C_Nxdxd)]
+    
+    zeros_Nxdxd = tf.zeros_like(L_TxNxdxd[0])
+    result_3xTm1xNxdxd = tf.scan(fn=step, 
+                                 elems=[L_TxNxdxd[1:][::-1], L_TxNxdxd[:-1][::-1],
+                                        C_Tm1xNxdxd[::-1], Cbar_Tm1xNxdxd[::-1],
+                                        Lbar_TxNxdxd[1:][::-1]],
+                                 initializer=[zeros_Nxdxd, zeros_Nxdxd, zeros_Nxdxd])
+    Abar1_Nxdxd = _chol_grad(L_TxNxdxd[0], Lbar_TxNxdxd[0] + result_3xTm1xNxdxd[2][-1])
+    
+    Abar_TxNxdxd = tf.concat([tf.expand_dims(Abar1_Nxdxd, 0), result_3xTm1xNxdxd[0][::-1]],
+                             axis=0)
+    Abar_NxTxdxd = tf.transpose(Abar_TxNxdxd, [1,0,2,3])
+    Bbar_NxTm1xdxd = tf.transpose(result_3xTm1xNxdxd[1][::-1], [1,0,2,3])
+    
+    return [Abar_NxTxdxd, Bbar_NxTm1xdxd]
+
+
+def blk_chol_inv_grad(A_NxTxdxd, B_NxTm1xdxd, x_NxTxd, xbar_NxTxd, lower=True,
+                      transpose=False, inv_fn=blk_chol_inv_batch):
+    """
+    Reverse-mode gradient of `blk_chol_inv_batch`. For x = C^{-1}b, 
+    
+    bbar = C^{-T}*xbar,     Cbar = -bbar*x^T
+    
+    restricted to the blocks of C. C^T is represented by the same A, B with
+    both `lower` and `transpose` flipped, so bbar is one more block solve.
+    Only the solution x is needed.
+    
+    Returns:
+        [Abar, Bbar, bbar]
+    """
+    bbar_NxTxd = inv_fn(A_NxTxdxd, B_NxTm1xdxd, xbar_NxTxd, lower=not lower,
+                        transpose=not transpose)
+    # Sum of the outer products of the columns of u and v (the K stacked
+    # right-hand sides)
+    outer = lambda u, v : tf.reduce_sum(tf.expand_dims(u, axis=-2)*tf.expand_dims(v, axis=-3),
+                                        axis=-1)
+    bbar_NxTxdxK, _ = _stack_rhs(bbar_NxTxd)
+    x_NxTxdxK, _ = _stack_rhs(x_NxTxd)
+    
+    Cbar_NxTxdxd = -outer(bbar_NxTxdxK, x_NxTxdxK)
+    if lower:
+        Cbaroff_NxTm1xdxd = -outer(bbar_NxTxdxK[:,1:], x_NxTxdxK[:,:-1])
+    else:
+        Cbaroff_NxTm1xdxd = -outer(bbar_NxTxdxK[:,:-1], x_NxTxdxK[:,1:])
+    if transpose:
+        Cbar_NxTxdxd = tf.matrix_transpose(Cbar_NxTxdxd)
+        Cbaroff_NxTm1xdxd = tf.matrix_transpose(Cbaroff_NxTm1xdxd)
+    # Only the lower triangles of the diagonal blocks are ever read
+    Abar_NxTxdxd = tf.matrix_band_part(Cbar_NxTxdxd, -1, 0)
+    
+    return [Abar_NxTxdxd, Cbaroff_NxTm1xdxd, bbar_NxTxd]
+
+
+def with_analytic_grads(chol_fn, inv_fn):
+    """
+    Wraps a pair of block-tridiagonal Cholesky and solve functions with the
+    analytic gradients `blk_tridiag_chol_grad` and `blk_chol_inv_grad`.
+    
+    Backpropagating through the scans (or while loops) of the forward
+    functions makes tensorflow store every intermediate of every time step.
+    The wrapped functions keep only their inputs and outputs, so that the
+    training memory scales with the size of the factor. The gradients are the
+    same.
+    """
+    def chol_fn_wg(A_NxTxdxd, B_NxTm1xdxd):
+        @tf.custom_gradient
+        def chol(A_NxTxdxd, B_NxTm1xdxd):
+            AChol_NxTxdxd, BChol_NxTm1xdxd = chol_fn(A_NxTxdxd, B_NxTm1xdxd)
+            def grad(ACholbar_NxTxdxd, BCholbar_NxTm1xdxd):
+                Abar_NxTxdxd, Bbar_NxTm1xdxd = blk_tridiag_chol_grad(
+                    AChol_NxTxdxd, BChol_NxTm1xdxd, ACholbar_NxTxdxd, BCholbar_NxTm1xdxd)
+                # A single off-diagonal block shared by all trials and times
+                # gets the sum of their gradients.
+                if len(B_NxTm1xdxd.get_shape()) == 2:
+                    Bbar_NxTm1xdxd = tf.reduce_sum(Bbar_NxTm1xdxd, axis=[0,1])
+                return [Abar_NxTxdxd, Bbar_NxTm1xdxd]
+            return [AChol_NxTxdxd, BChol_NxTm1xdxd], grad
+        return chol(tf.convert_to_tensor(A_NxTxdxd), tf.convert_to_tensor(B_NxTm1xdxd))
+    
+    def inv_fn_wg(A_NxTxdxd, B_NxTm1xdxd, b_NxTxd, lower=True, transpose=False):
+        @tf.custom_gradient
+        def inv(A_NxTxdxd, B_NxTm1xdxd, b_NxTxd):
+            x_NxTxd = inv_fn(A_NxTxdxd, B_NxTm1xdxd, b_NxTxd, lower=lower, transpose=transpose)
+            def grad(xbar_NxTxd):
+                return blk_chol_inv_grad(A_NxTxdxd, B_NxTm1xdxd, x_NxTxd, xbar_NxTxd,
+                                         lower=lower, transpose=transpose, inv_fn=inv_fn)
+            return x_NxTxd, grad
+        return inv(tf.convert_to_tensor(A_NxTxdxd), tf.convert_to_tensor(B_NxTm1xdxd),
+                   tf.convert_to_tensor(b_NxTxd))
+    
+    return chol_fn_wg, inv_fn_wg
+
+
+def blk_chol_selected_inv(A_NxTxdxd, B_NxTm1xdxd):
+    """
+    Selected inversion of a block-tridiagonal matrix M = L*L^T from its
+    block-bidiagonal Cholesky factor L (the output of `blk_tridiag_chol_batch`).
+    Returns the diagonal and first lower off-diagonal blocks of M^{-1} in
+    O(T*d^3), without ever forming the dense inverse.
+    
+    With G_t = B_t*A_t^{-1}, the blocks of S = M^{-1} obey the backward
+    recursion
+    
+    S_{T,T} = A_T^{-T}*A_T^{-1}
+    S_{t,t} = A_t^{-T}*A_t^{-1} + G_t^T*S_{t+1,t+1}*G_t
+    S_{t+1,t} = -S_{t+1,t+1}*G_t
+    
+    Inputs:
+    A - [N x T x n x n]   tensor of (lower triangular) block diagonals of L
+    B - [N x T-1 x n x n] tensor of lower 1st block off-diagonals of L
+    
+    Outputs: 
+    R - python list with two elements
+        * R[0] - [N x T x n x n] tensor of diagonal blocks S_{t,t}
+        * R[1] - [N x T-1 x n x n] tensor of lower off-diagonal blocks S_{t+1,t}
+    """
+    A_TxNxdxd = tf.transpose(A_NxTxdxd, [1,0,2,3])
+    B_Tm1xNxdxd = tf.transpose(B_NxTm1xdxd, [1,0,2,3])
+    
+    # Everything that does not depend on the recursion is computed for all t
+    # at once.
+    eye_TxNxdxd = tf.eye(tf.shape(A_TxNxdxd)[-1], batch_shape=tf.shape(A_TxNxdxd)[:-2],
+                         dtype=A_TxNxdxd.dtype)
+    AInv_TxNxdxd = tri_solve_dxd(A_TxNxdxd, eye_TxNxdxd)
+    AInvTAInv_TxNxdxd = matmul_dxd(AInv_TxNxdxd, AInv_TxNxdxd, transpose_a=True)
+    G_Tm1xNxdxd = matmul_dxd(B_Tm1xNxdxd, AInv_TxNxdxd[:-1])
+    
+    def step(S_Nxdxd, GA_2xNxdxd):
+        G_Nxdxd, AInvTAInv_Nxdxd = GA_2xNxdxd[0], GA_2xNxdxd[1]
+        return AInvTAInv_Nxdxd + matmul_dxd(G_Nxdxd, matmul_dxd(S_Nxdxd, G_Nxdxd),
+                                           transpose_a=True)
+    
+    ST_Nxdxd = AInvTAInv_TxNxdxd[-1]
+    S_Tm1xNxdxd = tf.scan(fn=step, elems=[G_Tm1xNxdxd[::-1], AInvTAInv_TxNxdxd[:-1][::-1]],
+                          initializer=ST_Nxdxd)
+    S_TxNxdxd = tf.concat([tf.expand_dims(ST_Nxdxd, axis=0), S_Tm1xNxdxd], axis=0)[::-1]
+    SOff_Tm1xNxdxd = -matmul_dxd(S_TxNxdxd[1:], G_Tm1xNxdxd)
+    
+    return [tf.transpose(S_TxNxdxd, [1,0,2,3]),
+            tf.transpose(SOff_Tm1xNxdxd, [1,0,2,3])]
+
+
+
+class EvolutionMatrices():
+    """
+    The evolution matrices A(x_t) = Alinear + alpha*B(x_t) at a batch of N x T
+    points. The nonlinear part B is kept in one of three forms:
+    
+        'dense'     : B_NxTxdxd
+        'lowrank'   : B = U*V^T, with U and V of shape [N x T x d x r]
+        'blockdiag' : B = diag{B_1, ..., B_k}, with the k blocks of size b x b
+                      in an [N x T x k x b x b] tensor
+        'linear'    : B = 0, for alpha = 0. A = Alinear at every point of an
+                      [N x T] batch and there is no evolution network at all
+    
+    The products used by the evolution and by the posterior precision are
+    computed from the factors: x*A costs O(d*r) per point and A^T*M*A costs
+    O(d^2*r), instead of the O(d^2) and O(d^3) of the dense A (b in place of r
+    for 'blockdiag'). The constant M of these products may be passed as the
+    [d] diagonal of a diagonal M, in which case B^T*M is a scaling of the
+    columns of B^T.
+    
+    An inflow modulation A -> s*A + c*I, with per-point scalars s and c, is
+    supported by all the products. See `with_inflow`.
+    
+    `dense` builds every entry, for the consumers that need them.
+    """
+    def __init__(self, Alinear_dxd, alpha, B_NxTxdxd=None, U_NxTxdxr=None, V_NxTxdxr=None,
+                 Bblocks_NxTxkxbxb=None, batch_shape=None):
+        """
+        Args:
+            Alinear_dxd: The linear part of the evolution, shared by all points
+            alpha: The scale of the nonlinearity
+            B_NxTxdxd: The nonlinear part, for the 'dense' structure
+            U_NxTxdxr, V_NxTxdxr: Its factors, for the 'lowrank' structure
+            Bblocks_NxTxkxbxb: Its diagonal blocks, for the 'blockdiag' structure
+            batch_shape: The [N, T] shape of the batch, for the 'linear'
+                structure
+        """
+        if B_NxTxdxd is not None:
+            self.structure, self.factors = 'dense', [B_NxTxdxd]
+        elif U_NxTxdxr is not None and V_NxTxdxr is not None:
+            self.structure, self.factors = 'lowrank', [U_NxTxdxr, V_NxTxdxr]
+        elif Bblocks_NxTxkxbxb is not None:
+            self.structure, self.factors = 'blockdiag', [Bblocks_NxTxkxbxb]
+        elif batch_shape is not None:
+            self.structure, self.factors = 'linear', []
+        else:
+            raise ValueError("Must provide B, its low-rank factors U, V, its diagonal blocks "
+                             "or the batch shape of a linear evolution")
+        self.Alinear_dxd = Alinear_dxd
+        self.alpha = alpha
+        self.xDim = Alinear_dxd.get_shape().as_list()[-1]
+        self.batch_shape = batch_shape
+        self.scale_NxT, self.shift_NxT = None, None
+    
+    def _copy(self, Alinear_dxd, factors):
+        """
+        """
+        other = EvolutionMatrices.__new__(EvolutionMatrices)
+        other.__dict__.update(self.__dict__)
+        other.Alinear_dxd, other.factors = Alinear_dxd, factors
+        other.__dict__.pop('_dense_B', None)
+        other.__dict__.pop('_dense', None)
+        return other
+    
+    def with_inflow(self, scale_NxT, shift_NxT):
+        """
+        Returns the matrices s*A + c*I.
+        """
+        other = self._copy(self.Alinear_dxd, self.factors)
+        other.scale_NxT, other.shift_NxT = scale_NxT, shift_NxT
+        return other
+    
+    def _inflow_terms(self):
+        """
+        Returns the matrices A without the inflow and the [N x T x 1 x 1] s and c.
+        """
+        other = self._copy(self.Alinear_dxd, self.factors)
+        other.scale_NxT, other.shift_NxT = None, None
+        s_NxTx1x1 = tf.expand_dims(tf.expand_dims(self.scale_NxT, -1), -1)
+        c_NxTx1x1 = tf.expand_dims(tf.expand_dims(self.shift_NxT, -1), -1)
+        return other, s_NxTx1x1, c_NxTx1x1
+    
+    def transpose(self):
+        """
+        Returns the matrices A^T, with the same structure.
+        """
+        if self.structure == 'lowrank':
+            factors = self.factors[::-1]
+        elif self.structure == 'linear':
+            factors = []
+        else:
+            factors = [tf.matrix_transpose(self.factors[0])]
+        return self._copy(tf.transpose(self.Alinear_dxd), factors)
+    
+    def _rows_dot(self, X_Nx_xd, M_dxd):
+        """
+        X*M for a constant M, without broadcasting M to every point.
+        """
+        if is_diagonal(M_dxd): return X_Nx_xd*M_dxd
+        X_Mxd = tf.reshape(X_Nx_xd, [-1, self.xDim])
+        return tf.reshape(tf.matmul(X_Mxd, M_dxd), tf.shape(X_Nx_xd))
+    
+    def _rmul_B(self, X_NxTxmxd):
+        """
+        X*B(x_t) for m row vectors at every point.
+        """
+        if self.structure == 'dense':
+            return matmul_dxd(X_NxTxmxd, self.factors[0])
+        elif self.structure == 'linear':
+            return tf.zeros_like(X_NxTxmxd)
+        elif self.structure == 'lowrank':
+            U_NxTxdxr, V_NxTxdxr = self.factors
+            return tf.matmul(tf.matmul(X_NxTxmxd, U_NxTxdxr), V_NxTxdxr, transpose_b=True)
+        else:
+            Bblocks_NxTxkxbxb = self.factors[0]
+            k, b = Bblocks_NxTxkxbxb.get_shape().as_list()[-3:-1]
+            shape = tf.shape(X_NxTxmxd)
+            X_NxTxkxmxb = tf.transpose(tf.reshape(X_NxTxmxd, tf.concat([shape[:-1], [k, b]], 0)),
+                                       [0,1,3,2,4])
+            XB_NxTxmxkxb = tf.transpose(tf.matmul(X_NxTxkxmxb, Bblocks_NxTxkxbxb), [0,1,3,2,4])
+            return tf.reshape(XB_NxTxmxkxb, shape)
+    
+    def _Bt_dot(self, M_dxd):
+        """
+        B(x_t)^T*M for a constant M.
+        """
+        if self.structure == 'dense':
+            return self._rows_dot(tf.matrix_transpose(self.factors[0]), M_dxd)
+        elif self.structure == 'linear':
+            return self.dense_B()
+        elif self.structure == 'lowrank':
+            U_NxTxdxr, V_NxTxdxr = self.factors
+            return tf.matmul(V_NxTxdxr, self._rows_dot(tf.matrix_transpose(U_NxTxdxr), M_dxd))
+        else:
+            Bblocks_NxTxkxbxb = self.factors[0]
+            k, b = Bblocks_NxTxkxbxb.get_shape().as_list()[-3:-1]
+            shape = tf.shape(Bblocks_NxTxkxbxb)
+            if is_diagonal(M_dxd):
+                # B^T*M is block-diagonal too, with blocks B_i^T*M_i
+                BtMblocks_NxTxkxbxb = ( tf.matrix_transpose(Bblocks_NxTxkxbxb)*
+                                        tf.reshape(M_dxd, [k, 1, b]) )
+                return self._copy(self.Alinear_dxd, [BtMblocks_NxTxkxbxb]).dense_B()
+            # Row block i of B^T*M is B_i^T times row block i of M 
+            Bt_kxNTbxb = tf.reshape(tf.transpose(Bblocks_NxTxkxbxb, [2,0,1,4,3]), [k, -1, b])
+            BtM_kxNTbxd = tf.matmul(Bt_kxNTbxb, tf.reshape(M_dxd, [k, b, self.xDim]))
+            BtM_NxTxkxbxd = tf.transpose(tf.reshape(BtM_kxNTbxd, [k, shape[0], shape[1], b,
+                                                                  self.xDim]), [1,2,0,3,4])
+            return tf.reshape(BtM_NxTxkxbxd, [shape[0], shape[1], self.xDim, self.xDim])
+    
+    def dense_B(self):
+        """
+        Returns the [N x T x d x d] nonlinear part B. Built once.
+        """
+        if hasattr(self, '_dense_B'): return self._dense_B
+        if self.structure == 'dense':
+            B_NxTxdxd = self.factors[0]
+        elif self.structure == 'linear':
+            B_NxTxdxd = tf.zeros(tf.concat([self.batch_shape, [self.xDim, self.xDim]], axis=0),
+                                 dtype=self.Alinear_dxd.dtype)
+        elif self.structure == 'lowrank':
+            B_NxTxdxd = tf.matmul(self.factors[0], self.factors[1], transpose_b=True)
+        else:
+            Bblocks_NxTxkxbxb = self.factors[0]
+            k, b = Bblocks_NxTxkxbxb.get_shape().as_list()[-3:-1]
+            shape = tf.shape(Bblocks_NxTxkxbxb)
+            eye_kx1xkx1 = tf.reshape(tf.eye(k, dtype=Bblocks_NxTxkxbxb.dtype), [k, 1, k, 1])
+            B_NxTxkxbxkxb = tf.expand_dims(Bblocks_NxTxkxbxb, axis=4)*eye_kx1xkx1
+            B_NxTxdxd = tf.reshape(B_NxTxkxbxkxb, [shape[0], shape[1], self.xDim, self.xDim])
+        self._dense_B = B_NxTxdxd
+        return B_NxTxdxd
+    
+    def dense(self):
+        """
+        Returns the [N x T x d x d] matrices A. Built once.
+        """
+        if hasattr(self, '_dense'): return self._dense
+        A_NxTxdxd = self.alpha*self.dense_B() + self.Alinear_dxd # Broadcast
+        if self.scale_NxT is not None:
+            eye_dxd = tf.eye(self.xDim, dtype=A_NxTxdxd.dtype)
+            A_NxTxdxd = ( tf.expand_dims(tf.expand_dims(self.scale_NxT, -1), -1)*A_NxTxdxd +
+                          tf.expand_dims(tf.expand_dims(self.shift_NxT, -1), -1)*eye_dxd )
+        self._dense = A_NxTxdxd
+        return A_NxTxdxd
+    
+    def rmatvec(self, X_NxTxd):
+        """
+        Returns the row vectors x_t*A(x_t).
+        """
+        XA_NxTxd = self._rows_dot(X_NxTxd, self.Alinear_dxd)
+        if self.structure != 'linear':
+            XB_NxTxd = self._rmul_B(tf.expand_dims(X_NxTxd, axis=2))[:,:,0]
+            XA_NxTxd += self.alpha*XB_NxTxd
+        if self.scale_NxT is not None:
+            XA_NxTxd = ( tf.expand_dims(self.scale_NxT, -1)*XA_NxTxd +
+                         tf.expand_dims(self.shift_NxT, -1)*X_NxTxd )
+        return XA_NxTxd
+    
+    def transpose_dot(self, M_dxd):
+        """
+        Returns A^T*M for a constant M, [N x T x d x d].
+        """
+        if self.scale_NxT is not None:
+            # (s*A + c*I)^T*M = s*A^T*M + c*M
+            A, s_NxTx1x1, c_NxTx1x1 = self._inflow_terms()
+            Mfull_dxd = tf.matrix_diag(M_dxd) if is_diagonal(M_dxd) else M_dxd
+            return s_NxTx1x1*A.transpose_dot(M_dxd) + c_NxTx1x1*Mfull_dxd
+        AltM_dxd = ( tf.transpose(self.Alinear_dxd)*M_dxd if is_diagonal(M_dxd) else
+                     tf.matmul(self.Alinear_dxd, M_dxd, transpose_a=True) )
+        return AltM_dxd + self.alpha*self._Bt_dot(M_dxd) # Broadcast
+    
+    def quad_form(self, M_dxd):
+        """
+        Returns A^T*M*A for a constant M, [N x T x d x d].
+        
+            A^T*M*A = Alinear^T*M*Alinear + alpha*B^T*(M*Alinear) + alpha*(A^T*M)*B 
+        
+        With inflow, (s*A + c*I)^T*M*(s*A + c*I) = s^2*A^T*M*A + s*c*(A^T*M + M*A) + c^2*M.
+        """
+        if self.scale_NxT is not None:
+            A, s_NxTx1x1, c_NxTx1x1 = self._inflow_terms()
+            if is_diagonal(M_dxd):
+                Mfull_dxd, Mt_dxd = tf.matrix_diag(M_dxd), M_dxd
+            else:
+                Mfull_dxd, Mt_dxd = M_dxd, tf.transpose(M_dxd)
+            MA_NxTxdxd = tf.matrix_transpose(A.transpose_dot(Mt_dxd))
+            return ( tf.square(s_NxTx1x1)*A.quad_form(M_dxd) +
+                     s_NxTx1x1*c_NxTx1x1*(A.transpose_dot(M_dxd) + MA_NxTxdxd) +
+                     tf.square(c_NxTx1x1)*Mfull_dxd )
+        MAl_dxd = ( tf.expand_dims(M_dxd, -1)*self.Alinear_dxd if is_diagonal(M_dxd) else
+                    tf.matmul(M_dxd, self.Alinear_dxd) )
+        AltMAl_dxd = tf.matmul(self.Alinear_dxd, MAl_dxd, transpose_a=True)
+        return ( AltMAl_dxd + self.alpha*self._Bt_dot(MAl_dxd) + # Broadcast
+                 self.alpha*self._rmul_B(self.transpose_dot(M_dxd)) )
+    
+    
+class BlockTridiagPrecision():
+    """
+    A batch of N symmetric, positive definite, block-tridiagonal precision
+    matrices Lambda = L*L^T, each of T x T blocks of size d x d. 
+    
+    The block-bidiagonal Cholesky factor L is computed once at construction and
+    cached together with every forward substitution L^{-1}b, so that the
+    posterior mean, the Mahalanobis distance and any other quantity built on
+    the same right-hand side share it.
+    
+    The factorization may run in a higher precision than the inputs (see
+    `get_dtypes`). Right-hand sides are cast to it, and every output is cast
+    back to the dtype of the inputs.
+    """
+    solvers = {'sequential' : (blk_tridiag_chol_batch, blk_chol_inv_batch),
+               'parallel' : (blk_tridiag_chol_parallel, blk_chol_inv_parallel)}
+    
+    def __init__(self, A_NxTxdxd, B_NxTm1xdxd, solver='sequential', dtype=None,
+                 analytic_grads=True):
+        """
+        Args:
+            A_NxTxdxd: The diagonal blocks of Lambda
+            B_NxTm1xdxd: The upper off-diagonal blocks of Lambda
+            solver: One of ['sequential', 'parallel']. See `blk_tridiag_chol_parallel`.
+            dtype: The dtype of the factorization. Defaults to that of the
+                inputs.
+            analytic_grads: Whether to backpropagate through the Cholesky and
+                the solves with the memory-lean gradients of
+                `with_analytic_grads` instead of through their loops.
+        """
+        self.out_dtype = A_NxTxdxd.dtype
+        self.dtype = dtype = self.out_dtype if dtype is None else dtype
+        chol_fn, self._inv_fn = self.solvers[solver]
+        if analytic_grads:
+            chol_fn, self._inv_fn = with_analytic_grads(chol_fn, self._inv_fn)
+        self.AChol_NxTxdxd, self.BChol_NxTm1xdxd = chol_fn(tf.cast(A_NxTxdxd, dtype),
+                                                           tf.cast(B_NxTm1xdxd, dtype))
+        self._solve_cache = {}
+        
+    def _solve(self, b_NxTxd):
+        """
+        L^{-1}b in the dtype of the factorization. Computed once per right-hand
+        side tensor.
+        """
+        if b_NxTxd not in self._solve_cache:
+            self._solve_cache[b_NxTxd] = self._inv_fn(self.AChol_NxTxdxd, self.BChol_NxTm1xdxd,
+                                                      tf.cast(b_NxTxd, self.dtype))
+        return self._solve_cache[b_NxTxd]
+    
+    def _solve_transpose(self, b_NxTxd):
+        """
+        L^{-T}b in the dtype of the factorization.
+        """
+        return self._inv_fn(self.AChol_NxTxdxd, self.BChol_NxTm1xdxd,
+                            tf.cast(b_NxTxd, self.dtype), lower=False, transpose=True)
+        
+    def solve(self, b_NxTxd):
+        """
+        Returns L^{-1}b. 
+        """
+        return tf.cast(self._solve(b_NxTxd), self.out_dtype)
+    
+    def solve_transpose(self, b_NxTxd):
+        """
+        Returns L^{-T}b.
+        """
+        return tf.cast(self._solve_transpose(b_NxTxd), self.out_dtype)
+    
+    def inv_dot(self, b_NxTxd):
+        """
+        Returns Lambda^{-1}b = L^{-T}L^{-1}b.
+        """
+        return tf.cast(self._solve_transpose(self._solve(b_NxTxd)), self.out_dtype)
+    
+    def inv_dot_and_sample(self, b_NxTxdxK, noise_NxTxdxM):
+        """
+        Returns Lambda^{-1}b and the samples L^{-T}*noise for K and M stacked
+        right-hand sides respectively. Everything comes out of a single forward
+        and a single backward pass over the factor.
+        """
+        K = tf.shape(b_NxTxdxK)[-1]
+        y_NxTxdxKpM = tf.concat([self._solve(b_NxTxdxK), tf.cast(noise_NxTxdxM, self.dtype)],
+                                axis=-1)
+        x_NxTxdxKpM = tf.cast(self._solve_transpose(y_NxTxdxKpM), self.out_dtype)
+        return x_NxTxdxKpM[...,:K], x_NxTxdxKpM[...,K:]
+    
+    def sample(self, noise_NxTxd=None):
+        """
+        Returns a zero-mean sample with covariance Lambda^{-1}, that is L^{-T}eps
+        for standard normal eps. If noise_NxTxd is None, eps is drawn here.
+        """
+        if noise_NxTxd is None:
+            noise_NxTxd = tf.random_normal(tf.shape(self.AChol_NxTxdxd)[:-1], dtype=self.dtype)
+        return self.solve_transpose(noise_NxTxd)
+    
+    def logdet(self):
+        """
+        Returns the [N] log-determinants of Lambda as 2 times the sum of the log
+        diagonal of L. O(T*d) once the factor is available.
+        """
+        logdet_N = 2.0*tf.reduce_sum(tf.log(tf.matrix_diag_part(self.AChol_NxTxdxd)), axis=[1,2])
+        return tf.cast(logdet_N, self.out_dtype)
+    
+    def mahalanobis(self, b_NxTxd):
+        """
+        Returns the [N] quadratic forms b^T*Lambda^{-1}*b = |L^{-1}b|^2.
+        """
+        return tf.cast(tf.reduce_sum(tf.square(self._solve(b_NxTxd)), axis=[1,2]),
+                       self.out_dtype)
+    
+    def marginal_covariances(self):
+        """
+        Returns the diagonal blocks Cov(x_t) [N x T x d x d] and the lag-one
+        blocks Cov(x_{t+1}, x_t) [N x T-1 x d x d] of Lambda^{-1}. See
+        `blk_chol_selected_inv`.
+        """
+        if not hasattr(self, '_marginal_covariances'):
+            S_NxTxdxd, SOff_NxTm1xdxd = blk_chol_selected_inv(self.AChol_NxTxdxd,
+                                                              self.BChol_NxTm1xdxd)
+            self._marginal_covariances = [tf.cast(S_NxTxdxd, self.out_dtype),
+                                          tf.cast(SOff_NxTm1xdxd, self.out_dtype)]
+        return self._marginal_covariances
+
+
+class LinearGaussianPrecision(BlockTridiagPrecision):
+    """
+    The precision of the posterior of a linear-Gaussian state-space model, for
+    globally linear dynamics. All the off-diagonal blocks are the same d x d
+    matrix, so that neither the per-time evolution matrices nor the
+    off-diagonal blocks are ever materialized. See `blk_tridiag_chol_shared`.
+    
+    Everything built on the factor (solves, samples, logdet, marginal
+    covariances) is inherited from `BlockTridiagPrecision`.
+    """
+    def __init__(self, A_NxTxdxd, B_dxd, solver='sequential', dtype=None, analytic_grads=True,
+                 steady_state_tol=None):
+        """
+        Args:
+            A_NxTxdxd: The diagonal blocks of Lambda
+            B_dxd: The upper off-diagonal block of Lambda, shared by every time
+                and trial
+            steady_state_tol: If not None, A_t must be the same for all
+                0 < t < T-1, and the factorization reuses the steady state of
+                the Riccati recursion once it is reached within this tolerance
+            solver, dtype, analytic_grads: See `BlockTridiagPrecision`. The
+                solver is only used for the solves.
+        """
+        self.out_dtype = A_NxTxdxd.dtype
+        self.dtype = dtype = self.out_dtype if dtype is None else dtype
+        chol_fn = lambda A, B : blk_tridiag_chol_shared(A, B, steady_state_tol=steady_state_tol)
+        self._inv_fn = self.solvers[solver][1]
+        if analytic_grads:
+            chol_fn, self._inv_fn = with_analytic_grads(chol_fn, self._inv_fn)
+        self.AChol_NxTxdxd, self.BChol_NxTm1xdxd = chol_fn(tf.cast(A_NxTxdxd, dtype),
+                                                           tf.cast(B_dxd, dtype))
+        self._solve_cache = {}
+
+
+class IdGroups():
+    """
+    The trials of a dataset grouped by their entity Id. The trials are sorted by
+    Id once, so that the trials of every entity are a contiguous range of that
+    order. A single evaluation over the sorted trials then yields the outputs
+    of all the entities, see `split`.
+    """
+    def __init__(self, Ids_N):
+        """
+        Args:
+            Ids_N: The Id of every trial
+        """
+        self.Ids_N = np.asarray(Ids_N)
+        self.order_N = np.argsort(self.Ids_N, kind='mergesort')
+        self.ids_E, starts_E, counts_E = np.unique(self.Ids_N[self.order_N], return_index=True,
+                                                   return_counts=True)
+        self._slices = {Id : slice(start, start + count) for Id, start, count
+                        in zip(self.ids_E.tolist(), starts_E, counts_E)}
+        
+    def indices(self, Id):
+        """
+        Returns the indices of the trials of entity Id, in the original order.
+        """
+        return self.order_N[self._slices.get(int(Id), slice(0, 0))]
+    
+    def sort(self, data_Nx_):
+        """
+        Returns the per-trial data_Nx_ sorted by Id.
+        """
+        return data_Nx_[self.order_N]
+        
+    def split(self, sorted_data_Nx_):
+        """
+        Splits per-trial data sorted by Id into a dictionary keyed by Id.
+        """
+        return {Id : sorted_data_Nx_[slc] for Id, slc in self._slices.items()}
+
 
 if __name__ == '__main__':
     # Test `blk_tridiag_chol`
@@ -140,13 +1150,13 @@ if __name__ == '__main__':
                    [mZ, mF.T, mC, mE],
                    [mZ, mZ, mE.T, mD]])
     
-    tA = tf.get_variable('tA', initializer=mA, dtype=DTYPE)
-    tB = tf.get_variable('tB', initializer=mB, dtype=DTYPE)
-    tC = tf.get_variable('tC', initializer=mC, dtype=DTYPE)
-    tD = tf.get_variable('tD', initializer=mD, dtype=DTYPE)
+    tA = tf.get_variable('tA', initializer=mA, dtype=tf.float32)
+    tB = tf.get_variable('tB', initializer=mB, dtype=tf.float32)
+    tC = tf.get_variable('tC', initializer=mC, dtype=tf.float32)
+    tD = tf.get_variable('tD', initializer=mD, dtype=tf.float32)
 
-    tE = tf.get_variable('tE', initializer=mE, dtype=DTYPE)
-    tF = tf.get_variable('tF', initializer=mF, dtype=DTYPE)
+    tE = tf.get_variable('tE', initializer=mE, dtype=tf.float32)
+    tF = tf.get_variable('tF', initializer=mF, dtype=tf.float32)
 
     As = tf.stack([tA, tB, tC, tD])
     Bs = tf.stack([tE, tF, tE])
@@ -167,22 +1177,18 @@ if __name__ == '__main__':
               np.allclose(mat, new_mat))
         print('')
         
-    # Test `blk_chol_inv` Before I used `mA`, `mB`, etc to construct a matrix to
-    # for which I found the Cholesky decomposition. Now I use the same matrices
-    # to construct the Cholesky decomposition of some matrix.
-    lowermat = np.bmat([[mA,     mZ, mZ,   mZ],
-                        [mE.T,   mB, mZ,   mZ],
-                        [mZ,   mF.T, mC,   mZ],
-                        [mZ,     mZ, mE.T, mD]])
+    # Test `blk_chol_inv`. The diagonal blocks of C must be lower triangular,
+    # so use the Cholesky factors of `mat` found above. Then C*C^T = mat.
+    lowermat = Chol_mat
     lwrmat_sq = np.dot(lowermat, lowermat.T)
     
     # To find the Cholesky inverse, we pass the LOWER blocks of the blocks-
     # tridiagonal matrix
-    Bs = tf.stack([tf.transpose(tE), tf.transpose(tF), tf.transpose(tE)])
+    As = tf.constant(AChol)
+    Bs = tf.constant(BChol)
     
     # Initialize a numpy vector
     vb = np.mat('1.0 2.0; 3.0 4.0; 5.0 6.0; 7.0 8.0', dtype='f')
-    tb = tf.get_variable('b', initializer=vb, dtype=DTYPE)
      
     # Apply `blk_chol_inv` to `vb` twice
     temp_ib = blk_chol_inv(As, Bs, vb)
@@ -28,8 +28,7 @@ from code.LatEvModels import LocallyLinearEvolution
 from code.ObservationModels import PoissonObs, GaussianObs
 from code.Optimizer_VAEC import Optimizer_TS
 from code.datetools import addDateTime
-
-DTYPE = tf.float32
+from code.utils import get_dtypes, IdGroups
 
 # CONFIGURATION
 RUN_MODE = 'train' # ['train', 'generate', 'other']
@@ -55,6 +54,8 @@ XDIM = 2
 WITH_IDS = False
 PDIM = 1
 NUM_DIFF_ENTITIES = 1
+LAZY_ENTITY_UPDATES = False
+ENTITY_SHARDS = 1
 WITH_INPUTS = False
 WITH_MOD_DYNAMICS = False
 WITH_ITERM = False
@@ -62,6 +63,11 @@ INCLUDE_WITH_INPUTS = False
 IDIM = 1
 NNODES = 70
 ALPHA = 0.1
+EVOLUTION_STRUCTURE = 'dense' # ['dense', 'lowrank', 'blockdiag']
+EVOLUTION_RANK = 2
+EVOLUTION_BLOCK_SIZE = 2
+A_GRID_RANGE = 40.0
+A_GRID_POINTS = 101
 INITRANGE_MUX = 0.1
 INITRANGE_LAMBDAX = 0.01
 INITRANGE_B = 0.3
@@ -69,6 +75,7 @@ INITRANGE_OUTY = 0.1
 INIT_Q0 = 1.0
 INIT_Q = 2.0
 IS_Q_TRAINABLE = True
+Q_STRUCTURE = 'full' # ['full', 'diagonal', 'isotropic']
 INITRANGE_GOUTMEAN = 9.0
 INITRANGE_GOUTVAR = 1.0
 INITBIAS_GOUTMEAN = 1.0
@@ -83,6 +90,12 @@ END_LR = 1e-4
 NUM_FPIS = 2
 USE_GRAD_TERM = False
 USE_TRANSPOSE_TRICK = True
+GRAD_TERM_METHOD = 'vjp' # ['vjp', 'jacobian']
+TRIDIAG_SOLVER = 'sequential' # ['sequential', 'parallel']
+DTYPE = 'float32' # ['float32', 'float64', 'mixed']
+ANALYTIC_CHOL_GRADS = True
+STATIONARY_LAMBDA = False
+STEADY_STATE_TOL = 1e-6
 NUM_EPS_TO_INCLUDE_GRADS = 2000
 BATCH_SIZE = 1
 NUM_EPOCHS = 500
@@ -125,6 +138,21 @@ flags.DEFINE_integer('xDim', XDIM, "The dimensionality of the latent space")
 flags.DEFINE_integer('yDim', YDIM, "The dimensionality of the data")
 flags.DEFINE_float('alpha', ALPHA, ("The scale factor of the nonlinearity. This parameters "
                                     "works in conjunction with initrange_B"))
+flags.DEFINE_string('evolution_structure', EVOLUTION_STRUCTURE, ("The structure of the "
+                                        "nonlinear part B(x) of the evolution A(x) = Alinear + "
+                                        "alpha*B(x). 'dense' has xDim**2 entries. 'lowrank' is "
+                                        "U(x)*V(x)^T with rank evolution_rank. 'blockdiag' has "
+                                        "diagonal blocks of size evolution_block_size. The "
+                                        "structured options scale to large xDim.") )
+flags.DEFINE_integer('evolution_rank', EVOLUTION_RANK, "The rank of B(x) if 'lowrank'")
+flags.DEFINE_integer('evolution_block_size', EVOLUTION_BLOCK_SIZE, ("The size of the diagonal "
+                                        "blocks of B(x) if 'blockdiag'. Must divide xDim.") )
+flags.DEFINE_float('A_grid_range', A_GRID_RANGE, ("For xDim <= 3, the half-width of the "
+                                        "grid on which A(x) may be tabulated for fast sampling "
+                                        "and flow plots (use_A_grid)") )
+flags.DEFINE_integer('A_grid_points', A_GRID_POINTS, ("The number of points per dimension of "
+                                        "the A(x) grid. The interpolation error goes as "
+                                        "(2*A_grid_range/A_grid_points)^2.") )
 flags.DEFINE_float('initrange_MuX', INITRANGE_MUX, ("Controls the initial ranges within "
                                            "which the latent space paths are contained. Bigger "
                                            "values here lead to bigger bounding box. It is im-"
@@ -154,11 +182,20 @@ flags.DEFINE_float('initrange_Goutvar', INITRANGE_GOUTVAR, "")
 flags.DEFINE_float('initbias_Goutmean', INITBIAS_GOUTMEAN, "")
 flags.DEFINE_float('inv_tau', INV_TAU, "")
 flags.DEFINE_boolean('is_Q_trainable', IS_Q_TRAINABLE, "")
+flags.DEFINE_string('Q_structure', Q_STRUCTURE, ("The structure of the evolution noise Q and of the "
+                                                 "initial covariance Q0. 'diagonal' and 'isotropic' turn the "
+                                                 "products with Q^-1 into elementwise scalings."))
 flags.DEFINE_boolean('is_out_positive', IS_OUT_POSITIVE, "")
 flags.DEFINE_boolean('is_linear_output', IS_LINEAR_OUTPUT, "")
 flags.DEFINE_boolean('is_identity_output', IS_IDENTITY_OUTPUT, "")
 flags.DEFINE_boolean('with_ids', WITH_IDS, "")
 flags.DEFINE_integer('num_diff_entities', NUM_DIFF_ENTITIES, "")
+flags.DEFINE_boolean('lazy_entity_updates', LAZY_ENTITY_UPDATES, ("Update only the rows of the "
+                                                                  "per-entity parameters that appear in "
+                                                                  "the batch, and only their Adam moments. "
+                                                                  "For large num_diff_entities."))
+flags.DEFINE_integer('entity_shards', ENTITY_SHARDS, ("Number of variables the per-entity parameters "
+                                                      "are split into"))
 flags.DEFINE_integer('pDim', PDIM, "")
 flags.DEFINE_boolean('with_inputs', WITH_INPUTS, "")
 flags.DEFINE_integer('iDim', IDIM, "")
@@ -185,6 +222,32 @@ flags.DEFINE_boolean('use_grad_term', USE_GRAD_TERM, ("Should I include the term
                                         "is the costliest operation timewise. On the other " 
                                         "hand, it IS an approximation. Use carefully.") )
 flags.DEFINE_boolean('use_transpose_trick', USE_TRANSPOSE_TRICK, (""))
+flags.DEFINE_string('grad_term_method', GRAD_TERM_METHOD, ("How the gradient term is "
+                                        "computed. 'vjp' differentiates the evolution energy "
+                                        "in a single backward pass. 'jacobian' builds the full "
+                                        "[NT x d x d x d] Jacobian of A(x) and contracts it.") )
+flags.DEFINE_string('tridiag_solver', TRIDIAG_SOLVER, ("The block-tridiagonal solver used by the "
+                                        "recognition model. 'sequential' scans over time. "
+                                        "'parallel' has O(log T) depth and is faster for long "
+                                        "sequences. See tests/bench_blk_tridiag.py for the "
+                                        "crossover.") )
+flags.DEFINE_boolean('analytic_chol_grads', ANALYTIC_CHOL_GRADS, ("Backpropagate through "
+                                        "the block-tridiagonal Cholesky and solves with their "
+                                        "analytic gradients. These only store the factor, "
+                                        "whereas autodiff through the scans stores every "
+                                        "intermediate of every time step.") )
+flags.DEFINE_boolean('stationary_Lambda', STATIONARY_LAMBDA, ("Use a single learned "
+                                        "recognition precision Lambda for every time bin "
+                                        "instead of the output of the recognition network.") )
+flags.DEFINE_float('steady_state_tol', STEADY_STATE_TOL, ("For globally linear dynamics "
+                                        "(alpha = 0) with stationary_Lambda, the Cholesky of "
+                                        "the posterior precision stops once its blocks "
+                                        "converge to this tolerance, and reuses the steady "
+                                        "state for the remaining time bins.") )
+flags.DEFINE_string('dtype', DTYPE, ("The numeric precision of the model. 'mixed' keeps "
+                                        "the networks in float32 but computes the "
+                                        "block-tridiagonal factorizations and the "
+                                        "log-determinants in float64.") )
 flags.DEFINE_integer('num_eps_to_include_grads', NUM_EPS_TO_INCLUDE_GRADS, ("Number of epochs "
                                         "after which the exact gradient terms should be "
                                         "included in the computation of the posterior.") )
@@ -260,9 +323,10 @@ def generate_fake_data(params, data_path=None, save_data_file=None,
     NTbins=params.genNTbins
     xDim = params.xDim
     yDim = params.yDim
+    dtype, _ = get_dtypes(params)
     with tf.Session() as sess:
-        X = tf.placeholder(DTYPE, shape=[None, None, xDim], name='X')
-        Y = tf.placeholder(DTYPE, shape=[None, None, yDim], name='Y')
+        X = tf.placeholder(dtype, shape=[None, None, xDim], name='X')
+        Y = tf.placeholder(dtype, shape=[None, None, yDim], name='Y')
         if lat_mod_class in ['llwparams']:
             Ids = tf.placeholder(tf.int32, [None], name='Ids')
             latm = evolution_class(X, Ids, params)
@@ -289,13 +353,9 @@ def generate_fake_data(params, data_path=None, save_data_file=None,
         # If xDim == 2, draw a cool path plot
         if xDim == 2:
             if lat_mod_class in ['llwparams']:
-                for ent in range(params.num_diff_entities):
-                    print('Plottins DS for entity ', str(ent), '...')
-                    list_idxs = [i for i, Id in enumerate(Iddata) if Id == ent]
-                    XdataId = Xdata[list_idxs]
-                    latm.plot_2Dquiver_paths(sess, XdataId, [ent], rlt_dir=data_path,
-                                             rslt_file='quiver_plot_'+str(ent),
-                                             with_inflow=True, savefig=savefigs)
+                latm.plot_2Dquiver_paths_grouped(sess, Xdata, IdGroups(Iddata),
+                                                 rlt_dir=data_path, rslt_file='quiver_plot',
+                                                 with_inflow=True, savefig=savefigs)
             else:
                 latm.plot_2Dquiver_paths(sess, Xdata, Xvar_name='X:0', rlt_dir=data_path,
                                          with_inflow=True, savefig=savefigs)
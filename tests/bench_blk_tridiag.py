@@ -0,0 +1,91 @@
+# Copyright 2018 Daniel Hernandez Diaz, Columbia University
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+# ==============================================================================
+"""
+Crossover benchmark for the block-tridiagonal solvers. Times the Cholesky plus
+the two solves of the posterior mean for the 'sequential' and 'parallel'
+solvers over a range of sequence lengths T. Use the output to set
+`tridiag_solver` in runner.py.
+
+Run from the root of the repo as
+
+    python -m tests.bench_blk_tridiag
+"""
+import os
+os.environ['TF_CPP_MIN_LOG_LEVEL'] = '2'
+
+import time
+
+import numpy as np
+import tensorflow as tf
+
+from code.utils import (blk_tridiag_chol_batch, blk_chol_inv_batch, blk_tridiag_chol_parallel,
+                        blk_chol_inv_parallel)
+from tests.blk_tridiag_helpers import random_blk_tridiag
+
+DTYPE = tf.float32
+
+flags = tf.app.flags
+flags.DEFINE_integer('xDim', 2, "")
+flags.DEFINE_integer('Nsamps', 10, "")
+flags.DEFINE_string('NTbins_list', '16,32,64,128,256,512,1024,2048,4096', "")
+flags.DEFINE_integer('num_reps', 10, "")
+params = tf.flags.FLAGS
+
+
+def build_postX(chol_fn, inv_fn, A_NxTxdxd, B_NxTm1xdxd, b_NxTxd):
+    """
+    """
+    AChol, BChol = chol_fn(A_NxTxdxd, B_NxTm1xdxd)
+    return inv_fn(AChol, BChol, inv_fn(AChol, BChol, b_NxTxd), lower=False, transpose=True)
+
+def time_op(sess, op, feed_dict, num_reps):
+    """
+    Returns the best wall time over num_reps runs, after a warm-up run.
+    """
+    sess.run(op, feed_dict=feed_dict)
+    times = []
+    for _ in range(num_reps):
+        t0 = time.time()
+        sess.run(op, feed_dict=feed_dict)
+        times.append(time.time() - t0)
+    return min(times)
+
+def main(_):
+    """
+    """
+    xDim, Nsamps = params.xDim, params.Nsamps
+    A = tf.placeholder(DTYPE, [None, None, xDim, xDim], name='A')
+    B = tf.placeholder(DTYPE, [None, None, xDim, xDim], name='B')
+    b = tf.placeholder(DTYPE, [None, None, xDim], name='b')
+    seq_op = build_postX(blk_tridiag_chol_batch, blk_chol_inv_batch, A, B, b)
+    par_op = build_postX(blk_tridiag_chol_parallel, blk_chol_inv_parallel, A, B, b)
+
+    crossover = None
+    print('{:>8} {:>14} {:>14}'.format('T', 'sequential(s)', 'parallel(s)'))
+    with tf.Session() as sess:
+        for NTbins in [int(T) for T in params.NTbins_list.split(',')]:
+            A_NxTxdxd, B_NxTm1xdxd = random_blk_tridiag(Nsamps, NTbins, xDim)
+            b_NxTxd = np.random.randn(Nsamps, NTbins, xDim)
+            fd = {A : A_NxTxdxd, B : B_NxTm1xdxd, b : b_NxTxd}
+            t_seq = time_op(sess, seq_op, fd, params.num_reps)
+            t_par = time_op(sess, par_op, fd, params.num_reps)
+            if crossover is None and t_par < t_seq: crossover = NTbins
+            print('{:>8} {:>14.5f} {:>14.5f}'.format(NTbins, t_seq, t_par))
+    print('\nParallel solver faster from T =', crossover)
+
+
+if __name__ == '__main__':
+    tf.app.run()
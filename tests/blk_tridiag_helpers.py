@@ -0,0 +1,52 @@
+# Copyright 2018 Daniel Hernandez Diaz, Columbia University
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+# ==============================================================================
+"""
+NumPy helpers for the block-tridiagonal tests. They do not import tensorflow, so
+that the numpy backend can be tested without it.
+"""
+import numpy as np
+
+
+def random_blk_tridiag(Nsamps, NTbins, xDim, seed=0):
+    """
+    Draws Nsamps symmetric, positive definite block-tridiagonal matrices. The
+    diagonal blocks are made dominant so that the whole thing is PD.
+    """
+    rng = np.random.RandomState(seed)
+    M_NxTxdxd = rng.randn(Nsamps, NTbins, xDim, xDim)
+    A_NxTxdxd = ( np.matmul(M_NxTxdxd, np.transpose(M_NxTxdxd, [0,1,3,2])) +
+                  3*xDim*np.eye(xDim) )
+    B_NxTm1xdxd = 0.3*rng.randn(Nsamps, NTbins-1, xDim, xDim)
+    return A_NxTxdxd.astype('f'), B_NxTm1xdxd.astype('f')
+
+
+def dense_from_blocks(A_Txdxd, B_Tm1xdxd, symmetric=True):
+    """
+    Builds the dense matrix out of its diagonal and first (upper) off-diagonal
+    blocks. If symmetric=False, B is treated as the lower off-diagonal and the
+    upper part is left empty.
+    """
+    NTbins, xDim = A_Txdxd.shape[0], A_Txdxd.shape[1]
+    M = np.zeros([NTbins*xDim, NTbins*xDim])
+    for t in range(NTbins):
+        M[t*xDim:(t+1)*xDim, t*xDim:(t+1)*xDim] = A_Txdxd[t]
+    for t in range(NTbins-1):
+        if symmetric:
+            M[t*xDim:(t+1)*xDim, (t+1)*xDim:(t+2)*xDim] = B_Tm1xdxd[t]
+            M[(t+1)*xDim:(t+2)*xDim, t*xDim:(t+1)*xDim] = B_Tm1xdxd[t].T
+        else:
+            M[(t+1)*xDim:(t+2)*xDim, t*xDim:(t+1)*xDim] = B_Tm1xdxd[t]
+    return M
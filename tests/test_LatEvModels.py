@@ -118,6 +118,124 @@ class LocallyLinearEvolutionTest(tf.test.TestCase):
             print('alphaB ranges', list(zip(mins, maxs)))
             print('\n')
              
+    def test_sample_X(self):
+        """
+        Checks the in-graph sampler: shapes, starting points and rejection of
+        trivial paths.
+        """
+        X0data = np.random.randn(self.Nsamps, self.xDim)
+        with self.sess.as_default():
+            sampleX = self.lm1.sample_X(self.sess, 'LM1/X1:0', Nsamps=self.Nsamps,
+                                        NTbins=self.NTbins, X0data=X0data,
+                                        with_inflow=True, init_variables=False)
+        self.assertEqual(sampleX.shape, (self.Nsamps, self.NTbins, self.xDim))
+        self.assertAllClose(sampleX[:,0], X0data)
+        self.assertEqual(self.sampleX1.shape, (self.Nsamps, self.NTbins, self.xDim))
+        path_mse = np.mean(np.linalg.norm(np.diff(self.sampleX1, axis=1), axis=2), axis=1)
+        self.assertTrue(np.all(path_mse >= 0.1))
+
+    def test_evolution_memoized(self):
+        """
+        Evaluating the evolution again on the same tensor must not add a new
+        copy of the network to the graph.
+        """
+        num_ev_ops = lambda : len([op for op in self.graph.get_operations()
+                                   if 'ev_nn' in op.name])
+        with self.graph.as_default():
+            with tf.variable_scope('LM1'):
+                num_ops = num_ev_ops()
+                A_NxTxdxd, Awinflow_NxTxdxd, _ = self.lm1._define_evolution_network_wi(self.X1)
+                self.lm1.compute_LogDensity_Xterms(self.X1)
+                self.assertIs(A_NxTxdxd, self.lm1.A_NxTxdxd)
+                self.assertIs(Awinflow_NxTxdxd, self.lm1.Awinflow_NxTxdxd)
+                self.assertEqual(num_ev_ops(), num_ops)
+                
+    def test_entity_grads_sparse(self):
+        """
+        The gradients of the cost with respect to the per-entity parameters
+        must be sparse in the rows, so that they can be updated lazily.
+        """
+        with self.graph.as_default():
+            LD1, _ = self.lm1.logdensity_Xterms
+            grad = tf.gradients(LD1, self.lm1.ev_params_Pxp)[0]
+            self.assertIsInstance(grad, tf.IndexedSlices)
+            self.assertIn(self.lm1.ev_params_Pxp, tf.get_collection('ENTITY'))
+                
+    def test_A_grid(self):
+        """
+        The interpolated A(X) must be exact on the nodes of the grid, and the
+        table must go away when invalidated.
+        """
+        with self.graph.as_default():
+            grid_G, A_table = self.lm1.get_A_grid(self.sess)
+            self.assertEqual(A_table.shape, (len(grid_G),)*self.xDim + (self.xDim, self.xDim))
+            Xdata = np.array([[grid_G[3], grid_G[50]], [grid_G[70], grid_G[10]]])
+            A_interp = self.lm1.interpolate_A(self.sess, Xdata)
+            A_exact = self.sess.run(self.lm1.A_NxTxdxd,
+                                    feed_dict={'LM1/X1:0' : Xdata[np.newaxis],
+                                               'LM1/Ids:0' : np.zeros(1, dtype=np.int32)})[0]
+            self.assertAllClose(A_interp, A_exact, rtol=1e-4, atol=1e-5)
+            self.lm1.invalidate_A_grid()
+            self.assertEqual(self.lm1._A_grids, {})
+                
+    def test_find_fixed_points(self):
+        """
+        The origin is a fixed point of any x -> xA(x). Every point returned
+        must satisfy x = xA(x) and be classified.
+        """
+        X0data = np.concatenate([np.zeros([1, self.xDim]),
+                                 np.random.uniform(-20.0, 20.0, [50, self.xDim])])
+        with self.graph.as_default():
+            fixed_points = self.lm1.find_fixed_points(self.sess, X0data=X0data)
+            X_Kxd, eigvals_Kxd, stability_K, counts_K = fixed_points[0]
+            self.assertTrue(np.any(np.linalg.norm(X_Kxd, axis=1) < 1e-2))
+            self.assertEqual(eigvals_Kxd.shape, X_Kxd.shape)
+            self.assertTrue(set(stability_K) <= {'stable', 'unstable', 'saddle', 'marginal'})
+            self.assertLessEqual(np.sum(counts_K), len(X0data))
+            A_1xKxdxd = self.sess.run(self.lm1.A_NxTxdxd,
+                                      feed_dict={'LM1/X1:0' : X_Kxd[np.newaxis],
+                                                 'LM1/Ids:0' : np.zeros(1, dtype=np.int32)})
+            self.assertAllClose(np.einsum('ki,kij->kj', X_Kxd, A_1xKxdxd[0]), X_Kxd,
+                                atol=1e-3)
+                
+    def test_kstep_forecast(self):
+        """
+        Without noise, the 1-step forecast from every point must be xA(x), and
+        all the particles must coincide.
+        """
+        Xdata = self.sampleX1[:5]
+        feed_dict = {'LM1/X1:0' : Xdata, 'LM1/Ids:0' : np.zeros(len(Xdata), dtype=np.int32)}
+        with self.graph.as_default():
+            with tf.variable_scope('LM1', reuse=True):
+                Xpred_NxTmkxMxd = self.lm1.kstep_forecast_graph(self.X1, self.lm1.Ids, 1,
+                                                                num_particles=3,
+                                                                with_noise=False)
+            Xpred, A = self.sess.run([Xpred_NxTmkxMxd, self.lm1.A_NxTxdxd], feed_dict=feed_dict)
+            self.assertEqual(Xpred.shape, (len(Xdata), self.NTbins-1, 3, self.xDim))
+            XA_NxTm1xd = np.einsum('nti,ntij->ntj', Xdata[:,:-1], A[:,:-1])
+            for m in range(3):
+                self.assertAllClose(Xpred[:,:,m], XA_NxTm1xd, rtol=1e-4, atol=1e-4)
+                
+    def test_get_A_jacobian(self):
+        """
+        Checks the batched Jacobian of A(X) against central finite differences.
+        """
+        Xdata = self.sampleX1[:5]
+        feed_dict = {'LM1/X1:0' : Xdata, 'LM1/Ids:0' : np.zeros(len(Xdata), dtype=np.int32)}
+        eps = 1e-2
+        with self.graph.as_default():
+            Agrads_NxTxdxdxd = self.lm1.get_A_jacobian()
+            Agrads = self.sess.run(Agrads_NxTxdxdxd, feed_dict=feed_dict)
+            for k in range(self.xDim):
+                dX = np.zeros_like(Xdata)
+                dX[...,k] = eps
+                feed_dict['LM1/X1:0'] = Xdata + dX
+                Aplus = self.sess.run(self.lm1.A_NxTxdxd, feed_dict=feed_dict)
+                feed_dict['LM1/X1:0'] = Xdata - dX
+                Aminus = self.sess.run(self.lm1.A_NxTxdxd, feed_dict=feed_dict)
+                self.assertAllClose(Agrads[...,k], (Aplus - Aminus)/(2*eps), rtol=1e-2,
+                                    atol=1e-3)
+
 
 if __name__ == '__main__':
     tf.test.main()
@@ -98,6 +98,36 @@ class SmoothingNLDSTimeSeriesTest(tf.test.TestCase):
             print('postX ranges', list(zip(mins, maxs)))
             print("")
             
+    def test_postX_cov(self):
+        with tf.Session(graph=self.graph) as sess:
+            sess.run(tf.global_variables_initializer())
+            postX_cov = sess.run(self.mrec1.postX_cov_NxTxdxd,
+                                 feed_dict={'M1/Y1:0' : self.sampleY1,
+                                            'M1/X1:0' : self.sampleX1})
+            self.assertEqual(postX_cov.shape, (self.Nsamps, self.NTbins, self.xDim, self.xDim))
+            self.assertTrue(np.all(np.linalg.eigvalsh(postX_cov) > 0.0))
+            print('postX std (mean)', np.mean(np.sqrt(np.diagonal(postX_cov, axis1=2, axis2=3)),
+                                              axis=(0,1)))
+            print("")
+
+    def test_postX_gradterm_methods(self):
+        """
+        The single backward pass through the evolution energy must agree with
+        the contraction of the full Jacobian of A.
+        """
+        with self.graph.as_default():
+            with tf.variable_scope('M1', reuse=True):
+                gradterm_vjp = self.mrec1._compute_postX_gradterm(method='vjp')
+                gradterm_jac = self.mrec1._compute_postX_gradterm(method='jacobian')
+            with tf.Session(graph=self.graph) as sess:
+                sess.run(tf.global_variables_initializer())
+                feed_dict = {'M1/X1:0' : self.sampleX1[:10],
+                             'M1/Ids:0' : np.zeros(10, dtype=np.int32)}
+                gvjp, gjac = sess.run([gradterm_vjp, gradterm_jac], feed_dict=feed_dict)
+        self.assertEqual(gvjp.shape, (10, self.NTbins, self.xDim))
+        self.assertAllClose(gvjp, gjac, rtol=1e-4, atol=1e-4)
+        self.assertAllEqual(gvjp[:,-1], np.zeros([10, self.xDim]))
+            
     def test_MuLambda_statistics(self):
         with self.sess.as_default():
             Mu = self.sess.run(self.mrec1.Mu_NxTxd, feed_dict={'M1/Y1:0' : self.sampleY1})
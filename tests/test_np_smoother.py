@@ -0,0 +1,96 @@
+# Copyright 2018 Daniel Hernandez Diaz, Columbia University
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+# ==============================================================================
+import unittest
+
+import numpy as np
+
+from code import np_smoother
+from tests.blk_tridiag_helpers import random_blk_tridiag, dense_from_blocks
+
+
+class NumpySmootherTest(unittest.TestCase):
+    """
+    Checks the numpy backend against dense numpy linear algebra.
+    """
+    Nsamps = 4
+    NTbins = 10
+    xDim = 2
+    A_NxTxdxd, B_NxTm1xdxd = random_blk_tridiag(Nsamps, NTbins, xDim)
+    A_NxTxdxd, B_NxTm1xdxd = A_NxTxdxd.astype('d'), B_NxTm1xdxd.astype('d')
+    b_NxTxd = np.random.RandomState(1).randn(Nsamps, NTbins, xDim)
+
+    def assertAllClose(self, a, b, rtol=1e-6, atol=1e-6):
+        np.testing.assert_allclose(a, b, rtol=rtol, atol=atol)
+
+    def test_chol_and_inv(self):
+        AChol, BChol = np_smoother.blk_tridiag_chol(self.A_NxTxdxd, self.B_NxTm1xdxd)
+        x = np_smoother.blk_chol_inv(AChol, BChol, self.b_NxTxd)
+        xt = np_smoother.blk_chol_inv(AChol, BChol, self.b_NxTxd, lower=False, transpose=True)
+        for n in range(self.Nsamps):
+            L = np.linalg.cholesky(dense_from_blocks(self.A_NxTxdxd[n], self.B_NxTm1xdxd[n]))
+            self.assertAllClose(dense_from_blocks(AChol[n], BChol[n], symmetric=False), L)
+            b = self.b_NxTxd[n].flatten()
+            self.assertAllClose(x[n].flatten(), np.linalg.solve(L, b))
+            self.assertAllClose(xt[n].flatten(), np.linalg.solve(L.T, b))
+
+    def test_banded_solve(self):
+        AChol, BChol = np_smoother.blk_tridiag_chol(self.A_NxTxdxd, self.B_NxTm1xdxd)
+        x_chol = np_smoother.blk_chol_inv(AChol, BChol, np_smoother.blk_chol_inv(AChol, BChol,
+                                                                                 self.b_NxTxd),
+                                          lower=False, transpose=True)
+        x_banded = np_smoother.blk_tridiag_solve(self.A_NxTxdxd, self.B_NxTm1xdxd, self.b_NxTxd)
+        self.assertAllClose(x_chol, x_banded)
+
+    def test_precision_and_postX(self):
+        """
+        The posterior precision must be Lambda plus the precision of the prior
+        x_{t+1} = F_t*x_t + noise, with F_t = A_t if use_transpose_trick, else
+        A_t^T.
+        """
+        rng = np.random.RandomState(2)
+        Nsamps, NTbins, xDim = self.Nsamps, self.NTbins, self.xDim
+        M_NxTxdxd = rng.randn(Nsamps, NTbins, xDim, xDim)
+        Lambda_NxTxdxd = np.matmul(M_NxTxdxd, np.swapaxes(M_NxTxdxd, 2, 3)) + np.eye(xDim)
+        LambdaMu_NxTxd = rng.randn(Nsamps, NTbins, xDim)
+        A_NxTxdxd = 0.5*rng.randn(Nsamps, NTbins, xDim, xDim) + np.eye(xDim)
+        M_dxd = rng.randn(xDim, xDim)
+        QInv_dxd = np.dot(M_dxd, M_dxd.T) + np.eye(xDim)
+        Q0Inv_dxd = 0.5*np.eye(xDim)
+        for use_transpose_trick in [True, False]:
+            AA, BB = np_smoother.compute_precision(Lambda_NxTxdxd, A_NxTxdxd, QInv_dxd, Q0Inv_dxd,
+                                                   use_transpose_trick=use_transpose_trick)
+            postX = np_smoother.compute_postX(Lambda_NxTxdxd, LambdaMu_NxTxd, A_NxTxdxd,
+                                              QInv_dxd, Q0Inv_dxd,
+                                              use_transpose_trick=use_transpose_trick)
+            for n in range(Nsamps):
+                # The prior precision G^T*diag{Q0^-1, Q^-1, ...}*G, where G maps
+                # the path to the innovations x_0, x_1 - F_0*x_0, ...
+                G = np.eye(NTbins*xDim)
+                for t in range(NTbins-1):
+                    F_dxd = A_NxTxdxd[n,t] if use_transpose_trick else A_NxTxdxd[n,t].T
+                    G[(t+1)*xDim:(t+2)*xDim, t*xDim:(t+1)*xDim] = -F_dxd
+                QInvs = np.kron(np.eye(NTbins), QInv_dxd)
+                QInvs[:xDim,:xDim] = Q0Inv_dxd
+                Precision = ( np.dot(G.T, np.dot(QInvs, G)) +
+                              dense_from_blocks(Lambda_NxTxdxd[n],
+                                                np.zeros([NTbins-1, xDim, xDim])) )
+                self.assertAllClose(dense_from_blocks(AA[n], BB[n]), Precision)
+                self.assertAllClose(postX[n].flatten(),
+                                    np.dot(np.linalg.inv(Precision), LambdaMu_NxTxd[n].flatten()))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,333 @@
+# Copyright 2018 Daniel Hernandez Diaz, Columbia University
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+# ==============================================================================
+import os
+os.environ['TF_CPP_MIN_LOG_LEVEL'] = '2'
+
+import numpy as np
+import tensorflow as tf
+
+from code.utils import (blk_tridiag_chol, blk_chol_inv, blk_tridiag_chol_batch,
+                        blk_chol_inv_batch, blk_tridiag_chol_parallel, blk_chol_inv_parallel,
+                        blk_chol_selected_inv, BlockTridiagPrecision,
+                        with_analytic_grads, chol_dxd, tri_solve_dxd, matmul_dxd,
+                        EvolutionMatrices, LinearGaussianPrecision, lower_chol_variable,
+                        IdGroups, apply_to_nonzero_rows)
+from tests.blk_tridiag_helpers import random_blk_tridiag, dense_from_blocks
+
+DTYPE = tf.float32
+
+
+class BlockTridiagTest(tf.test.TestCase):
+    """
+    Checks the block-tridiagonal Cholesky and solves against dense numpy.
+    """
+    Nsamps = 5
+    NTbins = 12
+    xDim = 3
+    A_NxTxdxd, B_NxTm1xdxd = random_blk_tridiag(Nsamps, NTbins, xDim)
+    b_NxTxd = np.random.RandomState(1).randn(Nsamps, NTbins, xDim).astype('f')
+
+    def test_blk_tridiag_chol_batch(self):
+        with self.test_session() as sess:
+            AChol, BChol = sess.run(blk_tridiag_chol_batch(self.A_NxTxdxd, self.B_NxTm1xdxd))
+        for n in range(self.Nsamps):
+            M = dense_from_blocks(self.A_NxTxdxd[n], self.B_NxTm1xdxd[n])
+            L = dense_from_blocks(AChol[n], BChol[n], symmetric=False)
+            self.assertAllClose(M, np.dot(L, L.T), rtol=1e-4, atol=1e-4)
+
+    def test_batch_matches_single(self):
+        with self.test_session() as sess:
+            AChol_b, BChol_b = sess.run(blk_tridiag_chol_batch(self.A_NxTxdxd,
+                                                               self.B_NxTm1xdxd))
+            AChol_s, BChol_s = sess.run(blk_tridiag_chol(self.A_NxTxdxd[2],
+                                                         self.B_NxTm1xdxd[2]))
+        self.assertAllClose(AChol_b[2], AChol_s)
+        self.assertAllClose(BChol_b[2], BChol_s)
+
+    def test_blk_chol_inv_batch(self):
+        with self.test_session() as sess:
+            AChol, BChol = blk_tridiag_chol_batch(self.A_NxTxdxd, self.B_NxTm1xdxd)
+            x_NxTxd = blk_chol_inv_batch(AChol, BChol,
+                                         blk_chol_inv_batch(AChol, BChol, self.b_NxTxd),
+                                         lower=False, transpose=True)
+            x_Txd = blk_chol_inv(AChol[0], BChol[0],
+                                 blk_chol_inv(AChol[0], BChol[0], self.b_NxTxd[0]),
+                                 lower=False, transpose=True)
+            x_NxTxd, x_Txd = sess.run([x_NxTxd, x_Txd])
+        for n in range(self.Nsamps):
+            M = dense_from_blocks(self.A_NxTxdxd[n], self.B_NxTm1xdxd[n])
+            true_x = np.linalg.solve(M, self.b_NxTxd[n].flatten())
+            self.assertAllClose(x_NxTxd[n].flatten(), true_x, rtol=1e-4, atol=1e-4)
+        self.assertAllClose(x_NxTxd[0], x_Txd)
+
+    def test_parallel_matches_sequential(self):
+        with self.test_session() as sess:
+            A = tf.placeholder(DTYPE, [None, None, self.xDim, self.xDim])
+            B = tf.placeholder(DTYPE, [None, None, self.xDim, self.xDim])
+            b = tf.placeholder(DTYPE, [None, None, self.xDim])
+            seq_chol = blk_tridiag_chol_batch(A, B)
+            par_chol = blk_tridiag_chol_parallel(A, B)
+            seq_x = [blk_chol_inv_batch(seq_chol[0], seq_chol[1], b, lower=lower,
+                                        transpose=transpose)
+                     for lower in [True, False] for transpose in [True, False]]
+            par_x = [blk_chol_inv_parallel(seq_chol[0], seq_chol[1], b, lower=lower,
+                                           transpose=transpose)
+                     for lower in [True, False] for transpose in [True, False]]
+            # Include a T that is not a power of 2
+            for NTbins in [2, 7, self.NTbins]:
+                fd = {A : self.A_NxTxdxd[:,:NTbins], B : self.B_NxTm1xdxd[:,:NTbins-1],
+                      b : self.b_NxTxd[:,:NTbins]}
+                seq_vals, par_vals = sess.run([seq_chol + seq_x, par_chol + par_x],
+                                              feed_dict=fd)
+                for seq_val, par_val in zip(seq_vals, par_vals):
+                    self.assertAllClose(seq_val, par_val, rtol=1e-4, atol=1e-4)
+
+    def test_stacked_rhs(self):
+        with self.test_session() as sess:
+            b_NxTxdx2 = tf.constant(np.stack([self.b_NxTxd, -2*self.b_NxTxd[:,::-1]], axis=-1))
+            AChol, BChol = blk_tridiag_chol_batch(self.A_NxTxdxd, self.B_NxTm1xdxd)
+            for inv_fn in [blk_chol_inv_batch, blk_chol_inv_parallel]:
+                for lower, transpose in [(True, False), (False, True)]:
+                    x_NxTxdx2 = inv_fn(AChol, BChol, b_NxTxdx2, lower=lower, transpose=transpose)
+                    x_2xNxTxd = [inv_fn(AChol, BChol, b_NxTxdx2[...,k], lower=lower,
+                                        transpose=transpose) for k in range(2)]
+                    x_NxTxdx2, x_2xNxTxd = sess.run([x_NxTxdx2, x_2xNxTxd])
+                    self.assertAllClose(x_NxTxdx2, np.stack(x_2xNxTxd, axis=-1))
+            
+            precision = BlockTridiagPrecision(self.A_NxTxdxd, self.B_NxTm1xdxd)
+            noise_NxTxdx1 = tf.constant(self.b_NxTxd[...,None])
+            x_NxTxdx2, samp_NxTxdx1 = precision.inv_dot_and_sample(b_NxTxdx2, noise_NxTxdx1)
+            x, samp = sess.run([[precision.inv_dot(b_NxTxdx2[...,k]) for k in range(2)],
+                                precision.sample(noise_NxTxdx1[...,0])])
+            self.assertAllClose(x_NxTxdx2.eval(), np.stack(x, axis=-1))
+            self.assertAllClose(samp_NxTxdx1.eval()[...,0], samp)
+
+    def test_block_tridiag_precision(self):
+        with self.test_session() as sess:
+            precision = BlockTridiagPrecision(self.A_NxTxdxd, self.B_NxTm1xdxd)
+            b_NxTxd = tf.constant(self.b_NxTxd)
+            self.assertIs(precision.solve(b_NxTxd), precision.solve(b_NxTxd))
+            logdet, maha, x, samp = sess.run([precision.logdet(),
+                                              precision.mahalanobis(b_NxTxd),
+                                              precision.inv_dot(b_NxTxd),
+                                              precision.sample(b_NxTxd)])
+        for n in range(self.Nsamps):
+            M = dense_from_blocks(self.A_NxTxdxd[n], self.B_NxTm1xdxd[n])
+            b = self.b_NxTxd[n].flatten()
+            self.assertAllClose(logdet[n], np.linalg.slogdet(M)[1], rtol=1e-4)
+            self.assertAllClose(maha[n], np.dot(b, np.linalg.solve(M, b)), rtol=1e-4)
+            self.assertAllClose(x[n].flatten(), np.linalg.solve(M, b), rtol=1e-4, atol=1e-4)
+            self.assertAllClose(samp[n].flatten(), np.linalg.solve(np.linalg.cholesky(M).T, b),
+                                rtol=1e-4, atol=1e-4)
+
+    def test_mixed_precision(self):
+        with self.test_session() as sess:
+            precision = BlockTridiagPrecision(self.A_NxTxdxd, self.B_NxTm1xdxd,
+                                              dtype=tf.float64)
+            b_NxTxd = tf.constant(self.b_NxTxd)
+            outputs = [precision.logdet(), precision.inv_dot(b_NxTxd),
+                       precision.marginal_covariances()[0]]
+            for output in outputs:
+                self.assertEqual(output.dtype, DTYPE)
+            self.assertEqual(precision.AChol_NxTxdxd.dtype, tf.float64)
+            logdet, x, _ = sess.run(outputs)
+        for n in range(self.Nsamps):
+            M = dense_from_blocks(self.A_NxTxdxd[n], self.B_NxTm1xdxd[n])
+            b = self.b_NxTxd[n].flatten()
+            self.assertAllClose(logdet[n], np.linalg.slogdet(M)[1], rtol=1e-5)
+            self.assertAllClose(x[n].flatten(), np.linalg.solve(M, b), rtol=1e-5, atol=1e-5)
+
+    def test_analytic_grads(self):
+        with self.test_session() as sess:
+            A = tf.constant(self.A_NxTxdxd)
+            B = tf.constant(self.B_NxTm1xdxd)
+            b = tf.constant(self.b_NxTxd)
+            def loss(chol_fn, inv_fn):
+                AChol, BChol = chol_fn(A, B)
+                x = inv_fn(AChol, BChol, inv_fn(AChol, BChol, b), lower=False, transpose=True)
+                return ( tf.reduce_sum(tf.square(x)) +
+                         tf.reduce_sum(tf.log(tf.matrix_diag_part(AChol))) +
+                         tf.reduce_sum(tf.sin(BChol)) )
+            for chol_fn, inv_fn in [(blk_tridiag_chol_batch, blk_chol_inv_batch),
+                                    (blk_tridiag_chol_parallel, blk_chol_inv_parallel)]:
+                autodiff_grads = tf.gradients(loss(chol_fn, inv_fn), [A, B, b])
+                analytic_grads = tf.gradients(loss(*with_analytic_grads(chol_fn, inv_fn)),
+                                              [A, B, b])
+                autodiff_grads, analytic_grads = sess.run([autodiff_grads, analytic_grads])
+                for autodiff_grad, analytic_grad in zip(autodiff_grads, analytic_grads):
+                    self.assertAllClose(autodiff_grad, analytic_grad, rtol=1e-3, atol=1e-4)
+
+    def test_small_dim_kernels(self):
+        rng = np.random.RandomState(2)
+        with self.test_session() as sess:
+            for xDim in [2, 3]:
+                M = rng.randn(self.Nsamps, self.NTbins, xDim, xDim)
+                M_NxTxdxd = tf.constant(np.matmul(M, np.transpose(M, [0,1,3,2])) +
+                                        np.eye(xDim), dtype=DTYPE)
+                b_NxTxdx2 = tf.constant(rng.randn(self.Nsamps, self.NTbins, xDim, 2),
+                                        dtype=DTYPE)
+                L_NxTxdxd = tf.cholesky(M_NxTxdxd)
+                unrolled = [chol_dxd(M_NxTxdxd), tri_solve_dxd(L_NxTxdxd, b_NxTxdx2),
+                            tri_solve_dxd(L_NxTxdxd, b_NxTxdx2, adjoint=True),
+                            matmul_dxd(L_NxTxdxd, M_NxTxdxd, transpose_a=True)]
+                general = [L_NxTxdxd, tf.matrix_triangular_solve(L_NxTxdxd, b_NxTxdx2),
+                           tf.matrix_triangular_solve(L_NxTxdxd, b_NxTxdx2, adjoint=True),
+                           tf.matmul(L_NxTxdxd, M_NxTxdxd, transpose_a=True)]
+                unrolled, general = sess.run([unrolled, general])
+                for unrolled_val, general_val in zip(unrolled, general):
+                    self.assertAllClose(unrolled_val, general_val, rtol=1e-4, atol=1e-5)
+
+    def test_blk_chol_selected_inv(self):
+        with self.test_session() as sess:
+            AChol, BChol = blk_tridiag_chol_batch(self.A_NxTxdxd, self.B_NxTm1xdxd)
+            S_NxTxdxd, SOff_NxTm1xdxd = sess.run(blk_chol_selected_inv(AChol, BChol))
+        xDim = self.xDim
+        for n in range(self.Nsamps):
+            MInv = np.linalg.inv(dense_from_blocks(self.A_NxTxdxd[n], self.B_NxTm1xdxd[n]))
+            for t in range(self.NTbins):
+                self.assertAllClose(S_NxTxdxd[n,t],
+                                    MInv[t*xDim:(t+1)*xDim, t*xDim:(t+1)*xDim],
+                                    rtol=1e-4, atol=1e-5)
+            for t in range(self.NTbins-1):
+                self.assertAllClose(SOff_NxTm1xdxd[n,t],
+                                    MInv[(t+1)*xDim:(t+2)*xDim, t*xDim:(t+1)*xDim],
+                                    rtol=1e-4, atol=1e-5)
+
+    def test_linear_gaussian_precision(self):
+        # A precision with a shared off-diagonal block and stationary diagonal
+        # blocks, except for the first and the last. T = 2 leaves no room for
+        # the steady state.
+        rng = np.random.RandomState(3)
+        xDim = self.xDim
+        M_dxd = rng.randn(xDim, xDim)
+        Ass_dxd = np.dot(M_dxd, M_dxd.T) + 3*xDim*np.eye(xDim)
+        B_dxd = tf.constant(0.3*rng.randn(xDim, xDim), dtype=DTYPE)
+        for NTbins in [40, 2]:
+            A_NxTxdxd = np.tile(Ass_dxd, [self.Nsamps, NTbins, 1, 1])
+            A_NxTxdxd[:,0] += np.eye(xDim)
+            A_NxTxdxd[:,-1] -= np.eye(xDim)
+            A_NxTxdxd = A_NxTxdxd.astype('f')
+            b_NxTxd = tf.constant(rng.randn(self.Nsamps, NTbins, xDim), dtype=DTYPE)
+            with self.test_session() as sess:
+                B_NxTm1xdxd = tf.tile(tf.reshape(B_dxd, [1, 1, xDim, xDim]),
+                                      [self.Nsamps, NTbins-1, 1, 1])
+                precisions = [BlockTridiagPrecision(A_NxTxdxd, B_NxTm1xdxd),
+                              LinearGaussianPrecision(A_NxTxdxd, B_dxd),
+                              LinearGaussianPrecision(A_NxTxdxd, B_dxd, steady_state_tol=1e-6)]
+                outputs = [[precision.logdet(), precision.inv_dot(b_NxTxd),
+                            tf.gradients(tf.reduce_sum(precision.logdet()), B_dxd)[0]]
+                           for precision in precisions]
+                outputs = sess.run(outputs)
+            for output in outputs[1:]:
+                for val, expected in zip(output, outputs[0]):
+                    self.assertAllClose(val, expected, rtol=1e-4, atol=1e-4)
+
+    def test_lower_chol_variable(self):
+        rng = np.random.RandomState(4)
+        xDim = self.xDim
+        with self.test_session() as sess:
+            L_dxd, logdiag_d = lower_chol_variable('L', xDim, 2.0, DTYPE)
+            sess.run(tf.global_variables_initializer())
+            self.assertAllClose(sess.run(L_dxd), 2.0*np.eye(xDim))
+            # Any value of the variables gives a valid Cholesky factor
+            logdiag, offdiag = tf.trainable_variables()
+            sess.run([offdiag.assign(rng.randn(xDim, xDim)), logdiag.assign(rng.randn(xDim))])
+            L, logdiag = sess.run([L_dxd, logdiag_d])
+        self.assertAllClose(L, np.tril(L))
+        self.assertTrue(np.all(np.diag(L) > 0.0))
+        self.assertAllClose(2*np.sum(logdiag), np.linalg.slogdet(np.dot(L, L.T))[1], rtol=1e-5)
+
+    def test_evolution_matrices(self):
+        rng = np.random.RandomState(3)
+        Nsamps, NTbins, xDim, r, b = 3, 4, 6, 2, 3
+        Alinear_dxd = rng.randn(xDim, xDim)
+        M = rng.randn(xDim, xDim)
+        M_dxd = np.dot(M, M.T)
+        X_NxTxd = rng.randn(Nsamps, NTbins, xDim)
+        U_NxTxdxr, V_NxTxdxr = rng.randn(2, Nsamps, NTbins, xDim, r)
+        Bblocks_NxTxkxbxb = rng.randn(Nsamps, NTbins, xDim//b, b, b)
+        # A diagonal M, passed as its diagonal
+        Mdiag_d = rng.rand(xDim) + 0.5
+        scale_NxT, shift_NxT = rng.rand(2, Nsamps, NTbins)
+        Bblockdiag_NxTxdxd = np.zeros([Nsamps, NTbins, xDim, xDim])
+        for k in range(xDim//b):
+            Bblockdiag_NxTxdxd[:,:,k*b:(k+1)*b,k*b:(k+1)*b] = Bblocks_NxTxkxbxb[:,:,k]
+        const = lambda M : tf.constant(M, dtype=DTYPE)
+        with self.test_session() as sess:
+            structured = [
+                (EvolutionMatrices(const(Alinear_dxd), 0.5, U_NxTxdxr=const(U_NxTxdxr),
+                                   V_NxTxdxr=const(V_NxTxdxr)),
+                 np.matmul(U_NxTxdxr, np.transpose(V_NxTxdxr, [0,1,3,2]))),
+                (EvolutionMatrices(const(Alinear_dxd), 0.5,
+                                   Bblocks_NxTxkxbxb=const(Bblocks_NxTxkxbxb)),
+                 Bblockdiag_NxTxdxd)]
+            for A, B_NxTxdxd in structured:
+                for transpose, inflow in [(False, False), (True, False), (False, True),
+                                          (True, True)]:
+                    At = A.transpose() if transpose else A
+                    A_NxTxdxd = Alinear_dxd + 0.5*B_NxTxdxd
+                    if transpose: A_NxTxdxd = np.transpose(A_NxTxdxd, [0,1,3,2])
+                    if inflow:
+                        At = At.with_inflow(const(scale_NxT), const(shift_NxT))
+                        A_NxTxdxd = ( scale_NxT[:,:,None,None]*A_NxTxdxd +
+                                      shift_NxT[:,:,None,None]*np.eye(xDim) )
+                    At_NxTxdxd = np.transpose(A_NxTxdxd, [0,1,3,2])
+                    vals = sess.run([At.dense(), At.rmatvec(const(X_NxTxd)),
+                                     At.transpose_dot(const(M_dxd)),
+                                     At.quad_form(const(M_dxd)),
+                                     At.transpose_dot(const(Mdiag_d)),
+                                     At.quad_form(const(Mdiag_d))])
+                    expected = [A_NxTxdxd, np.einsum('nti,ntij->ntj', X_NxTxd, A_NxTxdxd),
+                                np.matmul(At_NxTxdxd, M_dxd),
+                                np.matmul(At_NxTxdxd, np.matmul(M_dxd, A_NxTxdxd)),
+                                At_NxTxdxd*Mdiag_d,
+                                np.matmul(At_NxTxdxd*Mdiag_d, A_NxTxdxd)]
+                    for val, exp in zip(vals, expected):
+                        self.assertAllClose(val, exp, rtol=1e-4, atol=1e-4)
+
+
+class NonzeroRowsTest(tf.test.TestCase):
+    
+    def test_apply_to_nonzero_rows(self):
+        rng = np.random.RandomState(5)
+        W_3x4, b_4 = rng.randn(3, 4), rng.randn(4)
+        X_Mx3 = np.zeros([10, 3])
+        X_Mx3[[2, 7]] = rng.randn(2, 3)
+        fn = lambda X : tf.nn.softplus(tf.matmul(X, tf.constant(W_3x4, DTYPE)) +
+                                       tf.constant(b_4, DTYPE))
+        with self.test_session() as sess:
+            X = tf.constant(X_Mx3, DTYPE)
+            fast, dense = sess.run([apply_to_nonzero_rows(fn, X), fn(X)])
+        self.assertAllClose(fast, dense, rtol=1e-5, atol=1e-6)
+
+
+class IdGroupsTest(tf.test.TestCase):
+    
+    def test_id_groups(self):
+        Ids_N = np.array([2, 0, 2, 5, 0, 2])
+        data_Nx3 = np.arange(18).reshape(6, 3)
+        groups = IdGroups(Ids_N)
+        self.assertAllEqual(groups.ids_E, [0, 2, 5])
+        self.assertAllEqual(groups.indices(2), [0, 2, 5])
+        self.assertAllEqual(groups.indices(3), [])
+        split = groups.split(groups.sort(data_Nx3))
+        self.assertEqual(sorted(split), [0, 2, 5])
+        for Id, data_nx3 in split.items():
+            self.assertAllEqual(data_nx3, data_Nx3[Ids_N == Id])
+
+
+if __name__ == '__main__':
+    tf.test.main()